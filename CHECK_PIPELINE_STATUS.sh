@@ -41,10 +41,15 @@ fi
 echo ""
 
 # 4. 特徴量ファイル
+features_dir="data/features/USDJPY/tf=M5"
 features_file="data/features/USDJPY/M5_features.parquet"
-if [ -f "$features_file" ]; then
+if [ -d "$features_dir" ]; then
+  month_count=$(find "$features_dir" -name "part-*.parquet" 2>/dev/null | wc -l | tr -d ' ')
+  dir_size=$(du -sh "$features_dir" | awk '{print $1}')
+  echo "[4] 特徴量ストア: ✅ 存在（${month_count}ヶ月分、サイズ: ${dir_size}）"
+elif [ -f "$features_file" ]; then
   file_size=$(ls -lh "$features_file" | awk '{print $5}')
-  echo "[4] 特徴量ファイル: ✅ 存在（サイズ: ${file_size}）"
+  echo "[4] 特徴量ファイル: ✅ 存在（サイズ: ${file_size}、旧形式）"
 else
   echo "[4] 特徴量ファイル: ⏳ 未生成"
 fi
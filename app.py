@@ -1,8 +1,10 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
+import hmac
 import os
-import subprocess
+import threading
+from functools import wraps
 from datetime import datetime, timedelta, timezone
 from pathlib import Path
 
@@ -12,9 +14,13 @@ from linebot.exceptions import InvalidSignatureError
 from linebot.models import MessageEvent, TextMessage, TextSendMessage
 from dotenv import load_dotenv
 
+from feature_store import FeatureStore
+from job_queue import JobQueue
+from job_runner import JobRunner
+
 # FX分析AIエージェント（高精度分析モデル）
 try:
-    from fx_ai_agent import analyze_fx, create_fx_agent
+    from fx_ai_agent import analyze_fx, cache_stats, cached_features, create_fx_agent, inference_stats
     FX_AI_AGENT_AVAILABLE = True
 except ImportError:
     FX_AI_AGENT_AVAILABLE = False
@@ -35,6 +41,8 @@ app = Flask(__name__)
 # 環境変数の読み込み（起動時エラーハンドリング）
 LINE_CHANNEL_ACCESS_TOKEN = os.getenv("LINE_CHANNEL_ACCESS_TOKEN")
 LINE_CHANNEL_SECRET = os.getenv("LINE_CHANNEL_SECRET")
+# 管理用エンドポイント（/jobs）のトークン（未設定ならそれらのエンドポイントは無効）
+ADMIN_TOKEN = os.getenv("ADMIN_TOKEN")
 
 # LINE Bot API初期化（環境変数が無い場合は後でエラーを返す）
 line_bot_api = None
@@ -56,35 +64,48 @@ ALLOWED_COMMANDS = {
     "予測": "predict",
     "データ更新": "update_data",
     "イベント更新": "update_events",
+    "モデル学習": "train_model",
+    "ジョブ状況": "job_status",
     "ヘルプ": "help",
 }
 
+# ジョブキューで実行するコマンド（Webhookの中では実行しない）
+JOB_LABELS = {
+    "update_data": "データ更新",
+    "update_events": "イベント更新",
+    "train_model": "モデル学習",
+}
+JOB_STATUS_LABELS = {
+    "queued": "待機中",
+    "running": "実行中",
+    "done": "完了",
+    "failed": "失敗",
+}
 
-def run_job(job_name: str, args: list = None, timeout: int = 300) -> tuple[bool, str]:
-    """ジョブを実行して結果を返す"""
-    jobs_dir = Path(__file__).parent / "jobs"
-    job_path = jobs_dir / f"{job_name}.py"
-    
-    if not job_path.exists():
-        return False, f"Job {job_name} not found"
-    
-    try:
-        cmd = ["python3", str(job_path)] + (args or [])
-        result = subprocess.run(
-            cmd,
-            capture_output=True,
-            text=True,
-            timeout=timeout,
-            cwd=jobs_dir.parent
-        )
-        if result.returncode == 0:
-            return True, result.stdout
-        else:
-            return False, result.stderr
-    except subprocess.TimeoutExpired:
-        return False, f"Job timeout ({timeout}s)"
-    except Exception as e:
-        return False, str(e)
+
+# ジョブ実行用のプロセスプール（ワーカー起動時にpandasなどを読み込んでおく）
+# import しただけでは起動しない。最初のジョブの投入時、または起動時のフック
+# （gunicorn.conf.py の post_worker_init、python app.py の場合は下の __main__）で起動する
+job_runner = JobRunner(workers=int(os.getenv("JOB_PROCESSES", "1")))
+
+
+def run_job(job_name: str, args: list = None, timeout: int = 300) -> tuple[bool, dict]:
+    """
+    ジョブを実行して結果を返す（jobs/<job_name>.py の run() をプロセスプール内で呼ぶ）
+
+    Returns:
+        (成功したか, ジョブの結果。失敗時は "error" を含む)
+    """
+    result = job_runner.run(job_name, args, timeout=timeout)
+    status = "OK" if result.get("ok") else "ERROR"
+    print(f"[{status}] job {job_name} ({result.get('elapsed_sec', '-')}s): "
+          f"{ {k: v for k, v in result.items() if k != 'log'} }")
+    return bool(result.get("ok")), result
+
+
+def job_error(result: dict) -> str:
+    """失敗したジョブの短いエラーメッセージ"""
+    return str(result.get("error") or "不明なエラー")[:200]
 
 
 def analyze_usdjpy() -> str:
@@ -96,13 +117,12 @@ def analyze_usdjpy() -> str:
         # フォールバック: 簡易分析
         # プロジェクトルートからの絶対パスを使用
         project_root = Path(__file__).parent
-        features_path = project_root / "data/features/USDJPY/M5_features.parquet"
-        if not features_path.exists():
+        store = FeatureStore("USDJPY", "M5", root=project_root / "data/features")
+        if not store.exists():
             return "特徴量ファイルが見つかりません。まずデータ更新を実行してください。"
         
-        import pandas as pd
         try:
-            df = pd.read_parquet(features_path)
+            df = store.latest(1)
             latest = df.iloc[-1]
             
             result = f"""USDJPY 最新分析結果
@@ -136,7 +156,7 @@ def update_data() -> str:
     # 方法1: Yahoo Financeからデータを取得（最も確実で簡単）
     print("[INFO] Yahoo Financeからデータを取得中...")
     results.append("📥 Yahoo Financeからデータを取得中...")
-    success_yahoo, msg_yahoo = run_job("download_yahoo_finance", [
+    success_yahoo, res_yahoo = run_job("download_yahoo_finance", [
         "--pair", "USDJPY",
         "--start-date", start_date,
         "--end-date", end_date,
@@ -144,15 +164,15 @@ def update_data() -> str:
     ], timeout=180)  # タイムアウトを3分に短縮
     
     if success_yahoo:
-        results.append("✅ Yahoo Financeデータ取得完了")
+        results.append(f"✅ Yahoo Financeデータ取得完了（{res_yahoo.get('rows', 0)}本）")
         
         # Yahoo Financeデータをbuild_features.pyが読み込める形式に変換
-        # data/yahoo_finance/USDJPY/1h.parquet → data/bars/USDJPY/tf=H1/all.parquet
+        # （ジョブが返した保存先） → data/bars/USDJPY/tf=H1/month=YYYY-MM/part-000.parquet
         try:
             import pandas as pd
-            from pathlib import Path
+            from jobs.build_bars_from_m1 import migrate_legacy_bars, upsert_bars
             
-            yahoo_path = Path("data/yahoo_finance/USDJPY/1h.parquet")
+            yahoo_path = Path(res_yahoo["path"])
             bars_dir = Path("data/bars/USDJPY/tf=H1")
             
             if yahoo_path.exists():
@@ -171,49 +191,23 @@ def update_data() -> str:
                 # 必要なカラムがあるか確認
                 required_cols = ["open", "high", "low", "close"]
                 if all(col in df.columns for col in required_cols):
-                    bars_path = bars_dir / "all.parquet"
-                    df.to_parquet(bars_path, index=False)
+                    # 取得した期間の行だけを月別パーティションに反映する（以前の all.parquet は先に移す）
+                    migrate_legacy_bars(bars_dir)
+                    df["ts"] = pd.to_datetime(df["ts"], utc=True, errors="coerce")
+                    df = df.dropna(subset=["ts"]).drop_duplicates("ts", keep="last").set_index("ts").sort_index()
+                    upsert_bars(bars_dir, df)
                     results.append("✅ H1バーデータを準備完了")
                 else:
                     results.append("⚠️ Yahoo Financeデータに必要なカラムがありません")
         except Exception as e:
             results.append(f"⚠️ バーデータ変換エラー: {str(e)[:100]}")
     else:
-        results.append(f"⚠️ Yahoo Finance取得エラー: {msg_yahoo}")
+        results.append(f"⚠️ Yahoo Finance取得エラー: {job_error(res_yahoo)}")
     
     # 方法2: DukascopyからBI5をダウンロード（スキップ - 時間がかかりすぎる）
     # Render環境ではYahoo Financeのみを使用
     results.append("⏭️ Dukascopyはスキップ（Yahoo Financeデータを使用）")
     
-    if success_bi5:
-        results.append("✅ Dukascopy BI5ダウンロード完了")
-        
-        # M1生成
-        start_date_m1 = (now - timedelta(days=1)).strftime("%Y-%m-%d")
-        end_date_m1 = now.strftime("%Y-%m-%d")
-        success_m1, msg_m1 = run_job("build_m1_from_bi5", [
-            "--pair", "USDJPY",
-            "--start-date", start_date_m1,
-            "--end-date", end_date_m1
-        ], timeout=300)
-        
-        if success_m1:
-            results.append("✅ M1バー生成完了")
-            
-            # 全時間足生成
-            success_bars, msg_bars = run_job("build_bars_from_m1", [
-                "--pair", "USDJPY"
-            ], timeout=300)
-            
-            if success_bars:
-                results.append("✅ 時間足バー生成完了")
-            else:
-                results.append(f"⚠️ 時間足生成エラー: {msg_bars}")
-        else:
-            results.append(f"⚠️ M1生成エラー: {msg_m1}")
-    else:
-        results.append(f"⚠️ Dukascopy取得エラー: {msg_bi5}（スキップ）")
-    
     # イベントデータ取得（簡略化 - スキップして高速化）
     # results.append("⏭️ イベントデータはスキップ（高速化のため）")
     
@@ -221,58 +215,130 @@ def update_data() -> str:
     # Yahoo FinanceからはH1データを取得しているため、H1特徴量を生成
     print("[INFO] 特徴量を生成中...")
     results.append("🔧 特徴量を生成中...")
-    success_features, msg_features = run_job("build_features", [
+    success_features, res_features = run_job("build_features", [
         "--pair", "USDJPY",
         "--timeframe", "H1"  # Yahoo Financeは1hデータなので、H1特徴量を生成
     ], timeout=180)  # タイムアウトを3分に短縮
     
     if success_features:
-        results.append("✅ 特徴量生成完了")
+        results.append(f"✅ 特徴量生成完了（{res_features.get('rows', 0)}行、{res_features.get('elapsed_sec')}秒）")
         return "\n".join(results) + "\n\n✅ データ更新完了！「分析」コマンドを試してください。"
     else:
-        # エラーメッセージを短縮
-        error_msg = str(msg_features)[:200] if msg_features else "不明なエラー"
-        results.append(f"⚠️ 特徴量生成エラー: {error_msg}")
+        results.append(f"⚠️ 特徴量生成エラー: {job_error(res_features)}")
         return "\n".join(results) + "\n\n⚠️ 一部の処理が失敗しました。数分待ってから再度「データ更新」を試してください。"
 
 
 def update_events() -> str:
     """イベント更新を実行"""
-    events_cache = "data/events/events_cache.parquet"
+    events_db = "data/events/events.sqlite"
     
     # マクロイベント
-    success1, msg1 = run_job("fetch_macro_events", [
-        "--events-cache", events_cache
+    success1, res1 = run_job("fetch_macro_events", [
+        "--events-cache", events_db
     ])
     
     # RSSイベント
-    success2, msg2 = run_job("fetch_rss_events", [
-        "--events-cache", events_cache
+    success2, res2 = run_job("fetch_rss_events", [
+        "--events-cache", events_db
     ])
     
     if success1 and success2:
-        return "✅ イベント更新完了"
+        return f"✅ イベント更新完了（イベント数: {res2.get('rows', 0)}件）"
     else:
-        return f"⚠️ 一部エラー: {msg1 or msg2}"
+        return f"⚠️ 一部エラー: {job_error(res1 if not success1 else res2)}"
 
 
 def train_fx_model() -> str:
     """FXモデル学習を実行（自動判定付き）"""
     # 自動学習スクリプトを使用（再学習判定あり）
     # モデル学習は時間がかかる可能性があるため、タイムアウトを延長
-    success, msg = run_job("auto_train_model", [
+    success, res = run_job("auto_train_model", [
         "--pair", "USDJPY",
         "--features-tf", "M5",
         "--force"  # LINE Botから実行時は強制学習
     ], timeout=1800)  # 30分タイムアウト
     
-    if success:
-        return f"✅ モデル学習完了\n\n{msg}\n\nモデル保存先: models/fx_usdjpy_model.pkl"
+    if success and res.get("trained"):
+        cv = res.get("cv_scores", {})
+        return (f"✅ モデル学習完了\n\n"
+                f"学習データ: {res.get('rows', 0)}行（特徴量 {res.get('feature_count', 0)}個）\n"
+                f"検証精度: {cv.get('val_mean', 0):.3f}±{cv.get('val_std', 0):.3f}\n"
+                f"所要時間: {res.get('elapsed_sec')}秒\n\n"
+                f"モデル保存先: {res.get('model_path')}")
+    elif success:
+        return f"⚠️ モデル学習をスキップしました（{res.get('reason')}）"
     else:
         # タイムアウトの場合は別メッセージ
-        if "timeout" in msg.lower():
+        if res.get("timeout"):
             return "⚠️ モデル学習がタイムアウトしました（30分）。データ量が多い場合は時間がかかります。\n\nバックグラウンドで実行するか、データ量を減らして再試行してください。"
-        return f"⚠️ モデル学習エラー: {msg}"
+        return f"⚠️ モデル学習エラー: {job_error(res)}"
+
+
+_job_queue = None
+_job_queue_lock = threading.Lock()
+
+
+def notify_job_finished(job: dict):
+    """ジョブ完了をジョブを依頼した全員にpush通知"""
+    if not line_bot_api or not job["notify"]:
+        return
+    label = JOB_LABELS.get(job["kind"], job["kind"])
+    if job["status"] == "done":
+        text = f"✅ {label}（ジョブ#{job['id']}）が完了しました\n\n{job['result']}"
+    else:
+        text = f"⚠️ {label}（ジョブ#{job['id']}）が失敗しました\n\n{job['result']}"
+    for to in job["notify"]:
+        try:
+            line_bot_api.push_message(to, TextSendMessage(text=text[:4900]))
+        except Exception as e:
+            print(f"[ERROR] Failed to push job result to {to}: {e}")
+
+
+def get_job_queue() -> JobQueue:
+    """ジョブキュー（初回呼び出し時にワーカースレッドを起動）"""
+    global _job_queue
+    with _job_queue_lock:
+        if _job_queue is None:
+            _job_queue = JobQueue(
+                handlers={
+                    "update_data": update_data,
+                    "update_events": update_events,
+                    "train_model": train_fx_model,
+                },
+                db_path=os.getenv("JOB_QUEUE_DB", "data/jobs.sqlite"),
+                workers=int(os.getenv("JOB_WORKERS", "2")),
+                on_finish=notify_job_finished,
+            )
+        return _job_queue
+
+
+def line_target(event) -> str:
+    """push通知の宛先（グループ・トークルームならそちら）"""
+    source = event.source
+    return getattr(source, "group_id", None) or getattr(source, "room_id", None) or source.user_id
+
+
+def submit_job_reply(kind: str, event) -> str:
+    """ジョブを投入して、受付メッセージを返す（実行中なら合流）"""
+    job, joined = get_job_queue().submit(kind, notify_to=line_target(event))
+    label = JOB_LABELS[kind]
+    if joined:
+        status = JOB_STATUS_LABELS.get(job["status"], job["status"])
+        return f"⏳ {label}はすでに{status}です（ジョブ#{job['id']}）。\n完了したらお知らせします。"
+    return f"🔄 {label}を受け付けました（ジョブ#{job['id']}）。\n完了したらお知らせします（数分かかる場合があります）。"
+
+
+def job_status_text(limit: int = 5) -> str:
+    jobs = get_job_queue().recent(limit)
+    if not jobs:
+        return "📋 実行したジョブはありません"
+    lines = ["📋 最近のジョブ"]
+    for job in jobs:
+        label = JOB_LABELS.get(job["kind"], job["kind"])
+        status = JOB_STATUS_LABELS.get(job["status"], job["status"])
+        when = job["finished_at"] or job["started_at"] or job["created_at"]
+        lines.append(f"#{job['id']} {label}: {status}（{when}）")
+    return "\n".join(lines)
 
 
 @app.route("/callback", methods=["POST"])
@@ -321,6 +387,7 @@ def handle_message(event):
 • データ更新 - Dukascopyから最新データを取得
 • イベント更新 - 経済指標・要人発言を更新
 • モデル学習 - 高精度分析モデルを学習・更新
+• ジョブ状況 - データ更新・モデル学習などの実行状況を表示
 
 例: 「分析」「データ更新して」「モデル学習」
 
@@ -342,30 +409,14 @@ def handle_message(event):
             line_bot_api.reply_message(event.reply_token, TextSendMessage(text=result))
             return
         
-        if cmd == "update_data":
-            # 即座に応答を返す（処理が長時間かかる可能性があるため）
-            line_bot_api.reply_message(
-                event.reply_token,
-                TextSendMessage(text="🔄 データ更新を開始しました。処理中です...\n\n（数分かかる場合があります）")
-            )
-            # バックグラウンドで処理を実行（LINE Botのタイムアウトを回避）
-            try:
-                result = update_data()
-                # 処理完了後にユーザーに通知（オプション - 実装が複雑なため、今回はスキップ）
-                # ユーザーは「分析」コマンドで結果を確認できる
-            except Exception as e:
-                print(f"[ERROR] Data update failed: {e}")
-            return
-        
-        if cmd == "update_events":
-            result = update_events()
+        if cmd in JOB_LABELS:
+            # 時間のかかる処理はジョブキューで実行し、Webhookはすぐに返す（完了時にpush通知）
+            result = submit_job_reply(cmd, event)
             line_bot_api.reply_message(event.reply_token, TextSendMessage(text=result))
             return
         
-        if cmd == "train_model" or cmd == "モデル学習":
-            # モデル学習を実行（バックグラウンド推奨）
-            result = train_fx_model()
-            line_bot_api.reply_message(event.reply_token, TextSendMessage(text=result))
+        if cmd == "job_status":
+            line_bot_api.reply_message(event.reply_token, TextSendMessage(text=job_status_text()))
             return
         
         # コマンドが一致しない場合: FX分析AIエージェントまたは外部ネイティブAIに投げる
@@ -408,10 +459,12 @@ def handle_message(event):
                 # FX分析データをcontextに含める（あれば）
                 context = None
                 try:
-                    features_path = Path("data/features/USDJPY/M5_features.parquet")
-                    if features_path.exists():
-                        import pandas as pd
-                        df = pd.read_parquet(features_path)
+                    store = FeatureStore("USDJPY", "M5")
+                    if store.exists():
+                        if FX_AI_AGENT_AVAILABLE:
+                            df = cached_features(store)
+                        else:
+                            df = store.latest(1, columns=["rsi_14", "atr_14", "close"])
                         latest = df.iloc[-1] if not df.empty else None
                         if latest is not None:
                             context = f"FX分析コンテキスト: RSI={latest.get('rsi_14', 'N/A'):.2f}, ATR={latest.get('atr_14', 'N/A'):.4f}, 価格={latest.get('close', 'N/A'):.2f}"
@@ -485,6 +538,53 @@ else:
     print("[WARN] LINE handler not registered. Set LINE_CHANNEL_ACCESS_TOKEN and LINE_CHANNEL_SECRET to enable LINE features.")
 
 
+@app.route("/model", methods=["GET"])
+def model_stats():
+    """推論の内訳（学習済みモデルが使われているか）とキャッシュの状態"""
+    from flask import jsonify
+    if not FX_AI_AGENT_AVAILABLE:
+        return jsonify({"error": "fx_ai_agent not available"}), 503
+    return jsonify({"inference": inference_stats(), "cache": cache_stats()}), 200
+
+
+def require_admin(view):
+    """X-Admin-Token ヘッダが ADMIN_TOKEN と一致するときだけ通す（ADMIN_TOKEN 未設定なら 404）"""
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        if not ADMIN_TOKEN:
+            abort(404)
+        token = request.headers.get("X-Admin-Token", "")
+        if not hmac.compare_digest(token.encode("utf-8"), ADMIN_TOKEN.encode("utf-8")):
+            abort(401)
+        return view(*args, **kwargs)
+    return wrapper
+
+
+def public_job(job: dict) -> dict:
+    """APIで返すジョブの内容（通知先のLINEのユーザー/グループIDは含めない）"""
+    return {k: v for k, v in job.items() if k != "notify"}
+
+
+@app.route("/jobs", methods=["GET"])
+@require_admin
+def jobs():
+    """最近のジョブ一覧"""
+    from flask import jsonify
+    limit = request.args.get("limit", default=20, type=int)
+    return jsonify([public_job(j) for j in get_job_queue().recent(limit)]), 200
+
+
+@app.route("/jobs/<int:job_id>", methods=["GET"])
+@require_admin
+def job_status(job_id: int):
+    """ジョブの状態"""
+    from flask import jsonify
+    job = get_job_queue().get(job_id)
+    if job is None:
+        return jsonify({"error": "job not found"}), 404
+    return jsonify(public_job(job)), 200
+
+
 @app.route("/", methods=["GET"])
 def index():
     """ルートエンドポイント"""
@@ -494,6 +594,8 @@ def index():
         "endpoints": {
             "/health": "Health check",
             "/callback": "LINE Webhook (POST)",
+            "/jobs": "Recent jobs (データ更新・イベント更新・モデル学習。X-Admin-Token ヘッダが必要)",
+            "/model": "Model inference stats (model / rules / fallbacks)",
             "/": "This page"
         },
         "line_enabled": line_bot_api is not None,
@@ -506,4 +608,5 @@ if __name__ == "__main__":
     port = int(os.getenv("PORT", 5000))
     print(f"[INFO] Starting server on port {port}")
     print(f"[INFO] Health check: http://localhost:{port}/health")
+    job_runner.warm()
     app.run(host="0.0.0.0", port=port, debug=False)
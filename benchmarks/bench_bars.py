@@ -0,0 +1,92 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+時間足生成のベンチマーク
+時間足ごとのpandas resample（旧実装）と単一パスの集計エンジンを比較する
+
+使い方:
+    python3 benchmarks/bench_bars.py --years 5
+"""
+
+import argparse
+import sys
+import time
+import warnings
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, str(Path(__file__).parent.parent))
+
+from jobs.build_bars_from_m1 import (
+    TF_MAP, aggregate_timeframes, build_6m_from_1m, build_monthly, resample_ohlc,
+)
+
+TFS = ["M5", "M15", "H1", "H4", "D1", "W1", "1M", "6M"]
+
+
+def synthetic_m1(years: int, seed: int = 0) -> pd.DataFrame:
+    """平日のみのM1（FXの営業時間を模したもの）"""
+    rng = np.random.default_rng(seed)
+    idx = pd.date_range("2019-01-01", periods=int(years * 365.25 * 1440), freq="1min", tz="UTC")
+    idx = idx[idx.dayofweek < 5]
+    n = len(idx)
+    close = 110 + np.cumsum(rng.normal(0, 0.005, n))
+    spread = rng.random(n) * 0.01
+    spread[rng.random(n) < 0.01] = np.nan
+    return pd.DataFrame({
+        "open": close + rng.normal(0, 0.002, n),
+        "high": close + 0.01,
+        "low": close - 0.01,
+        "close": close,
+        "vol": rng.random(n) * 10,
+        "spread": spread,
+    }, index=pd.DatetimeIndex(idx, name="ts"))
+
+
+def pandas_bars(m1: pd.DataFrame) -> dict:
+    """旧実装: 時間足ごとにresample（6Mは月足をもう一度作り直す）"""
+    out = {}
+    for tf in TFS:
+        if tf == "1M":
+            out[tf] = build_monthly(m1)
+        elif tf == "6M":
+            out[tf] = build_6m_from_1m(build_monthly(m1))
+        else:
+            out[tf] = resample_ohlc(m1, TF_MAP.get(tf, tf))
+    return out
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--years", type=int, default=5)
+    args = ap.parse_args()
+    warnings.simplefilter("ignore", FutureWarning)
+
+    m1 = synthetic_m1(args.years)
+    print(f"[INFO] M1 rows: {len(m1):,} ({m1.index[0]} - {m1.index[-1]})")
+
+    t0 = time.perf_counter()
+    expected = pandas_bars(m1)
+    t_pandas = time.perf_counter() - t0
+
+    t0 = time.perf_counter()
+    actual = aggregate_timeframes(m1, TFS)
+    t_engine = time.perf_counter() - t0
+
+    ohlc = ["open", "high", "low", "close"]
+    for tf in TFS:
+        a, b = expected[tf], actual[tf]
+        # OHLCはビット単位で一致、vol/spreadは加算順の違いのみ
+        pd.testing.assert_frame_equal(a[ohlc], b[ohlc], check_freq=False, check_exact=True)
+        pd.testing.assert_frame_equal(a, b, check_freq=False, check_exact=False, rtol=1e-12)
+
+    print(f"[OK] pandas resample x{len(TFS)}: {t_pandas:.2f}s")
+    print(f"[OK] single-pass engine  : {t_engine:.2f}s")
+    print(f"[OK] speedup             : x{t_pandas / t_engine:.1f} (all {len(TFS)} timeframes match)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,133 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+データソースのマージのベンチマーク
+ソースごとに set/isin で追加して全体を再ソートする旧実装と、(ts, 優先順位) の1回のソートで決める実装を比較する。
+Yahoo/OANDAの読み込みは、全行の .dt.date で絞る旧実装と ts のフィルタを読み込みに渡す実装を比較する。
+
+使い方:
+    python3 benchmarks/bench_merge.py --years 5
+"""
+
+import argparse
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, str(Path(__file__).parent.parent))
+
+from jobs.merge_data_sources import load_range_files, merge_frames
+
+PRIORITY = ["dukascopy", "yahoo", "oanda"]
+
+
+def synthetic_m1(years: int, source: str, missing: float, seed: int) -> pd.DataFrame:
+    """平日のみのM1から1時間単位で missing の割合を欠損させたもの"""
+    rng = np.random.default_rng(seed)
+    idx = pd.date_range("2019-01-01", periods=int(years * 365.25 * 1440), freq="1min", tz="UTC")
+    idx = idx[idx.dayofweek < 5]
+    hours = idx.floor("h")
+    uniq = hours.unique()
+    dropped = uniq[rng.random(len(uniq)) < missing]
+    idx = idx[~hours.isin(dropped)]
+    n = len(idx)
+    close = 110 + np.cumsum(rng.normal(0, 0.005, n))
+    return pd.DataFrame({
+        "ts": idx,
+        "open": close + rng.normal(0, 0.002, n),
+        "high": close + 0.01,
+        "low": close - 0.01,
+        "close": close,
+        "vol": rng.random(n) * 10,
+        "source": source,
+    })
+
+
+def legacy_merge_frames(all_data: dict, priority: list) -> pd.DataFrame:
+    """旧実装: ソースごとに set(ts) にない行を追加して全体を再ソート"""
+    merged_df = None
+    for source in priority:
+        if source in all_data:
+            df = all_data[source].copy()
+            if merged_df is None:
+                merged_df = df
+            else:
+                existing_ts = set(merged_df['ts'])
+                new_rows = df[~df['ts'].isin(existing_ts)]
+                if not new_rows.empty:
+                    merged_df = pd.concat([merged_df, new_rows], ignore_index=True)
+                    merged_df = merged_df.sort_values('ts').reset_index(drop=True)
+    return merged_df
+
+
+def legacy_load(data_dir: Path, start_date: str, end_date: str, source: str) -> pd.DataFrame:
+    """旧実装: ファイル全体を読んで全行の .dt.date で絞る"""
+    dfs = []
+    for parquet_file in sorted(data_dir.glob("*.parquet")):
+        df = pd.read_parquet(parquet_file)
+        df['date'] = pd.to_datetime(df['ts']).dt.date
+        start = pd.to_datetime(start_date).date()
+        end = pd.to_datetime(end_date).date()
+        df = df[(df['date'] >= start) & (df['date'] <= end)]
+        if not df.empty:
+            dfs.append(df.drop('date', axis=1))
+    result = pd.concat(dfs, ignore_index=True)
+    result = result.sort_values('ts').reset_index(drop=True)
+    result['source'] = source
+    return result
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--years", type=int, default=5)
+    args = ap.parse_args()
+
+    data = {
+        "dukascopy": synthetic_m1(args.years, "dukascopy", missing=0.05, seed=0),
+        "yahoo": synthetic_m1(args.years, "yahoo", missing=0.20, seed=1),
+        "oanda": synthetic_m1(args.years, "oanda", missing=0.10, seed=2),
+    }
+    print("[INFO] M1 rows: " + ", ".join(f"{k}={len(v):,}" for k, v in data.items()))
+
+    t0 = time.perf_counter()
+    expected = legacy_merge_frames(data, PRIORITY)
+    t_legacy = time.perf_counter() - t0
+
+    t0 = time.perf_counter()
+    actual = merge_frames(data, PRIORITY)
+    t_engine = time.perf_counter() - t0
+
+    pd.testing.assert_frame_equal(expected.reset_index(drop=True), actual, check_exact=True)
+    print(f"[OK] merge: legacy {t_legacy:.2f}s, sort-merge {t_engine:.2f}s "
+          f"(x{t_legacy / t_engine:.1f}, {len(actual):,} rows match)")
+
+    # 1ソースの複数年のファイルから1か月分を読む
+    with tempfile.TemporaryDirectory() as tmp:
+        src_dir = Path(tmp)
+        yahoo = data["yahoo"].drop(columns="source")
+        for year, df in yahoo.groupby(yahoo["ts"].dt.year):
+            df.to_parquet(src_dir / f"{year}.parquet", index=False, row_group_size=50_000)
+        last = yahoo["ts"].iloc[-1]
+        start_date = (last - pd.Timedelta(days=30)).strftime("%Y-%m-%d")
+        end_date = last.strftime("%Y-%m-%d")
+
+        t0 = time.perf_counter()
+        expected = legacy_load(src_dir, start_date, end_date, "yahoo")
+        t_legacy = time.perf_counter() - t0
+
+        t0 = time.perf_counter()
+        actual = load_range_files(src_dir, start_date, end_date, "yahoo")
+        t_engine = time.perf_counter() - t0
+
+    pd.testing.assert_frame_equal(expected, actual, check_exact=True)
+    print(f"[OK] load {start_date}..{end_date}: legacy {t_legacy:.2f}s, pushdown {t_engine:.2f}s "
+          f"(x{t_legacy / t_engine:.1f}, {len(actual):,} rows match)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,119 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+bi5デコードのベンチマーク
+旧実装（struct.unpack_fromのPythonループ）とNumPy構造化dtype版を比較する
+
+使い方:
+    python3 benchmarks/bench_parse_bi5.py --hours 24 --ticks-per-hour 20000
+"""
+
+import argparse
+import lzma
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, str(Path(__file__).parent.parent))
+
+from jobs.build_m1_from_bi5 import RECORD, RECORD_DTYPE, decode_ticks, hour_base, parse_bi5
+
+
+def decode_ticks_loop(buf: bytes, base: datetime, price_scale: int) -> pd.DataFrame:
+    """旧実装: 1レコードずつunpackしてdatetimeを生成する"""
+    rows = []
+    for off in range(0, len(buf), RECORD.size):
+        if off + RECORD.size > len(buf):
+            break
+        t_ms, ask_i, bid_i, ask_v, bid_v = RECORD.unpack_from(buf, off)
+        ts = base + timedelta(milliseconds=int(t_ms))
+        rows.append((ts, bid_i / price_scale, ask_i / price_scale, float(bid_v), float(ask_v)))
+
+    df = pd.DataFrame(rows, columns=["ts", "bid", "ask", "bid_vol", "ask_vol"])
+    df = df.sort_values("ts")
+    df["mid"] = (df["bid"] + df["ask"]) / 2.0
+    df["spread"] = df["ask"] - df["bid"]
+    return df
+
+
+def parse_bi5_loop(path: Path, price_scale: int) -> pd.DataFrame:
+    with lzma.open(path, "rb") as f:
+        buf = f.read()
+    return decode_ticks_loop(buf, hour_base(path), price_scale)
+
+
+def write_corpus(root: Path, start: datetime, hours: int, ticks_per_hour: int, seed: int = 0) -> list:
+    """合成bi5ファイルをDukascopyと同じディレクトリ構造で書き出す"""
+    rng = np.random.default_rng(seed)
+    paths = []
+    for i in range(hours):
+        dt = start + timedelta(hours=i)
+        rec = np.zeros(ticks_per_hour, dtype=RECORD_DTYPE)
+        rec["t_ms"] = np.sort(rng.integers(0, 3_600_000, ticks_per_hour))
+        bid = 150_000 + np.cumsum(rng.integers(-3, 4, ticks_per_hour))
+        rec["bid"] = bid
+        rec["ask"] = bid + rng.integers(1, 10, ticks_per_hour)
+        rec["bid_vol"] = rng.random(ticks_per_hour) * 5
+        rec["ask_vol"] = rng.random(ticks_per_hour) * 5
+
+        path = root / f"{dt.year}" / f"{dt.month - 1:02d}" / f"{dt.day:02d}" / f"{dt.hour:02d}h_ticks.bi5"
+        path.parent.mkdir(parents=True, exist_ok=True)
+        with lzma.open(path, "wb") as f:
+            f.write(rec.tobytes())
+        paths.append(path)
+    return paths
+
+
+def timed(fn, paths, price_scale):
+    t0 = time.perf_counter()
+    frames = [fn(p, price_scale) for p in paths]
+    return time.perf_counter() - t0, frames
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--hours", type=int, default=24)
+    ap.add_argument("--ticks-per-hour", type=int, default=20000)
+    ap.add_argument("--price-scale", type=int, default=1000)
+    args = ap.parse_args()
+
+    start = datetime(2025, 1, 6, tzinfo=timezone.utc)
+    with tempfile.TemporaryDirectory() as tmp:
+        paths = write_corpus(Path(tmp) / "USDJPY", start, args.hours, args.ticks_per_hour)
+        total = args.hours * args.ticks_per_hour
+        print(f"[INFO] corpus: {args.hours} hours, {total} ticks")
+
+        t_loop, loop_frames = timed(parse_bi5_loop, paths, args.price_scale)
+        t_vec, vec_frames = timed(parse_bi5, paths, args.price_scale)
+
+        for a, b in zip(loop_frames, vec_frames):
+            pd.testing.assert_frame_equal(a.reset_index(drop=True), b.reset_index(drop=True))
+
+        # LZMA解凍を除いたデコード部分のみ
+        bufs = []
+        for p in paths:
+            with lzma.open(p, "rb") as f:
+                bufs.append((f.read(), hour_base(p)))
+        t0 = time.perf_counter()
+        for buf, base in bufs:
+            decode_ticks_loop(buf, base, args.price_scale)
+        t_dec_loop = time.perf_counter() - t0
+        t0 = time.perf_counter()
+        for buf, base in bufs:
+            decode_ticks(buf, base, args.price_scale)
+        t_dec_vec = time.perf_counter() - t0
+
+    print(f"[OK] parse (lzma + decode) loop      : {t_loop:.3f}s ({total / t_loop:,.0f} ticks/s)")
+    print(f"[OK] parse (lzma + decode) vectorized: {t_vec:.3f}s ({total / t_vec:,.0f} ticks/s)")
+    print(f"[OK] parse speedup : x{t_loop / t_vec:.1f} (outputs identical)")
+    print(f"[OK] decode only   : loop {t_dec_loop:.3f}s, vectorized {t_dec_vec:.3f}s -> x{t_dec_loop / t_dec_vec:.1f}")
+
+
+if __name__ == "__main__":
+    main()
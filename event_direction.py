@@ -0,0 +1,120 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+経済指標の方向符号（通貨ペア別）
+
+指標名のキーワードと国から、その指標が強い（実績 > 予想）ときに通貨ペアが上がるなら +1、下がるなら -1 を返す。
+- 基軸通貨の国の指標は +1、決済通貨の国の指標は -1
+- 失業率・失業保険申請件数などは高いほど弱いので符号を反転する
+- どちらの国でもない、またはキーワードに当たらない指標は default（+1）
+
+キーワードは正規表現1本にまとめ、列全体のユニークな (指標名, 国) についてだけ判定する。
+分類器はペアごとに1つ作って使い回し、判定結果もペアごとに保持する。
+"""
+
+import re
+from functools import lru_cache
+from typing import Dict, Iterable, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+
+INFLATION_KEYWORDS = ["cpi", "pce", "ppi", "inflation", "deflator", "core"]
+LABOR_KEYWORDS = ["payroll", "employment", "wage", "earnings"]
+RATES_KEYWORDS = ["interest rate", "rate decision", "fomc", "fed", "powell", "minutes", "policy", "statement", "boj"]
+GROWTH_KEYWORDS = ["gdp", "pmi", "ism", "retail sales", "industrial", "production", "tankan"]
+KEYWORDS = INFLATION_KEYWORDS + LABOR_KEYWORDS + RATES_KEYWORDS + GROWTH_KEYWORDS
+
+# 高いほど通貨が弱い指標（"unemployment" と "rate" を両方含む、または jobless / claims）
+INVERSE_PATTERN = r"(?=.*unemployment)(?=.*rate)|jobless|claims"
+
+# 国名（TradingEconomicsの Country、小文字）→ 通貨
+COUNTRY_PATTERNS = {
+    "USD": r"united states|u\.s\.|^us$",
+    "JPY": r"japan|^jp$",
+    "EUR": r"euro area|euro zone|eurozone|european union|germany|france|italy|spain|^eu$|^ea$",
+    "GBP": r"united kingdom|britain|^uk$|^gb$",
+    "AUD": r"australia|^au$",
+    "NZD": r"new zealand|^nz$",
+    "CAD": r"canada|^ca$",
+    "CHF": r"switzerland|^ch$",
+}
+
+
+def _alternation(words: Iterable[str]) -> str:
+    # 長い語を先に置く（部分一致の判定には影響しないが、一致箇所を最長にする）
+    return "|".join(re.escape(w) for w in sorted(set(words), key=len, reverse=True))
+
+
+class DirectionClassifier:
+    """通貨ペア（base/quote）の方向符号の分類器"""
+
+    def __init__(self, base: str, quote: str, default: float = 1.0):
+        self.base = base.upper()
+        self.quote = quote.upper()
+        self.default = float(default)
+        self._keywords = re.compile(_alternation(KEYWORDS))
+        self._inverse = re.compile(INVERSE_PATTERN)
+        self._base_country = re.compile(COUNTRY_PATTERNS[self.base]) if self.base in COUNTRY_PATTERNS else None
+        self._quote_country = re.compile(COUNTRY_PATTERNS[self.quote]) if self.quote in COUNTRY_PATTERNS else None
+        self._table: Dict[Tuple[str, str], float] = {}
+
+    def __repr__(self):
+        return f"DirectionClassifier({self.base!r}, {self.quote!r})"
+
+    def _side(self, country: str) -> Optional[float]:
+        """基軸通貨の国なら +1、決済通貨の国なら -1、どちらでもなければ None"""
+        if self._base_country is not None and self._base_country.search(country):
+            return 1.0
+        if self._quote_country is not None and self._quote_country.search(country):
+            return -1.0
+        return None
+
+    def _classify(self, event: str, country: str) -> float:
+        side = self._side(country)
+        if self._inverse.search(event):
+            return -(side if side is not None else self.default)
+        if side is not None and self._keywords.search(event):
+            return side
+        return self.default
+
+    def sign(self, event: Optional[str], country: Optional[str]) -> float:
+        """1件の方向符号"""
+        key = ((event or "").lower(), (country or "").lower())
+        v = self._table.get(key)
+        if v is None:
+            v = self._table[key] = self._classify(*key)
+        return v
+
+    def signs(self, events: Iterable, countries: Iterable) -> np.ndarray:
+        """
+        列全体の方向符号（ユニークな (指標名, 国) だけを判定する）
+
+        Returns:
+            float64 の配列（入力と同じ長さ・順序）
+        """
+        ev_codes, ev_uniques = pd.factorize(pd.Series(events, dtype=object).fillna(""))
+        co_codes, co_uniques = pd.factorize(pd.Series(countries, dtype=object).fillna(""))
+        if len(ev_codes) != len(co_codes):
+            raise ValueError(f"events and countries differ in length: {len(ev_codes)} != {len(co_codes)}")
+        if len(ev_codes) == 0:
+            return np.empty(0, dtype="float64")
+        pair_codes, inverse = np.unique(ev_codes.astype("int64") * len(co_uniques) + co_codes, return_inverse=True)
+        table = np.array([self.sign(str(ev_uniques[i // len(co_uniques)]), str(co_uniques[i % len(co_uniques)]))
+                          for i in pair_codes], dtype="float64")
+        return table[inverse]
+
+
+@lru_cache(maxsize=None)
+def direction_classifier(base: str, quote: str) -> DirectionClassifier:
+    """ペアごとの分類器（同じペアには同じインスタンスを返す）"""
+    return DirectionClassifier(base, quote)
+
+
+def pair_classifier(pair: str) -> DirectionClassifier:
+    """"USDJPY" のようなペア名から分類器を返す"""
+    pair = pair.upper().replace("/", "").replace("_", "")
+    if len(pair) != 6:
+        raise ValueError(f"pair must be 6 letters like USDJPY: {pair}")
+    return direction_classifier(pair[:3], pair[3:])
@@ -0,0 +1,376 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+イベントストア（data/events/events.sqlite）
+
+イベントは id を主キー、(category, ts) と ts にインデックスを持つSQLite（WAL）に追記する。
+同じ id は新しい値で上書きし、内容が同じなら書き込まない（何度取り込んでも結果は同じ）。
+書き込みは BEGIN IMMEDIATE で直列化するので、マクロ/RSSの取得ジョブを同時に動かしても互いの行を失わない。
+書き込み量は新しいイベントの数だけに比例する（旧形式の events_cache.parquet のように全件を書き直さない）。
+
+旧形式の parquet のパスを渡された場合は同じディレクトリの events.sqlite を使い、
+parquet の中身を初回に1回だけ取り込む。
+
+行の追加・更新はトリガーで changes テーブルに (通し番号, 影響する最も古いイベント時刻) として記録する。
+特徴量の増分計算は前回の通し番号以降の変更を見て、遅れて届いた・更新されたイベントの分を計算し直す。
+使い終わった変更は prune_changes で消す（消した通し番号より前からの変更は追えないので全件計算し直す）。
+"""
+
+import json
+import math
+import sqlite3
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Iterable, List, Optional, Union
+
+import numpy as np
+import pandas as pd
+
+DEFAULT_DB = "data/events/events.sqlite"
+DB_NAME = "events.sqlite"
+
+# 列として持つ項目（それ以外は extra にJSONで入れる）
+# surprise（実績 - 予想、方向の符号を付ける前）と country/event から、通貨ペアごとの方向付きセンチメントを求める
+CORE_COLUMNS = ["id", "ts", "source", "category", "importance", "weight",
+                "sentiment", "sentiment_w", "surprise", "country", "event", "url"]
+_VALUE_COLUMNS = CORE_COLUMNS[1:] + ["extra"]
+# upsert が更新する全件数（meta）
+_ROWS_KEY = "rows"
+# prune_changes で消した最後の通し番号（meta）
+_CHANGES_FLOOR_KEY = "changes_floor"
+
+TimeLike = Union[str, pd.Timestamp, datetime, None]
+
+
+def _ts_ns(t: TimeLike) -> Optional[int]:
+    if t is None:
+        return None
+    t = pd.Timestamp(t)
+    t = t.tz_localize("UTC") if t.tzinfo is None else t.tz_convert("UTC")
+    return int(t.value)
+
+
+def _plain(v):
+    """SQLite/JSONに入れられる値にする（NaN/NaT→None、numpyのスカラー→Python）"""
+    if v is None:
+        return None
+    if isinstance(v, np.generic):
+        v = v.item()
+    if isinstance(v, float) and math.isnan(v):
+        return None
+    if isinstance(v, pd.Timestamp):
+        return None if pd.isna(v) else v.isoformat()
+    if v is pd.NaT:
+        return None
+    return v
+
+
+class EventsStore:
+    """イベントの保存先（SQLite）"""
+
+    def __init__(self, path: Union[str, Path] = DEFAULT_DB, legacy_parquet: Optional[Union[str, Path]] = None):
+        """
+        Args:
+            legacy_parquet: 旧形式の events_cache.parquet（あれば初回に取り込む）
+        """
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        with self._connect() as conn:
+            conn.executescript("""
+                CREATE TABLE IF NOT EXISTS events (
+                    id TEXT PRIMARY KEY,
+                    ts INTEGER NOT NULL,
+                    source TEXT,
+                    category TEXT,
+                    importance INTEGER,
+                    weight REAL,
+                    sentiment REAL,
+                    sentiment_w REAL,
+                    surprise REAL,
+                    country TEXT,
+                    event TEXT,
+                    url TEXT,
+                    extra TEXT
+                );
+                CREATE INDEX IF NOT EXISTS events_category_ts ON events (category, ts);
+                CREATE INDEX IF NOT EXISTS events_ts ON events (ts);
+                CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT);
+                CREATE TABLE IF NOT EXISTS changes (seq INTEGER PRIMARY KEY AUTOINCREMENT, ts INTEGER NOT NULL);
+                CREATE TRIGGER IF NOT EXISTS events_inserted AFTER INSERT ON events BEGIN
+                    INSERT INTO changes (ts) VALUES (NEW.ts);
+                END;
+                -- 時刻が変わった更新は古い方の時刻も影響を受ける
+                CREATE TRIGGER IF NOT EXISTS events_updated AFTER UPDATE ON events BEGIN
+                    INSERT INTO changes (ts) VALUES (MIN(OLD.ts, NEW.ts));
+                END;
+                CREATE TRIGGER IF NOT EXISTS events_deleted AFTER DELETE ON events BEGIN
+                    INSERT INTO changes (ts) VALUES (OLD.ts);
+                END;
+                -- upsert が meta に持つ全件数を、upsert 以外で消された行の分だけ減らす
+                CREATE TRIGGER IF NOT EXISTS events_deleted_rows AFTER DELETE ON events BEGIN
+                    UPDATE meta SET value = CAST(value AS INTEGER) - 1 WHERE key = 'rows';
+                END;
+            """)
+            self._add_surprise_column(conn)
+        if legacy_parquet is not None:
+            self.migrate_parquet(legacy_parquet)
+
+    @staticmethod
+    def _add_surprise_column(conn: sqlite3.Connection):
+        """surprise 列が無い頃のストアに列を足し、extra に入っていた値を移す"""
+        if "surprise" in {r[1] for r in conn.execute("PRAGMA table_info(events)")}:
+            return
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            # 待っている間に別のプロセスが足していれば何もしない
+            if "surprise" not in {r[1] for r in conn.execute("PRAGMA table_info(events)")}:
+                conn.execute("ALTER TABLE events ADD COLUMN surprise REAL")
+                conn.execute("""
+                    UPDATE events
+                    SET surprise = json_extract(extra, '$.surprise'),
+                        extra = NULLIF(json_remove(extra, '$.surprise'), '{}')
+                    WHERE json_type(extra, '$.surprise') IS NOT NULL
+                """)
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+    @classmethod
+    def from_path(cls, path: Optional[Union[str, Path]] = None) -> "EventsStore":
+        """
+        --events-cache の値からストアを開く
+        - None: data/events/events.sqlite
+        - *.sqlite / *.db: そのファイル
+        - それ以外（旧形式の parquet）: 同じディレクトリの events.sqlite（parquet は初回に取り込む）
+        """
+        if path is None:
+            return cls(DEFAULT_DB)
+        path = Path(path)
+        if path.suffix in (".sqlite", ".db"):
+            return cls(path)
+        return cls(path.parent / DB_NAME, legacy_parquet=path)
+
+    def __repr__(self):
+        return f"EventsStore({str(self.path)!r})"
+
+    @contextmanager
+    def _connect(self):
+        # 呼び出しごとに接続する（プロセス・スレッドをまたいで共有しない）
+        conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+        try:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            yield conn
+        finally:
+            conn.close()
+
+    # --- 書き込み ---
+
+    @staticmethod
+    def _rows(events: Union[pd.DataFrame, Iterable[dict]]) -> List[tuple]:
+        records = events.to_dict("records") if isinstance(events, pd.DataFrame) else list(events)
+        rows = []
+        for rec in records:
+            try:
+                ts = _ts_ns(rec.get("ts"))
+            except (ValueError, TypeError):
+                ts = None
+            if ts is None or rec.get("id") is None:
+                continue
+            extra = {k: _plain(v) for k, v in rec.items() if k not in CORE_COLUMNS}
+            extra = {k: v for k, v in extra.items() if v is not None}
+            rows.append((
+                str(rec["id"]), ts,
+                *(_plain(rec.get(c)) for c in CORE_COLUMNS[2:]),
+                json.dumps(extra, ensure_ascii=False, sort_keys=True, default=str) if extra else None,
+            ))
+        return rows
+
+    def upsert(self, events: Union[pd.DataFrame, Iterable[dict]], keep_ts: bool = False) -> dict:
+        """
+        イベントを追加・更新する（同じ id は上書き、内容が同じなら何もしない）
+
+        Args:
+            keep_ts: 既にある id の ts は書き換えない（時刻の無い項目に取得時刻を入れる場合に、初めて見た時刻を残す）
+
+        Returns:
+            {"inserted", "updated", "rows"}（rows は書き込み後の全件数）
+        """
+        rows = self._rows(events)
+        skipped = (len(events) if isinstance(events, pd.DataFrame) else None)
+        if skipped is not None and skipped - len(rows) > 0:
+            print(f"[WARN] skipped {skipped - len(rows)} events without id or ts")
+        if not rows:
+            # 書き込むものが無ければロックも取らない
+            with self._connect() as conn:
+                return {"inserted": 0, "updated": 0, "rows": self._row_count(conn)}
+        cols = ", ".join(CORE_COLUMNS + ["extra"])
+        placeholders = ", ".join("?" * (len(CORE_COLUMNS) + 1))
+        value_columns = [c for c in _VALUE_COLUMNS if not (keep_ts and c == "ts")]
+        updates = ", ".join(f"{c} = excluded.{c}" for c in value_columns)
+        changed = " OR ".join(f"{c} IS NOT excluded.{c}" for c in value_columns)
+        sql = (f"INSERT INTO events ({cols}) VALUES ({placeholders}) "
+               f"ON CONFLICT(id) DO UPDATE SET {updates} WHERE {changed}")
+
+        with self._connect() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                # 追加された行は直前の最大の rowid より後ろに入る（更新では rowid は変わらない）
+                max_rowid = conn.execute("SELECT COALESCE(MAX(rowid), 0) FROM events").fetchone()[0]
+                before = self._row_count(conn)
+                # rowcount はトリガーによる changes への書き込みを含まない
+                written = conn.executemany(sql, rows).rowcount
+                inserted = conn.execute("SELECT COUNT(*) FROM events WHERE rowid > ?", (max_rowid,)).fetchone()[0]
+                conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)",
+                             (_ROWS_KEY, str(before + inserted)))
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+        return {"inserted": inserted, "updated": written - inserted, "rows": before + inserted}
+
+    @staticmethod
+    def _row_count(conn: sqlite3.Connection) -> int:
+        """全件数（meta に持っておき、無い場合だけ数える）"""
+        row = conn.execute("SELECT value FROM meta WHERE key = ?", (_ROWS_KEY,)).fetchone()
+        if row is not None:
+            return int(row[0])
+        return conn.execute("SELECT COUNT(*) FROM events").fetchone()[0]
+
+    def migrate_parquet(self, path: Union[str, Path]) -> int:
+        """旧形式の parquet を取り込む（取り込み済みのファイルは飛ばす）。取り込んだ件数を返す"""
+        path = Path(path)
+        if not path.exists():
+            return 0
+        key = f"migrated:{path.resolve()}"
+        with self._connect() as conn:
+            if conn.execute("SELECT 1 FROM meta WHERE key = ?", (key,)).fetchone():
+                return 0
+        try:
+            df = pd.read_parquet(path)
+        except Exception as e:
+            print(f"[WARN] could not read legacy events cache {path}: {e}")
+            return 0
+        res = self.upsert(df)
+        self.set_meta(key, datetime.now(timezone.utc).isoformat(timespec="seconds"))
+        print(f"[INFO] migrated {path} into {self.path} (inserted={res['inserted']})")
+        return res["inserted"]
+
+    # --- メタ情報（取得ジョブの状態など） ---
+
+    def get_meta(self, key: str) -> Optional[str]:
+        with self._connect() as conn:
+            row = conn.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return None if row is None else row[0]
+
+    def set_meta(self, key: str, value: str):
+        with self._connect() as conn:
+            conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", (key, value))
+
+    # --- 変更の記録 ---
+
+    def change_seq(self) -> int:
+        """最後の変更の通し番号（変更が無ければ0。changes を消しても戻らない）"""
+        with self._connect() as conn:
+            row = conn.execute("SELECT seq FROM sqlite_sequence WHERE name = 'changes'").fetchone()
+        return 0 if row is None else row[0]
+
+    def changes_floor(self) -> int:
+        """消した変更の最後の通し番号（これより前の通し番号からの変更は changed_since で追えない）"""
+        value = self.get_meta(_CHANGES_FLOOR_KEY)
+        return 0 if value is None else int(value)
+
+    def prune_changes(self, upto: int) -> int:
+        """通し番号 upto 以前の変更の記録を消す（消した件数）"""
+        with self._connect() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                row = conn.execute("SELECT value FROM meta WHERE key = ?", (_CHANGES_FLOOR_KEY,)).fetchone()
+                if row is not None and int(row[0]) >= upto:
+                    conn.execute("COMMIT")
+                    return 0
+                pruned = conn.execute("DELETE FROM changes WHERE seq <= ?", (upto,)).rowcount
+                conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)",
+                             (_CHANGES_FLOOR_KEY, str(upto)))
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+        return pruned
+
+    def changed_since(self, seq: int, upto: Optional[int] = None) -> Optional[pd.Timestamp]:
+        """
+        通し番号 seq より後（upto 以下）の変更が影響する最も古いイベント時刻（変更が無ければ None）
+        seq が changes_floor() より前なら消した変更が含まれないので、呼び出し側で全件計算し直す
+        """
+        sql, params = "SELECT MIN(ts) FROM changes WHERE seq > ?", [seq]
+        if upto is not None:
+            sql += " AND seq <= ?"
+            params.append(upto)
+        with self._connect() as conn:
+            v = conn.execute(sql, params).fetchone()[0]
+        return None if v is None else pd.Timestamp(v, tz="UTC")
+
+    # --- 読み出し ---
+
+    def range(self, start: TimeLike = None, end: TimeLike = None,
+              categories: Optional[List[str]] = None,
+              columns: Optional[List[str]] = None) -> pd.DataFrame:
+        """
+        start <= ts <= end のイベント（ts昇順、ts列はUTC）
+
+        Args:
+            categories: 絞り込むカテゴリ（インデックス (category, ts) を使う）
+            columns: 返す列（None なら extra の項目も展開して全て）
+        """
+        where, params = [], []
+        if categories is not None:
+            where.append(f"category IN ({', '.join('?' * len(categories))})")
+            params += list(categories)
+        if start is not None:
+            where.append("ts >= ?")
+            params.append(_ts_ns(start))
+        if end is not None:
+            where.append("ts <= ?")
+            params.append(_ts_ns(end))
+
+        want = None if columns is None else ["id", "ts"] + [c for c in columns if c not in ("id", "ts")]
+        core = CORE_COLUMNS if want is None else [c for c in want if c in CORE_COLUMNS]
+        need_extra = want is None or any(c not in CORE_COLUMNS for c in want)
+        select = core + (["extra"] if need_extra else [])
+
+        sql = f"SELECT {', '.join(select)} FROM events"
+        if where:
+            sql += " WHERE " + " AND ".join(where)
+        sql += " ORDER BY ts, id"
+        with self._connect() as conn:
+            rows = conn.execute(sql, params).fetchall()
+
+        df = pd.DataFrame.from_records(rows, columns=select)
+        if need_extra:
+            extra = pd.DataFrame([json.loads(x) if x else {} for x in df.pop("extra")], index=df.index)
+            if want is not None:
+                extra = extra[[c for c in want if c in extra.columns]]
+            df = pd.concat([df, extra], axis=1)
+        df["ts"] = pd.to_datetime(df["ts"].astype("int64"), utc=True)
+        for c in ("weight", "sentiment", "sentiment_w", "surprise"):
+            if c in df.columns:
+                df[c] = pd.to_numeric(df[c], errors="coerce")
+        return df
+
+    def count(self, category: Optional[str] = None) -> int:
+        with self._connect() as conn:
+            if category is None:
+                return conn.execute("SELECT COUNT(*) FROM events").fetchone()[0]
+            return conn.execute("SELECT COUNT(*) FROM events WHERE category = ?", (category,)).fetchone()[0]
+
+    def last_ts(self, category: Optional[str] = None) -> Optional[pd.Timestamp]:
+        with self._connect() as conn:
+            if category is None:
+                v = conn.execute("SELECT MAX(ts) FROM events").fetchone()[0]
+            else:
+                v = conn.execute("SELECT MAX(ts) FROM events WHERE category = ?", (category,)).fetchone()[0]
+        return None if v is None else pd.Timestamp(v, tz="UTC")
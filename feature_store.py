@@ -0,0 +1,310 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+特徴量ストア（data/features/<PAIR>/tf=<TF>/month=YYYY-MM/part-000.parquet）
+
+月ごとのパーティションに ts でソートして書き、行グループの統計（min/max）を持たせる。
+読み出し側は latest(n) / range(start, end, columns=...) で必要な行グループと列だけを読む。
+旧形式の単一ファイル（<TF>_features.parquet）しか無い場合はそれを読む。
+
+全期間の書き直し（write）は隣の一時ディレクトリに書いてからディレクトリごと入れ替える。
+読み出し側は入れ替えと重なったら（一覧を取った後にファイルが消えた・入れ替えの途中で空に見えた）読み直す。
+"""
+
+import os
+import shutil
+import tempfile
+import time
+from pathlib import Path
+from typing import List, Optional, Union
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+
+from hot_cache import file_signature
+
+DEFAULT_ROOT = "data/features"
+PART_NAME = "part-000.parquet"
+
+# 行グループの大きさ（M5で約1週間分）。小さいほど latest/range の読み込みが細かくなる
+ROW_GROUP_SIZE = 2048
+# write の入れ替えと重なった読み出しをやり直す回数と間隔（秒）
+SWAP_RETRIES = 50
+SWAP_RETRY_SEC = 0.01
+
+TimeLike = Union[str, pd.Timestamp, None]
+
+
+def _utc(t: TimeLike) -> Optional[pd.Timestamp]:
+    if t is None:
+        return None
+    t = pd.Timestamp(t)
+    return t.tz_localize("UTC") if t.tzinfo is None else t.tz_convert("UTC")
+
+
+def _month_key(t: pd.Timestamp) -> str:
+    return f"{t.year:04d}-{t.month:02d}"
+
+
+class FeatureStore:
+    """1通貨ペア・1時間足分の特徴量"""
+
+    def __init__(self, pair: str, tf: str, root: Union[str, Path] = DEFAULT_ROOT):
+        self.pair = pair.upper()
+        self.tf = tf.upper()
+        self.root = Path(root)
+        self.path = self.root / self.pair / f"tf={self.tf}"
+        self.legacy_path = self.root / self.pair / f"{self.tf}_features.parquet"
+
+    @classmethod
+    def from_path(cls, path: Union[str, Path]) -> Optional["FeatureStore"]:
+        """
+        パスからストアを求める
+        - data/features/<PAIR>/tf=<TF>
+        - data/features/<PAIR>/<TF>_features.parquet（旧形式。パーティションがあればそちらを読む）
+        どちらでもなければ None
+        """
+        path = Path(path)
+        if path.name.startswith("tf="):
+            return cls(path.parent.name, path.name[len("tf="):], root=path.parent.parent)
+        if path.name.endswith("_features.parquet"):
+            return cls(path.parent.name, path.name[:-len("_features.parquet")], root=path.parent.parent)
+        return None
+
+    def __repr__(self):
+        return f"FeatureStore({self.pair!r}, {self.tf!r}, root={str(self.root)!r})"
+
+    # --- 状態 ---
+
+    def partitions(self) -> List[Path]:
+        """月パーティションのファイル（古い順。write の入れ替えの途中なら入れ替わるまで待つ）"""
+        for _ in range(SWAP_RETRIES):
+            files = sorted(self.path.glob(f"month=*/{PART_NAME}"))
+            if files or not self._swapping():
+                return files
+            time.sleep(SWAP_RETRY_SEC)
+        return files
+
+    def _swapping(self) -> bool:
+        """write が古いディレクトリを退かしている最中か"""
+        return any(self.path.parent.glob(f".{self.path.name}.*.old"))
+
+    def _retry_swap(self, read):
+        """一覧を取った後に write の入れ替えでファイルが消えていたら、一覧から取り直す"""
+        for attempt in range(SWAP_RETRIES):
+            try:
+                return read()
+            except FileNotFoundError:
+                if attempt == SWAP_RETRIES - 1:
+                    raise
+                time.sleep(SWAP_RETRY_SEC)
+
+    def exists(self) -> bool:
+        return bool(self.partitions()) or self.legacy_path.exists()
+
+    def columns(self) -> List[str]:
+        files = self.partitions()
+        if files:
+            return pq.read_schema(files[-1]).names
+        if self.legacy_path.exists():
+            return pq.read_schema(self.legacy_path).names
+        return []
+
+    def num_rows(self) -> int:
+        """行数（フッタのメタデータのみ読む）"""
+        files = self.partitions() or ([self.legacy_path] if self.legacy_path.exists() else [])
+        return sum(pq.ParquetFile(f).metadata.num_rows for f in files)
+
+    def mtime(self) -> Optional[float]:
+        """最後に書き込まれた時刻（UNIX秒）"""
+        files = self.partitions() or ([self.legacy_path] if self.legacy_path.exists() else [])
+        return max((f.stat().st_mtime for f in files), default=None)
+
+    def signature(self) -> tuple:
+        """ファイル群の (名前, mtime_ns, サイズ)。キャッシュの更新判定に使う"""
+        files = self.partitions() or [self.legacy_path]
+        return file_signature(files)
+
+    def last_ts(self) -> Optional[pd.Timestamp]:
+        df = self.latest(1, columns=["ts"])
+        return None if df.empty else df["ts"].iloc[-1]
+
+    # --- 読み出し ---
+
+    def _files_between(self, start: Optional[pd.Timestamp], end: Optional[pd.Timestamp]) -> List[Path]:
+        """パーティション名で月を絞り込む"""
+        lo = _month_key(start) if start is not None else None
+        hi = _month_key(end) if end is not None else None
+        out = []
+        for f in self.partitions():
+            month = f.parent.name.replace("month=", "")
+            if (lo and month < lo) or (hi and month > hi):
+                continue
+            out.append(f)
+        return out
+
+    @staticmethod
+    def _with_ts(columns: Optional[List[str]]) -> Optional[List[str]]:
+        if columns is None:
+            return None
+        return ["ts"] + [c for c in columns if c != "ts"]
+
+    def range(self, start: TimeLike = None, end: TimeLike = None,
+              columns: Optional[List[str]] = None) -> pd.DataFrame:
+        """
+        start <= ts <= end の行を返す（ts列付き、昇順）
+
+        月パーティションの絞り込み、行グループ統計による述語プッシュダウン、
+        columns による列の射影で、必要な部分だけを読む
+        """
+        start, end = _utc(start), _utc(end)
+        columns = self._with_ts(columns)
+        return self._retry_swap(lambda: self._read_range(start, end, columns))
+
+    def _read_range(self, start: Optional[pd.Timestamp], end: Optional[pd.Timestamp],
+                    columns: Optional[List[str]]) -> pd.DataFrame:
+        cond = None
+        if start is not None:
+            cond = ds.field("ts") >= pa.scalar(start, type=pa.timestamp("ns", tz="UTC"))
+        if end is not None:
+            upper = ds.field("ts") <= pa.scalar(end, type=pa.timestamp("ns", tz="UTC"))
+            cond = upper if cond is None else cond & upper
+
+        files = self._files_between(start, end)
+        if files:
+            dataset = ds.dataset([str(f) for f in files], format="parquet")
+        elif not self.partitions() and self.legacy_path.exists():
+            dataset = ds.dataset(str(self.legacy_path), format="parquet")
+        else:
+            return pd.DataFrame(columns=columns or [])
+
+        if columns is not None:
+            columns = [c for c in columns if c in dataset.schema.names]
+        df = dataset.to_table(columns=columns, filter=cond).to_pandas()
+        return self._finish(df)
+
+    def latest(self, n: int = 1, columns: Optional[List[str]] = None) -> pd.DataFrame:
+        """
+        最新 n 行を返す（ts列付き、昇順）
+
+        新しい月から末尾の行グループを必要な分だけ読む
+        """
+        columns = self._with_ts(columns)
+        return self._retry_swap(lambda: self._read_latest(n, columns))
+
+    def _read_latest(self, n: int, columns: Optional[List[str]]) -> pd.DataFrame:
+        files = self.partitions()
+        if not files and self.legacy_path.exists():
+            files = [self.legacy_path]
+
+        tables = []
+        remaining = n
+        for f in reversed(files):
+            pf = pq.ParquetFile(f)
+            cols = None if columns is None else [c for c in columns if c in pf.schema_arrow.names]
+            for rg in reversed(range(pf.num_row_groups)):
+                table = pf.read_row_group(rg, columns=cols)
+                tables.append(table)
+                remaining -= table.num_rows
+                if remaining <= 0:
+                    break
+            if remaining <= 0:
+                break
+
+        if not tables:
+            return pd.DataFrame(columns=columns or [])
+        df = pa.concat_tables(list(reversed(tables))).to_pandas()
+        return self._finish(df).tail(n).reset_index(drop=True)
+
+    def read(self, columns: Optional[List[str]] = None) -> pd.DataFrame:
+        """全期間（学習用）"""
+        return self.range(columns=columns)
+
+    @staticmethod
+    def _finish(df: pd.DataFrame) -> pd.DataFrame:
+        if "ts" in df.columns:
+            df["ts"] = pd.to_datetime(df["ts"], utc=True)
+            df = df.sort_values("ts", kind="stable")
+        return df.reset_index(drop=True)
+
+    # --- 書き込み ---
+
+    @staticmethod
+    def _normalize(feat: pd.DataFrame) -> pd.DataFrame:
+        """ts列（UTC）を持つ昇順のDataFrameにする"""
+        df = feat.reset_index() if "ts" not in feat.columns else feat.copy()
+        df["ts"] = pd.to_datetime(df["ts"], utc=True, errors="coerce")
+        df = df.dropna(subset=["ts"])
+        return df.sort_values("ts", kind="stable").drop_duplicates("ts", keep="last").reset_index(drop=True)
+
+    def _write_month(self, month: str, df: pd.DataFrame, base: Optional[Path] = None):
+        """一時ファイルに書いてから置き換える（読み出し中のプロセスに途中のファイルを見せない）"""
+        part_dir = (base or self.path) / f"month={month}"
+        part_dir.mkdir(parents=True, exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=part_dir, prefix=PART_NAME, suffix=".tmp")
+        os.close(fd)
+        try:
+            table = pa.Table.from_pandas(df, preserve_index=False)
+            pq.write_table(table, tmp, row_group_size=ROW_GROUP_SIZE,
+                           write_statistics=True, compression="snappy")
+            os.replace(tmp, part_dir / PART_NAME)
+        finally:
+            Path(tmp).unlink(missing_ok=True)
+
+    def _write_months(self, df: pd.DataFrame, base: Optional[Path] = None) -> int:
+        months = df["ts"].dt.strftime("%Y-%m")
+        for month, part in df.groupby(months, sort=True):
+            self._write_month(month, part.reset_index(drop=True), base)
+        return months.nunique()
+
+    def write(self, feat: pd.DataFrame) -> int:
+        """
+        全期間を書き直す。書いた月の数を返す
+
+        隣の一時ディレクトリに全ての月を書いてから入れ替える
+        （読み出し中のプロセスに空のストアや書きかけの月の組を見せない）
+        """
+        df = self._normalize(feat)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = Path(tempfile.mkdtemp(dir=self.path.parent, prefix=f".{self.path.name}.", suffix=".tmp"))
+        old = None
+        try:
+            months = self._write_months(df, tmp)
+            if self.path.exists():
+                # 空でないディレクトリは os.replace で上書きできないので、古い方を退かしてから入れる
+                old = Path(tempfile.mkdtemp(dir=self.path.parent, prefix=f".{self.path.name}.", suffix=".old"))
+                os.replace(self.path, old / self.path.name)
+            try:
+                os.replace(tmp, self.path)
+            except OSError:
+                if old is not None:
+                    os.replace(old / self.path.name, self.path)
+                raise
+        finally:
+            shutil.rmtree(tmp, ignore_errors=True)
+            if old is not None:
+                shutil.rmtree(old, ignore_errors=True)
+        return months
+
+    def append(self, feat: pd.DataFrame) -> int:
+        """
+        行を追加する（同じtsは新しい値で上書き）
+        影響する月のパーティションだけを読み直して書き直す
+        """
+        df = self._normalize(feat)
+        if df.empty:
+            return 0
+        if not self.partitions() and self.legacy_path.exists():
+            # 旧形式から移行してから追加する
+            self.write(pd.read_parquet(self.legacy_path))
+
+        months = sorted(df["ts"].dt.strftime("%Y-%m").unique())
+        merged = [df]
+        for month in months:
+            f = self.path / f"month={month}" / PART_NAME
+            if f.exists():
+                merged.insert(0, pd.read_parquet(f))
+        return self._write_months(self._normalize(pd.concat(merged, ignore_index=True)))
@@ -7,12 +7,41 @@ FX分析特化型AIエージェント（高精度分析モデル）
 """
 
 import os
-import pickle
+import threading
 from pathlib import Path
 from typing import Optional, Dict, List, Tuple
 import pandas as pd
 import numpy as np
 
+import model_bundle
+from feature_store import FeatureStore
+from hot_cache import HotCache, file_signature
+from model_adapter import ModelAdapter
+
+# 分析に使う直近のバー数（分位点などの参照期間）
+ANALYSIS_LOOKBACK_BARS = 5000
+
+# モデルのバンドル（model_bundle。旧形式の models/fx_usdjpy_model.pkl しか無ければそれを読む）
+DEFAULT_MODEL_PATH = "models/fx_usdjpy_model"
+
+# build_features が書く vol_20 の分位点の列（直近 5000 本の rolling quantile）
+VOL_QUANTILE_COLUMNS = {0.8: "vol_20_p80", 0.95: "vol_20_p95"}
+
+# モデルと特徴量の末尾を保持するプロセス内キャッシュ（ファイル更新の確認はこの秒数に1回）
+_CACHE = HotCache(check_interval=float(os.getenv("FX_CACHE_CHECK_SEC", "1.0")))
+
+# 推論の内訳（プロセス内の累計）
+# model: モデルで判定 / rules: モデル無しでルール / fallbacks: モデルの推論に失敗してルール
+_INFERENCE_STATS = {"model": 0, "rules": 0, "fallbacks": 0, "last_error": None}
+_INFERENCE_LOCK = threading.Lock()
+
+
+def _count_inference(key: str, error: Optional[Exception] = None):
+    with _INFERENCE_LOCK:
+        _INFERENCE_STATS[key] += 1
+        if error is not None:
+            _INFERENCE_STATS["last_error"] = f"{type(error).__name__}: {error}"
+
 try:
     import lightgbm as lgb
     LIGHTGBM_AVAILABLE = True
@@ -28,35 +57,49 @@ class FXAnalysisAgent:
     高精度な分析・予測を行う。将来的にサッカー分析などにも拡張可能。
     """
     
-    def __init__(self, model_path: Optional[str] = None):
+    def __init__(self, model_path: Optional[str] = None, feature_store: Optional[FeatureStore] = None):
         """
         Args:
-            model_path: 学習済みモデルのパス（.pkl）。Noneの場合は簡易ルールベース分析
+            model_path: 学習済みモデルのバンドル（または旧形式の .pkl）。Noneの場合は簡易ルールベース分析
+            feature_store: 推論に使う特徴量ストア（あればモデルの特徴量スキーマと照合する）
         """
         self.model = None
         self.model_path = model_path
         self.feature_columns = None
+        self.manifest = None
+        self.adapter: Optional[ModelAdapter] = None
         
-        if model_path and Path(model_path).exists():
-            self.load_model(model_path)
+        resolved = model_bundle.resolve(model_path) if model_path else None
+        if resolved is not None:
+            self.load_model(str(resolved), feature_store)
         elif model_path:
             print(f"[WARN] Model file not found: {model_path}. Using rule-based analysis.")
     
-    def load_model(self, model_path: str):
-        """学習済みモデルを読み込む"""
+    def load_model(self, model_path: str, feature_store: Optional[FeatureStore] = None):
+        """学習済みモデルを読み込む（バンドル、無ければ旧形式の .pkl）"""
         if not LIGHTGBM_AVAILABLE:
             print("[WARN] LightGBM not available. Cannot load model.")
             return
         
         try:
-            with open(model_path, 'rb') as f:
-                data = pickle.load(f)
-                self.model = data.get('model')
-                self.feature_columns = data.get('feature_columns')
-            print(f"[INFO] Model loaded from {model_path}")
+            if model_bundle.is_bundle(model_path):
+                types = model_bundle.store_types(feature_store) if feature_store is not None else None
+                model, self.manifest = model_bundle.load_bundle(model_path, types)
+                self.set_model(model, self.manifest.get('feature_columns'))
+            else:
+                data = model_bundle.load_legacy_pickle(model_path)
+                self.set_model(data.get('model'), data.get('feature_columns'))
+            print(f"[INFO] Model loaded from {model_path} ({self.adapter})")
         except Exception as e:
             print(f"[ERROR] Failed to load model: {e}")
             self.model = None
+            self.adapter = None
+    
+    def set_model(self, model, feature_columns: Optional[List[str]] = None):
+        """推論に使うモデルを設定する（lgb.Booster または predict_proba を持つモデル）"""
+        self.adapter = ModelAdapter(model, feature_columns) if model is not None else None
+        self.model = model
+        self.feature_columns = self.adapter.feature_columns if self.adapter is not None else None
     
     def analyze(self, features_df: pd.DataFrame, pair: str = "USDJPY") -> Dict:
         """
@@ -89,48 +132,131 @@ class FXAnalysisAgent:
         latest = features_df.iloc[-1].copy()
         
         # モデル推論（学習済みモデルがある場合）
-        if self.model is not None and LIGHTGBM_AVAILABLE:
+        if self.adapter is not None:
             return self._predict_with_model(latest, features_df)
         else:
             # ルールベース分析（高精度版）
+            _count_inference("rules")
             return self._analyze_with_rules(latest, features_df)
     
+    def analyze_batch(self, features_df: pd.DataFrame, pair: str = "USDJPY") -> pd.DataFrame:
+        """
+        全行をまとめて判定する（ダッシュボード・バックテスト用）
+        モデルがあれば全行の入力行列で1回だけ推論し、無ければルールを列単位で評価する。
+        リスクのボラティリティ閾値は各行の vol_20_p95（列が無ければ features_df 全体の分位点）。
+        
+        Args:
+            features_df: 特徴量DataFrame
+            pair: 通貨ペア
+        
+        Returns:
+            features_df と同じインデックスの DataFrame
+            （列: direction, confidence, risk_level, method="model" | "rules"）
+        """
+        if features_df.empty:
+            return pd.DataFrame({
+                "direction": pd.Series(dtype=object),
+                "confidence": pd.Series(dtype=np.float64),
+                "risk_level": pd.Series(dtype=object),
+                "method": pd.Series(dtype=object),
+            }, index=features_df.index)
+        
+        direction = confidence = None
+        method = "rules"
+        if self.adapter is not None:
+            try:
+                proba = self.adapter.predict_proba(features_df)
+                direction = np.array(["sell", "hold", "buy"], dtype=object)[proba.argmax(axis=1)]
+                confidence = proba.max(axis=1)
+                method = "model"
+                _count_inference("model")
+            except Exception as e:
+                print(f"[ERROR] Model prediction failed: {e}")
+                _count_inference("fallbacks", e)
+        else:
+            _count_inference("rules")
+        if direction is None:
+            direction, confidence = self._rule_directions(self._rule_scores(features_df))
+        
+        return pd.DataFrame({
+            "direction": direction,
+            "confidence": confidence,
+            "risk_level": self._risk_levels(features_df),
+            "method": method,
+        }, index=features_df.index)
+    
+    @staticmethod
+    def _column(features_df: pd.DataFrame, name: str, default) -> np.ndarray:
+        """列の値（列が無ければ default。default は配列でもよい）"""
+        if name in features_df.columns:
+            return features_df[name].to_numpy(dtype=np.float64, na_value=np.nan)
+        return np.broadcast_to(np.asarray(default, dtype=np.float64), (len(features_df),))
+    
+    def _rule_scores(self, features_df: pd.DataFrame) -> np.ndarray:
+        """ルールベースの方向スコア（_analyze_with_rules と同じ判定を全行に）"""
+        rsi = self._column(features_df, 'rsi_14', 50)
+        close = self._column(features_df, 'close', 0)
+        ma_20 = self._column(features_df, 'ma_20', close)
+        macro_sent_24h = self._column(features_df, 'macro_sent_24H', 0)
+        
+        score = np.zeros(len(features_df))
+        score += np.where(rsi < 30, 0.3, np.where(rsi > 70, -0.3, 0.0))
+        score += np.where(close > ma_20 * 1.01, 0.2, np.where(close < ma_20 * 0.99, -0.2, 0.0))
+        score += np.where(macro_sent_24h > 0.5, 0.25, np.where(macro_sent_24h < -0.5, -0.25, 0.0))
+        return score
+    
+    @staticmethod
+    def _rule_directions(score: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """方向スコアから方向と信頼度"""
+        direction = np.where(score > 0.3, "buy", np.where(score < -0.3, "sell", "hold")).astype(object)
+        confidence = np.where(np.abs(score) > 0.3, np.minimum(0.7 + np.abs(score) * 0.3, 0.95), 0.5)
+        return direction, confidence
+    
+    def _risk_levels(self, features_df: pd.DataFrame) -> np.ndarray:
+        """リスクレベル（_assess_risk と同じ判定を全行に）"""
+        vol = self._column(features_df, 'vol_20', 0)
+        spread = self._column(features_df, 'spread', 0)
+        spread_ma_60 = self._column(features_df, 'spread_ma_60', spread)
+        macro_cnt_24h = self._column(features_df, 'macro_cnt_24H', 0)
+        
+        high = spread > spread_ma_60 * 1.5
+        if VOL_QUANTILE_COLUMNS[0.95] in features_df.columns:
+            # 行ごとにその時点までの分位点と比べる（バックテストでも先の値を使わない）
+            high |= vol > self._column(features_df, VOL_QUANTILE_COLUMNS[0.95], np.nan)
+        elif len(features_df) > 20 and 'vol_20' in features_df.columns:
+            high |= vol > features_df['vol_20'].quantile(0.95)
+        return np.where(high, "high", np.where(macro_cnt_24h > 3, "medium", "low")).astype(object)
+    
     def _predict_with_model(self, latest: pd.Series, features_df: pd.DataFrame) -> Dict:
         """学習済みモデルで予測"""
         try:
-            # 特徴量を準備
-            if self.feature_columns:
-                X = latest[self.feature_columns].values.reshape(1, -1)
-            else:
-                # 数値特徴量のみ選択
-                numeric_cols = latest.select_dtypes(include=[np.number]).index.tolist()
-                X = latest[numeric_cols].fillna(0).values.reshape(1, -1)
-            
-            # 予測
-            pred_proba = self.model.predict_proba(X)[0]
-            pred_class = self.model.predict(X)[0]
-            
-            # クラス定義: 0=売り, 1=様子見, 2=買い
-            direction_map = {0: "sell", 1: "hold", 2: "buy"}
-            direction = direction_map.get(pred_class, "hold")
-            confidence = float(max(pred_proba))
-            
-            # 詳細分析を生成
-            analysis = self._generate_analysis(latest, features_df, direction, confidence)
-            key_factors = self._extract_key_factors(latest, direction)
-            risk_level = self._assess_risk(latest, features_df)
-            
-            return {
-                "direction": direction,
-                "confidence": confidence,
-                "prediction": self._format_prediction(direction, confidence, latest),
-                "analysis": analysis,
-                "key_factors": key_factors,
-                "risk_level": risk_level
-            }
+            # 予測（最新1行）
+            pred_proba = self.adapter.predict_proba(features_df.iloc[[-1]])[0]
         except Exception as e:
             print(f"[ERROR] Model prediction failed: {e}")
+            _count_inference("fallbacks", e)
             return self._analyze_with_rules(latest, features_df)
+        _count_inference("model")
+        pred_class = int(np.argmax(pred_proba))
+        
+        # クラス定義: 0=売り, 1=様子見, 2=買い
+        direction_map = {0: "sell", 1: "hold", 2: "buy"}
+        direction = direction_map.get(pred_class, "hold")
+        confidence = float(max(pred_proba))
+        
+        # 詳細分析を生成
+        analysis = self._generate_analysis(latest, features_df, direction, confidence)
+        key_factors = self._extract_key_factors(latest, direction)
+        risk_level = self._assess_risk(latest, features_df)
+        
+        return {
+            "direction": direction,
+            "confidence": confidence,
+            "prediction": self._format_prediction(direction, confidence, latest),
+            "analysis": analysis,
+            "key_factors": key_factors,
+            "risk_level": risk_level
+        }
     
     def _analyze_with_rules(self, latest: pd.Series, features_df: pd.DataFrame) -> Dict:
         """高精度ルールベース分析（モデル未学習時）"""
@@ -177,7 +303,8 @@ class FXAnalysisAgent:
             direction_score -= 0.25
         
         # ボラティリティ判断
-        if vol_20 > features_df['vol_20'].quantile(0.8) if len(features_df) > 20 else False:
+        vol_p80 = self._vol_threshold(latest, features_df, 0.8)
+        if vol_p80 is not None and vol_20 > vol_p80:
             signals.append("ボラティリティが高水準 → リスク増大")
         
         # 方向決定
@@ -258,16 +385,30 @@ class FXAnalysisAgent:
         
         return factors
     
+    @staticmethod
+    def _vol_threshold(latest: pd.Series, features_df: pd.DataFrame, q: float) -> Optional[float]:
+        """
+        vol_20 の分位点
+        特徴量に vol_20_p80 / vol_20_p95 の列があれば最新行の値を使い（O(1)）、
+        無ければ（列を追加する前の特徴量）features_df 全体から計算する
+        """
+        col = VOL_QUANTILE_COLUMNS[q]
+        if col in latest.index:
+            v = latest[col]
+            return None if pd.isna(v) else float(v)
+        if len(features_df) > 20 and 'vol_20' in features_df.columns:
+            return features_df['vol_20'].quantile(q)
+        return None
+    
     def _assess_risk(self, latest: pd.Series, features_df: pd.DataFrame) -> str:
         """リスクレベルを評価"""
         vol = latest.get('vol_20', 0)
         spread = latest.get('spread', 0)
         
         # ボラティリティが高い
-        if len(features_df) > 20:
-            vol_p95 = features_df['vol_20'].quantile(0.95)
-            if vol > vol_p95:
-                return "high"
+        vol_p95 = self._vol_threshold(latest, features_df, 0.95)
+        if vol_p95 is not None and vol > vol_p95:
+            return "high"
         
         # スプレッドが広い
         if spread > latest.get('spread_ma_60', spread) * 1.5:
@@ -301,13 +442,53 @@ MA(20): {latest.get('ma_20', 'N/A'):.2f}
 ニュース: {latest.get('news_cnt_24H', 0):.0f}件"""
 
 
-def create_fx_agent(model_path: Optional[str] = None) -> FXAnalysisAgent:
+def create_fx_agent(model_path: Optional[str] = None,
+                    feature_store: Optional[FeatureStore] = None) -> FXAnalysisAgent:
     """FX分析エージェントを作成"""
-    default_model_path = "models/fx_usdjpy_model.pkl"
     if model_path is None:
-        model_path = default_model_path if Path(default_model_path).exists() else None
+        model_path = DEFAULT_MODEL_PATH if model_bundle.resolve(DEFAULT_MODEL_PATH) else None
     
-    return FXAnalysisAgent(model_path=model_path)
+    return FXAnalysisAgent(model_path=model_path, feature_store=feature_store)
+
+
+def cached_fx_agent(model_path: Optional[str] = None,
+                    feature_store: Optional[FeatureStore] = None) -> FXAnalysisAgent:
+    """
+    プロセス内で使い回すFX分析エージェント
+    モデルファイルの更新（作成・再学習）を検知したら読み直す（特徴量スキーマの照合は読み込み時）
+    """
+    path = model_path or DEFAULT_MODEL_PATH
+    store_key = str(feature_store.path) if feature_store is not None else None
+    return _CACHE.get(
+        ("agent", path, store_key),
+        lambda: file_signature(model_bundle.artifact_files(path)),
+        lambda: create_fx_agent(model_path, feature_store),
+    )
+
+
+def cached_features(store: FeatureStore, n: int = ANALYSIS_LOOKBACK_BARS) -> pd.DataFrame:
+    """
+    特徴量ストアの末尾 n 行（プロセス内で共有するため変更しないこと）
+    パーティションの更新を検知したら読み直す
+    """
+    return _CACHE.get(
+        ("features", str(store.path), n),
+        store.signature,
+        lambda: store.latest(n),
+    )
+
+
+def cache_stats() -> Dict[str, int]:
+    return _CACHE.stats()
+
+
+def inference_stats() -> Dict:
+    """
+    推論の内訳（プロセス内の累計）
+    model が増えずに fallbacks / rules が増えていれば、学習済みモデルが使われていない
+    """
+    with _INFERENCE_LOCK:
+        return dict(_INFERENCE_STATS)
 
 
 def analyze_fx(user_text: str, pair: str = "USDJPY") -> str:
@@ -332,18 +513,13 @@ def analyze_fx(user_text: str, pair: str = "USDJPY") -> str:
         # __file__が定義されていない場合（例: インタラクティブシェル）
         project_root = Path.cwd()
     
-    # 特徴量ファイルのパス（H1またはM5を試す）
-    features_path_h1 = project_root / f"data/features/{pair_normalized}/H1_features.parquet"
-    features_path_m5 = project_root / f"data/features/{pair_normalized}/M5_features.parquet"
+    # 特徴量ストア（H1またはM5を試す）
+    store_h1 = FeatureStore(pair_normalized, "H1", root=project_root / "data/features")
+    store_m5 = FeatureStore(pair_normalized, "M5", root=project_root / "data/features")
     
     # H1を優先、なければM5を試す
-    if features_path_h1.exists():
-        features_path = features_path_h1
-    elif features_path_m5.exists():
-        features_path = features_path_m5
-    else:
-        features_path = features_path_h1  # エラーメッセージ用
-    if not features_path.exists():
+    store = store_h1 if store_h1.exists() else store_m5
+    if not store.exists():
         # データが無い場合、簡易的な分析を返す（デプロイ環境でのフォールバック）
         return f"""⚠️ {pair_normalized}の特徴量データが見つかりません。
 
@@ -360,12 +536,13 @@ def analyze_fx(user_text: str, pair: str = "USDJPY") -> str:
 データ更新後、「分析」または「予測」コマンドを再度お試しください。"""
     
     try:
-        features_df = pd.read_parquet(features_path)
+        # 末尾の行グループだけを読む（キャッシュ済みならI/O無し）
+        features_df = cached_features(store)
         if features_df.empty:
             return "⚠️ 特徴量データが空です。"
         
-        # エージェントを作成
-        agent = create_fx_agent()
+        # エージェント（モデル読み込み済み）を取得
+        agent = cached_fx_agent(feature_store=store)
         
         # 分析実行（正規化されたペア名を使用）
         result = agent.analyze(features_df, pair=pair_normalized)
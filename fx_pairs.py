@@ -0,0 +1,135 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+複数通貨ペアの一括実行
+
+各ジョブの --pairs（カンマ区切り、または "all"）を解釈し、ペアごとの処理をプールで実行して
+ペア別の所要時間をまとめたレポートを出す（data/logs/pair_runs.jsonl にも1行で追記する）。
+"""
+
+import json
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Callable, Dict, List, Optional
+
+# --pairs all で対象にするペア
+DEFAULT_PAIRS = [
+    "USDJPY", "EURUSD", "GBPUSD", "AUDUSD", "NZDUSD", "USDCAD", "USDCHF",
+    "EURJPY", "GBPJPY", "AUDJPY", "NZDJPY", "CADJPY", "CHFJPY",
+    "EURGBP", "EURAUD", "EURCHF", "EURCAD", "GBPAUD", "GBPCHF", "AUDNZD", "AUDCAD",
+]
+
+REPORT_LOG = Path("data/logs/pair_runs.jsonl")
+
+
+def parse_pairs(pair: Optional[str] = None, pairs: Optional[str] = None) -> List[str]:
+    """--pair / --pairs からペアの一覧を作る（重複は除き、指定順を保つ）"""
+    if pairs:
+        if pairs.strip().lower() == "all":
+            return list(DEFAULT_PAIRS)
+        names = [p.strip().upper() for p in pairs.split(",") if p.strip()]
+    elif pair:
+        names = [pair.strip().upper()]
+    else:
+        names = []
+    return list(dict.fromkeys(names))
+
+
+def bi5_price_scale(pair: str) -> int:
+    """Dukascopyのbi5の価格の倍率（円が決済通貨のペアは小数3桁、それ以外は5桁）"""
+    return 1000 if pair.upper().endswith("JPY") else 100000
+
+
+def _timed(fn: Callable[[str], dict], pair: str) -> dict:
+    t0 = time.perf_counter()
+    try:
+        result = dict(fn(pair) or {})
+        result.setdefault("ok", True)
+    except SystemExit as e:
+        result = {"ok": False, "error": e.code if isinstance(e.code, str) else f"exit code {e.code}"}
+    except Exception as e:
+        traceback.print_exc()
+        result = {"ok": False, "error": f"{type(e).__name__}: {e}"}
+    result["elapsed_sec"] = round(time.perf_counter() - t0, 3)
+    return result
+
+
+def run_per_pair(job: str, fn: Callable[[str], dict], pairs: List[str], workers: int = 1,
+                 processes: bool = True, initializer: Optional[Callable] = None, initargs: tuple = ()) -> dict:
+    """
+    fn(pair) をペアごとにプールで実行する（1ペアの失敗で他のペアは止めない）
+
+    Args:
+        fn: モジュールレベルの関数（processes=True ならpickleできること。functools.partial可）
+        processes: TrueならプロセスプールでCPU処理を、Falseならスレッドプールで通信待ちを並列にする
+        initializer / initargs: プロセスプールの各ワーカーで1回だけ呼ぶ（共有データの受け渡し）
+
+    Returns:
+        {"job", "ok", "elapsed_sec", "pairs": {pair: 結果 + "elapsed_sec"}}
+    """
+    t0 = time.perf_counter()
+    results: Dict[str, dict] = {}
+    workers = max(1, min(workers, len(pairs)))
+
+    if workers == 1:
+        if initializer:
+            initializer(*initargs)
+        for pair in pairs:
+            results[pair] = _timed(fn, pair)
+    else:
+        if processes:
+            pool = ProcessPoolExecutor(max_workers=workers, initializer=initializer, initargs=initargs)
+        else:
+            if initializer:
+                initializer(*initargs)
+            pool = ThreadPoolExecutor(max_workers=workers)
+        with pool:
+            futures = {pool.submit(_timed, fn, pair): pair for pair in pairs}
+            for fut in as_completed(futures):
+                pair = futures[fut]
+                try:
+                    results[pair] = fut.result()
+                except Exception as e:  # ワーカープロセスの異常終了など
+                    results[pair] = {"ok": False, "error": f"{type(e).__name__}: {e}", "elapsed_sec": None}
+
+    report = {
+        "job": job,
+        "ok": all(r.get("ok") for r in results.values()),
+        "elapsed_sec": round(time.perf_counter() - t0, 3),
+        "workers": workers,
+        "pairs": {pair: results[pair] for pair in pairs},
+    }
+    print_report(report)
+    _append_log(report)
+    return report
+
+
+def print_report(report: dict):
+    """ペア別の所要時間の一覧"""
+    pairs = report["pairs"]
+    total = sum(r.get("elapsed_sec") or 0.0 for r in pairs.values())
+    print(f"[INFO] {report['job']}: {len(pairs)} pairs, workers={report['workers']}, "
+          f"wall={report['elapsed_sec']:.1f}s, sum={total:.1f}s")
+    for pair, r in sorted(pairs.items(), key=lambda kv: -(kv[1].get("elapsed_sec") or 0.0)):
+        status = "ok" if r.get("ok") else f"FAILED ({r.get('error')})"
+        elapsed = r.get("elapsed_sec")
+        print(f"    {pair:<8} {elapsed if elapsed is not None else float('nan'):>8.2f}s  {status}")
+    failed = [p for p, r in pairs.items() if not r.get("ok")]
+    if failed:
+        print(f"[WARN] {report['job']}: failed pairs: {','.join(failed)}")
+    else:
+        print(f"[OK] {report['job']}: all pairs done")
+
+
+def _append_log(report: dict):
+    try:
+        REPORT_LOG.parent.mkdir(parents=True, exist_ok=True)
+        record = {"at": datetime.now(timezone.utc).isoformat(timespec="seconds"), **report}
+        with open(REPORT_LOG, "a", encoding="utf-8") as f:
+            f.write(json.dumps(record, ensure_ascii=False, default=str) + "\n")
+    except OSError as e:
+        print(f"[WARN] could not write {REPORT_LOG}: {e}")
@@ -0,0 +1,13 @@
+# -*- coding: utf-8 -*-
+
+"""
+gunicorn の設定（起動コマンドの引数が優先される。ここでは起動時のフックだけを持つ）
+
+ジョブ用のプロセスプールは app を import しただけでは起動しないので、
+各ワーカーの起動後に先に立ち上げておく（マスタープロセスでは起動しない）。
+"""
+
+
+def post_worker_init(worker):
+    from app import job_runner
+    job_runner.warm()
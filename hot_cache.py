@@ -0,0 +1,100 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+プロセス内のホットキャッシュ
+
+ファイル（またはファイル群）の (mtime_ns, size) をシグネチャとして、読み込んだオブジェクトを保持する。
+シグネチャの確認（stat）は check_interval 秒に1回までで、その間のリクエストはファイルI/O無しで返る。
+gunicornのスレッドから同時に呼ばれても、同じキーの読み込みは1回だけ行う。
+"""
+
+import os
+import threading
+import time
+from pathlib import Path
+from typing import Any, Callable, Dict, Hashable, Iterable, Optional, Tuple, Union
+
+PathLike = Union[str, Path]
+
+
+def file_signature(paths: Iterable[PathLike]) -> Tuple:
+    """((path, mtime_ns, size), ...)。存在しないファイルは (path, None, None)"""
+    sig = []
+    for p in paths:
+        try:
+            st = os.stat(p)
+            sig.append((str(p), st.st_mtime_ns, st.st_size))
+        except FileNotFoundError:
+            sig.append((str(p), None, None))
+    return tuple(sig)
+
+
+class _Entry:
+    __slots__ = ("signature", "value", "checked_at")
+
+    def __init__(self, signature, value, checked_at):
+        self.signature = signature
+        self.value = value
+        self.checked_at = checked_at
+
+
+class HotCache:
+    """キー → (シグネチャ, 値)"""
+
+    def __init__(self, check_interval: float = 1.0):
+        self.check_interval = check_interval
+        self._entries: Dict[Hashable, _Entry] = {}
+        self._locks: Dict[Hashable, threading.Lock] = {}
+        self._locks_guard = threading.Lock()
+        self.hits = 0
+        self.loads = 0
+
+    def _lock_for(self, key: Hashable) -> threading.Lock:
+        with self._locks_guard:
+            lock = self._locks.get(key)
+            if lock is None:
+                lock = self._locks[key] = threading.Lock()
+            return lock
+
+    def get(self, key: Hashable, signature: Callable[[], Any], loader: Callable[[], Any]) -> Any:
+        """
+        キャッシュ済みの値を返す。シグネチャが変わっていれば loader で読み直す
+
+        Args:
+            signature: 読み込み元の状態を返す関数（file_signature など）
+            loader: 値を読み込む関数
+        """
+        entry = self._entries.get(key)
+        now = time.monotonic()
+        if entry is not None and now - entry.checked_at < self.check_interval:
+            self.hits += 1
+            return entry.value
+
+        sig = signature()
+        if entry is not None and entry.signature == sig:
+            entry.checked_at = now
+            self.hits += 1
+            return entry.value
+
+        with self._lock_for(key):
+            # 待っている間に別スレッドが読み込んでいればそれを使う
+            entry = self._entries.get(key)
+            if entry is not None and entry.signature == sig:
+                self.hits += 1
+                return entry.value
+            # シグネチャは読み込み前に取る（読み込み中に更新されたら次回読み直す）
+            value = loader()
+            self._entries[key] = _Entry(sig, value, time.monotonic())
+            self.loads += 1
+            return value
+
+    def invalidate(self, key: Optional[Hashable] = None):
+        """key（Noneなら全て）を破棄する"""
+        if key is None:
+            self._entries.clear()
+        else:
+            self._entries.pop(key, None)
+
+    def stats(self) -> Dict[str, int]:
+        return {"entries": len(self._entries), "hits": self.hits, "loads": self.loads}
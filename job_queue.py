@@ -0,0 +1,222 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+長時間かかるコマンド（データ更新・イベント更新・モデル学習）のジョブキュー
+
+ジョブはSQLite（data/jobs.sqlite）に記録し、プロセス内のワーカースレッドで実行する。
+同じ種類のジョブが待機中・実行中なら新しく作らずにそのジョブに合流する
+（gunicornの複数ワーカー間でもSQLiteで判定する）。
+終了時には on_finish に完了したジョブを渡す（LINEのpush通知など）。
+"""
+
+import json
+import os
+import queue
+import sqlite3
+import threading
+import traceback
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Callable, Dict, List, Optional
+
+DEFAULT_DB = "data/jobs.sqlite"
+
+# ステータス
+STATUS_QUEUED = "queued"
+STATUS_RUNNING = "running"
+STATUS_DONE = "done"
+STATUS_FAILED = "failed"
+ACTIVE = (STATUS_QUEUED, STATUS_RUNNING)
+
+RESULT_MAX_CHARS = 4000
+
+
+def utc_now_iso() -> str:
+    return datetime.now(timezone.utc).isoformat(timespec="seconds")
+
+
+def _pid_alive(pid: Optional[int]) -> bool:
+    if not pid:
+        return False
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+class JobQueue:
+    """種類ごとの処理関数を持つジョブキュー"""
+
+    def __init__(self, handlers: Dict[str, Callable[[], str]],
+                 db_path: str = DEFAULT_DB,
+                 workers: int = 2,
+                 on_finish: Optional[Callable[[dict], None]] = None):
+        """
+        Args:
+            handlers: ジョブの種類 → 結果のテキストを返す関数
+            workers: ワーカースレッド数
+            on_finish: ジョブ終了時に呼ぶ関数（ジョブのdictを受け取る）
+        """
+        self.handlers = handlers
+        self.db_path = Path(db_path)
+        self.db_path.parent.mkdir(parents=True, exist_ok=True)
+        self.on_finish = on_finish
+        self._pending: "queue.Queue[int]" = queue.Queue()
+        self._submit_lock = threading.Lock()
+
+        with self._connect() as conn:
+            conn.executescript("""
+                CREATE TABLE IF NOT EXISTS jobs (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    kind TEXT NOT NULL,
+                    status TEXT NOT NULL,
+                    notify TEXT NOT NULL DEFAULT '[]',
+                    result TEXT,
+                    pid INTEGER,
+                    created_at TEXT NOT NULL,
+                    started_at TEXT,
+                    finished_at TEXT
+                );
+                CREATE INDEX IF NOT EXISTS jobs_kind_status ON jobs (kind, status);
+            """)
+        self._recover()
+
+        self._threads = []
+        for i in range(max(1, workers)):
+            t = threading.Thread(target=self._worker, name=f"job-worker-{i}", daemon=True)
+            t.start()
+            self._threads.append(t)
+
+    @contextmanager
+    def _connect(self):
+        # 呼び出しごとに接続する（sqlite3の接続はスレッド間で共有しない）
+        conn = sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+        conn.row_factory = sqlite3.Row
+        try:
+            conn.execute("PRAGMA journal_mode=WAL")
+            yield conn
+        finally:
+            conn.close()
+
+    def _recover(self):
+        """終了したプロセスが持っていたジョブを片付ける（実行中→失敗、待機中→このプロセスで実行）"""
+        with self._connect() as conn:
+            rows = conn.execute(
+                "SELECT id, status, pid FROM jobs WHERE status IN (?, ?)", ACTIVE
+            ).fetchall()
+            for row in rows:
+                if _pid_alive(row["pid"]):
+                    continue
+                if row["status"] == STATUS_RUNNING:
+                    conn.execute(
+                        "UPDATE jobs SET status = ?, result = ?, finished_at = ? WHERE id = ?",
+                        (STATUS_FAILED, "interrupted (worker process exited)", utc_now_iso(), row["id"]),
+                    )
+                else:
+                    conn.execute("UPDATE jobs SET pid = ? WHERE id = ?", (os.getpid(), row["id"]))
+                    self._pending.put(row["id"])
+
+    # --- 投入・参照 ---
+
+    def submit(self, kind: str, notify_to: Optional[str] = None) -> tuple:
+        """
+        ジョブを投入する。同じ種類のジョブが待機中・実行中ならそれに合流する
+
+        Returns:
+            (job, joined) joined=True なら既存のジョブに合流した
+        """
+        if kind not in self.handlers:
+            raise ValueError(f"Unknown job kind: {kind}")
+
+        with self._submit_lock, self._connect() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                row = conn.execute(
+                    "SELECT * FROM jobs WHERE kind = ? AND status IN (?, ?) ORDER BY id LIMIT 1",
+                    (kind, *ACTIVE),
+                ).fetchone()
+                if row is not None:
+                    notify = json.loads(row["notify"])
+                    if notify_to and notify_to not in notify:
+                        notify.append(notify_to)
+                        conn.execute("UPDATE jobs SET notify = ? WHERE id = ?", (json.dumps(notify), row["id"]))
+                    conn.execute("COMMIT")
+                    return self.get(row["id"]), True
+
+                cur = conn.execute(
+                    "INSERT INTO jobs (kind, status, notify, pid, created_at) VALUES (?, ?, ?, ?, ?)",
+                    (kind, STATUS_QUEUED, json.dumps([notify_to] if notify_to else []), os.getpid(), utc_now_iso()),
+                )
+                job_id = cur.lastrowid
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+
+        self._pending.put(job_id)
+        return self.get(job_id), False
+
+    def get(self, job_id: int) -> Optional[dict]:
+        with self._connect() as conn:
+            row = conn.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        return self._as_dict(row) if row else None
+
+    def recent(self, limit: int = 5, kind: Optional[str] = None) -> List[dict]:
+        """新しい順のジョブ一覧"""
+        with self._connect() as conn:
+            if kind:
+                rows = conn.execute("SELECT * FROM jobs WHERE kind = ? ORDER BY id DESC LIMIT ?", (kind, limit))
+            else:
+                rows = conn.execute("SELECT * FROM jobs ORDER BY id DESC LIMIT ?", (limit,))
+            return [self._as_dict(r) for r in rows.fetchall()]
+
+    @staticmethod
+    def _as_dict(row: sqlite3.Row) -> dict:
+        job = dict(row)
+        job["notify"] = json.loads(job["notify"])
+        return job
+
+    # --- 実行 ---
+
+    def _claim(self, job_id: int) -> bool:
+        with self._connect() as conn:
+            cur = conn.execute(
+                "UPDATE jobs SET status = ?, pid = ?, started_at = ? WHERE id = ? AND status = ?",
+                (STATUS_RUNNING, os.getpid(), utc_now_iso(), job_id, STATUS_QUEUED),
+            )
+            return cur.rowcount == 1
+
+    def _finish(self, job_id: int, status: str, result: str):
+        with self._connect() as conn:
+            conn.execute(
+                "UPDATE jobs SET status = ?, result = ?, finished_at = ? WHERE id = ?",
+                (status, result[:RESULT_MAX_CHARS], utc_now_iso(), job_id),
+            )
+
+    def _worker(self):
+        while True:
+            job_id = self._pending.get()
+            try:
+                if not self._claim(job_id):
+                    continue
+                job = self.get(job_id)
+                try:
+                    result = self.handlers[job["kind"]]()
+                    self._finish(job_id, STATUS_DONE, str(result))
+                except Exception as e:
+                    print(f"[ERROR] Job {job_id} ({job['kind']}) failed: {e}")
+                    traceback.print_exc()
+                    self._finish(job_id, STATUS_FAILED, f"{type(e).__name__}: {e}")
+
+                if self.on_finish:
+                    try:
+                        self.on_finish(self.get(job_id))
+                    except Exception as e:
+                        print(f"[ERROR] Job {job_id} finish callback failed: {e}")
+            finally:
+                self._pending.task_done()
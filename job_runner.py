@@ -0,0 +1,152 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+jobs/ のジョブをプロセスプールで実行する
+
+各ジョブは run(argv) -> dict を持つ。ワーカープロセスは起動時に pandas / pyarrow / lightgbm と
+ジョブモジュールを読み込んでおき、ジョブごとのインタプリタ起動と再importを無くす。
+ジョブの標準出力は結果の "log" に入れて返す。
+タイムアウトやワーカーの異常終了時はプールを作り直す（同じプールで実行中の他のジョブも失敗扱いになる）。
+"""
+
+import importlib
+import io
+import multiprocessing
+import os
+import sys
+import threading
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor, TimeoutError as FuturesTimeout
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import redirect_stderr, redirect_stdout
+from pathlib import Path
+from typing import Optional
+
+PROJECT_ROOT = Path(__file__).parent
+JOBS_DIR = PROJECT_ROOT / "jobs"
+
+# ワーカー起動時に読み込んでおくモジュール
+WARM_MODULES = ["numpy", "pandas", "pyarrow", "pyarrow.parquet", "pyarrow.dataset", "lightgbm"]
+WARM_JOBS = ["build_features", "download_yahoo_finance", "fetch_macro_events", "fetch_rss_events"]
+
+LOG_MAX_CHARS = 20000
+
+
+def _init_worker(cwd: str):
+    """ワーカープロセスの初期化（作業ディレクトリを合わせて重いモジュールを読み込む）"""
+    os.chdir(cwd)
+    root = str(PROJECT_ROOT)
+    if root not in sys.path:
+        sys.path.insert(0, root)
+    for name in WARM_MODULES + [f"jobs.{job}" for job in WARM_JOBS]:
+        try:
+            importlib.import_module(name)
+        except ImportError:
+            pass
+
+
+def _ping() -> int:
+    return os.getpid()
+
+
+def _call(job_name: str, argv: list) -> dict:
+    """ワーカープロセス内でジョブを実行する"""
+    buf = io.StringIO()
+    t0 = time.perf_counter()
+    try:
+        module = importlib.import_module(f"jobs.{job_name}")
+        with redirect_stdout(buf), redirect_stderr(buf):
+            result = module.run(argv)
+        result = dict(result or {})
+        result.setdefault("ok", True)
+    except SystemExit as e:
+        # argparseのエラーや raise SystemExit("...")
+        error = e.code if isinstance(e.code, str) else f"exit code {e.code}"
+        result = {"ok": False, "error": error}
+    except Exception as e:
+        traceback.print_exc(file=buf)
+        result = {"ok": False, "error": f"{type(e).__name__}: {e}"}
+    result["elapsed_sec"] = round(time.perf_counter() - t0, 3)
+    result["log"] = buf.getvalue()[-LOG_MAX_CHARS:]
+    return result
+
+
+class JobRunner:
+    """ジョブ用のプロセスプール（初回利用時または warm() で起動）"""
+
+    def __init__(self, workers: int = 1, cwd: Optional[str] = None):
+        """
+        Args:
+            workers: プロセス数
+            cwd: ワーカーの作業ディレクトリ（ジョブの相対パスの基準。デフォルトはプロジェクトルート）
+        """
+        self.workers = max(1, workers)
+        self.cwd = str(cwd or PROJECT_ROOT)
+        self._pool: Optional[ProcessPoolExecutor] = None
+        self._lock = threading.Lock()
+
+    def _get_pool(self) -> ProcessPoolExecutor:
+        with self._lock:
+            if self._pool is None:
+                # forkだとFlaskやジョブキューのスレッドの状態を引き継ぐため spawn を使う
+                self._pool = ProcessPoolExecutor(
+                    max_workers=self.workers,
+                    mp_context=multiprocessing.get_context("spawn"),
+                    initializer=_init_worker,
+                    initargs=(self.cwd,),
+                )
+                # 全ワーカーを起動しておく
+                for _ in range(self.workers):
+                    self._pool.submit(_ping)
+            return self._pool
+
+    def warm(self):
+        """ワーカープロセスを先に起動しておく"""
+        self._get_pool()
+
+    def _reset(self, pool: ProcessPoolExecutor):
+        """プールを破棄する（実行中のワーカーは終了させる）"""
+        with self._lock:
+            if self._pool is pool:
+                self._pool = None
+        for proc in list((getattr(pool, "_processes", None) or {}).values()):
+            try:
+                proc.terminate()
+            except Exception:
+                pass
+        pool.shutdown(wait=False, cancel_futures=True)
+
+    def run(self, job_name: str, argv: Optional[list] = None, timeout: int = 300) -> dict:
+        """
+        ジョブを実行して結果を返す
+
+        Returns:
+            ジョブの run() の結果に "ok", "elapsed_sec", "log" を加えたもの
+            （失敗時は "error"、タイムアウト時は "timeout": True）
+        """
+        if not (JOBS_DIR / f"{job_name}.py").exists():
+            return {"ok": False, "error": f"Job {job_name} not found"}
+
+        pool = self._get_pool()
+        try:
+            try:
+                future = pool.submit(_call, job_name, list(argv or []))
+            except RuntimeError:
+                # 別スレッドがプールを破棄した直後なら作り直して投入する
+                pool = self._get_pool()
+                future = pool.submit(_call, job_name, list(argv or []))
+            return future.result(timeout=timeout)
+        except FuturesTimeout:
+            self._reset(pool)
+            return {"ok": False, "timeout": True, "error": f"Job timeout ({timeout}s)"}
+        except BrokenProcessPool as e:
+            self._reset(pool)
+            return {"ok": False, "error": f"Job worker exited: {e}"}
+
+    def shutdown(self):
+        with self._lock:
+            pool, self._pool = self._pool, None
+        if pool is not None:
+            pool.shutdown(wait=True, cancel_futures=True)
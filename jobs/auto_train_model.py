@@ -10,11 +10,12 @@ import os
 import sys
 from pathlib import Path
 from datetime import datetime, timedelta, timezone
-import pandas as pd
 
 # プロジェクトルートをパスに追加
 sys.path.insert(0, str(Path(__file__).parent.parent))
 
+import model_bundle
+from feature_store import FeatureStore
 from jobs.train_fx_model import train_model
 
 
@@ -23,31 +24,32 @@ def should_retrain(model_path: str, features_path: str, min_days_since_train: in
     モデルを再学習すべきか判定
     
     Args:
-        model_path: モデルファイルのパス
-        features_path: 特徴量ファイルのパス
+        model_path: モデルのバンドル（または旧形式の .pkl）のパス
+        features_path: 特徴量ストアのパス（data/features/<PAIR>/tf=<TF>）または特徴量ファイルのパス
         min_days_since_train: 前回学習から何日経過したら再学習するか
     
     Returns:
         True: 再学習すべき, False: 不要
     """
-    model_file = Path(model_path)
-    features_file = Path(features_path)
+    store = FeatureStore.from_path(features_path)
     
     # 特徴量ファイルが存在しない
-    if not features_file.exists():
+    if not (store.exists() if store is not None else Path(features_path).exists()):
         print(f"[INFO] Features file not found: {features_path}. Skipping retrain.")
         return False
     
     # モデルファイルが存在しない → 初回学習
-    if not model_file.exists():
+    if model_bundle.resolve(model_path) is None:
         print(f"[INFO] Model file not found: {model_path}. Will train initial model.")
         return True
     
-    # モデルの更新日時を取得
-    model_mtime = datetime.fromtimestamp(model_file.stat().st_mtime, tz=timezone.utc)
+    # モデルの更新日時を取得（バンドルはマニフェストとモデルの新しい方）
+    model_ts = max(f.stat().st_mtime for f in model_bundle.artifact_files(model_path) if f.exists())
+    model_mtime = datetime.fromtimestamp(model_ts, tz=timezone.utc)
     
-    # 特徴量の更新日時を取得
-    features_mtime = datetime.fromtimestamp(features_file.stat().st_mtime, tz=timezone.utc)
+    # 特徴量の更新日時を取得（ストアは最後に書かれたパーティション）
+    features_ts = store.mtime() if store is not None else Path(features_path).stat().st_mtime
+    features_mtime = datetime.fromtimestamp(features_ts, tz=timezone.utc)
     
     # 特徴量がモデルより新しい → 再学習が必要
     if features_mtime > model_mtime:
@@ -78,59 +80,49 @@ def auto_train(pair: str = "USDJPY",
         model_path: モデル保存先（Noneの場合はデフォルト）
         min_days_since_train: 再学習判定の最小日数
         force: 強制再学習（判定をスキップ）
+    
+    Returns:
+        {"trained", "reason", "model_path", "rows", ...train_model の結果}
     """
     if model_path is None:
-        model_path = f"models/fx_{pair.lower()}_model.pkl"
+        model_path = f"models/fx_{pair.lower()}_model"
     
-    features_path = f"data/features/{pair}/{features_tf}_features.parquet"
+    store = FeatureStore(pair, features_tf)
+    features_path = str(store.path)
     
     # 再学習判定
     if not force and not should_retrain(model_path, features_path, min_days_since_train):
         print("[INFO] Model retraining not needed. Use --force to force retraining.")
-        return
+        return {"trained": False, "reason": "up_to_date", "model_path": model_path}
     
     # 特徴量データを確認
-    if not Path(features_path).exists():
+    if not store.exists():
         print(f"[ERROR] Features file not found: {features_path}")
-        return
+        return {"trained": False, "reason": "no_features", "model_path": model_path}
     
-    # データ量を確認
+    # データ量を確認（行数はParquetのメタデータから取得し、本体は読まない）
     try:
-        df = pd.read_parquet(features_path)
-        if len(df) < 1000:
-            print(f"[WARN] Insufficient data: {len(df)} rows. Need at least 1000 rows.")
-            return
+        n_rows = store.num_rows()
+        if n_rows < 1000:
+            print(f"[WARN] Insufficient data: {n_rows} rows. Need at least 1000 rows.")
+            return {"trained": False, "reason": "insufficient_data", "model_path": model_path, "rows": n_rows}
     except Exception as e:
         print(f"[ERROR] Failed to read features: {e}")
-        return
+        return {"trained": False, "reason": f"read_error: {e}", "model_path": model_path}
     
     # 学習期間を自動設定
-    try:
-        if 'ts' in df.columns:
-            df['ts'] = pd.to_datetime(df['ts'], utc=True, errors='coerce')
-            df = df.set_index('ts').sort_index()
-        elif df.index.dtype == 'datetime64[ns]':
-            pass
-        else:
-            print("[WARN] No timestamp found. Using all data.")
-            train_start = None
-            train_end = None
-    except Exception:
-        train_start = None
-        train_end = None
-    else:
-        # 最新1年分で学習（または全データ）
-        # 必要に応じて調整可能
-        train_start = None  # 全データを使用
-        train_end = None
+    # 最新1年分で学習（または全データ）
+    # 必要に応じて調整可能
+    train_start = None  # 全データを使用
+    train_end = None
     
     print(f"[INFO] Starting model training...")
     print(f"[INFO] Features: {features_path}")
     print(f"[INFO] Output: {model_path}")
-    print(f"[INFO] Data rows: {len(df)}")
+    print(f"[INFO] Data rows: {n_rows}")
     
     try:
-        train_model(
+        summary = train_model(
             features_path=features_path,
             output_path=model_path,
             train_start=train_start,
@@ -141,20 +133,27 @@ def auto_train(pair: str = "USDJPY",
     except Exception as e:
         print(f"[ERROR] Model training failed: {e}")
         raise
+    return {"trained": True, "reason": "trained", "model_path": model_path, **summary}
 
 
-def main():
+def run(argv: list = None) -> dict:
+    """
+    ジョブのエントリポイント（app.run_job からプロセスプール内で呼ばれる）
+
+    Returns:
+        auto_train の結果
+    """
     import argparse
     
     ap = argparse.ArgumentParser(description="Auto train FX model")
     ap.add_argument("--pair", default="USDJPY", help="Currency pair")
     ap.add_argument("--features-tf", default="M5", help="Features timeframe")
-    ap.add_argument("--model-path", help="Model output path (default: models/fx_{pair}_model.pkl)")
+    ap.add_argument("--model-path", help="Model bundle directory (default: models/fx_{pair}_model)")
     ap.add_argument("--min-days", type=int, default=7, help="Minimum days since last training to retrain")
     ap.add_argument("--force", action="store_true", help="Force retraining regardless of conditions")
-    args = ap.parse_args()
+    args = ap.parse_args(argv)
     
-    auto_train(
+    return auto_train(
         pair=args.pair,
         features_tf=args.features_tf,
         model_path=args.model_path,
@@ -163,5 +162,9 @@ def main():
     )
 
 
+def main():
+    run()
+
+
 if __name__ == "__main__":
     main()
@@ -0,0 +1,292 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+FXAnalysisAgent の判断を過去の特徴量で再生するバックテスト
+
+各バーの終値で analyze_batch の判断（モデルまたはルール）からポジション（買い+1/売り-1/なし0）を決め、
+次のバーのリターンを受け取る。ポジションが変わるたびにスプレッドの半分を払う。
+確信度の下限（--confidence-cutoffs）は1回の判定から全て評価する。
+--target-thresholds を指定すると、閾値ごとに分割日より前でモデルを学習し、分割日以降で評価する
+（閾値ごとの学習・判定はプロセスプールで並列に実行する）。
+"""
+
+import argparse
+import json
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Dict, List, Optional
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, str(Path(__file__).parent.parent))
+
+import model_bundle
+from feature_store import FeatureStore
+from fx_ai_agent import DEFAULT_MODEL_PATH, FXAnalysisAgent
+
+RESULT_LOG = Path("data/logs/backtests.jsonl")
+DEFAULT_CUTOFFS = [0.0, 0.4, 0.5, 0.6, 0.7]
+SECONDS_PER_YEAR = 365.25 * 86400
+
+
+def load_features(pair: str, tf: str, start: Optional[str] = None, end: Optional[str] = None) -> pd.DataFrame:
+    """特徴量ストアから ts インデックスの特徴量を読む"""
+    store = FeatureStore(pair, tf)
+    if not store.exists():
+        raise FileNotFoundError(f"No features for {pair} {tf}: {store.path}")
+    df = store.range(start, end)
+    if "ts" in df.columns:
+        df["ts"] = pd.to_datetime(df["ts"], utc=True)
+        df = df.set_index("ts")
+    return df.sort_index()
+
+
+def bar_returns(features_df: pd.DataFrame) -> np.ndarray:
+    """各バーの次のバーまでのリターン（最後のバーは0）"""
+    if "close" in features_df.columns:
+        close = features_df["close"].to_numpy(dtype=np.float64)
+        nxt = np.empty_like(close)
+        nxt[:-1] = close[1:] / close[:-1] - 1.0
+    else:
+        logret = features_df["logret_1"].to_numpy(dtype=np.float64)
+        nxt = np.empty_like(logret)
+        nxt[:-1] = np.expm1(logret[1:])
+    nxt[-1:] = 0.0
+    return np.nan_to_num(nxt, nan=0.0, posinf=0.0, neginf=0.0)
+
+
+def spread_cost(features_df: pd.DataFrame, spread: Optional[float] = None) -> np.ndarray:
+    """
+    ポジションを1単位動かすコスト（リターン換算のスプレッドの半分）
+
+    spread を指定すればその値（価格単位）、無ければ特徴量の spread 列を使う。
+    価格は close（無ければ ma_5）
+    """
+    n = len(features_df)
+    if spread is not None:
+        s = np.full(n, float(spread))
+    elif "spread" in features_df.columns:
+        s = features_df["spread"].to_numpy(dtype=np.float64, na_value=np.nan)
+        s = pd.Series(s).ffill().fillna(0.0).to_numpy()
+    else:
+        return np.zeros(n)
+    price_col = "close" if "close" in features_df.columns else "ma_5"
+    price = features_df[price_col].to_numpy(dtype=np.float64, na_value=np.nan)
+    cost = 0.5 * s / price
+    return np.nan_to_num(cost, nan=0.0, posinf=0.0, neginf=0.0)
+
+
+def positions(decisions: pd.DataFrame, cutoff: float, skip_high_risk: bool = False) -> np.ndarray:
+    """判断からポジション（確信度が cutoff 未満、またはリスク高で除外なら0）"""
+    direction = decisions["direction"].to_numpy()
+    pos = np.where(direction == "buy", 1.0, np.where(direction == "sell", -1.0, 0.0))
+    active = decisions["confidence"].to_numpy(dtype=np.float64) >= cutoff
+    if skip_high_risk:
+        active &= decisions["risk_level"].to_numpy() != "high"
+    return np.where(active, pos, 0.0)
+
+
+def evaluate(pos: np.ndarray, returns: np.ndarray, cost: np.ndarray, index: pd.DatetimeIndex) -> dict:
+    """ポジションの損益・取引回数・ドローダウン"""
+    turnover = np.abs(np.diff(pos, prepend=0.0))
+    net = pos * returns - turnover * cost
+    equity = np.cumprod(1.0 + net)
+    drawdown = equity / np.maximum.accumulate(equity) - 1.0
+
+    span = (index[-1] - index[0]).total_seconds() if len(index) > 1 else 0.0
+    periods_per_year = len(index) / span * SECONDS_PER_YEAR if span > 0 else 0.0
+    std = net.std()
+    held = pos != 0
+    entries = int(((pos != 0) & (np.diff(pos, prepend=0.0) != 0)).sum())
+    return {
+        "total_return": float(equity[-1] - 1.0) if len(equity) else 0.0,
+        "sharpe": float(net.mean() / std * np.sqrt(periods_per_year)) if std > 0 else 0.0,
+        "max_drawdown": float(drawdown.min()) if len(drawdown) else 0.0,
+        "trades": entries,
+        "exposure": float(held.mean()) if len(held) else 0.0,
+        "hit_rate": float((net[held] > 0).mean()) if held.any() else 0.0,
+        "cost": float((turnover * cost).sum()),
+    }
+
+
+def sweep_cutoffs(agent: FXAnalysisAgent, features_df: pd.DataFrame, cutoffs: List[float],
+                  spread: Optional[float] = None, skip_high_risk: bool = False) -> List[dict]:
+    """1回の判定から確信度の下限ごとの結果を出す"""
+    decisions = agent.analyze_batch(features_df)
+    returns = bar_returns(features_df)
+    cost = spread_cost(features_df, spread)
+    method = decisions["method"].iat[0] if len(decisions) else None
+    results = []
+    for cutoff in cutoffs:
+        pos = positions(decisions, cutoff, skip_high_risk)
+        results.append({"method": method, "cutoff": cutoff,
+                        **evaluate(pos, returns, cost, features_df.index)})
+    return results
+
+
+# --- 閾値ごとの学習と評価（プロセスプールのワーカーで実行） ---
+
+_FEATURES: Optional[pd.DataFrame] = None
+
+
+def _set_features(features_df: pd.DataFrame):
+    global _FEATURES
+    _FEATURES = features_df
+
+
+def _train_and_sweep(threshold: float, split: str, forward_bars: int, cutoffs: List[float],
+                     spread: Optional[float], skip_high_risk: bool) -> List[dict]:
+    """分割日より前で閾値 ±threshold のラベルのモデルを学習し、分割日以降を評価する"""
+    from jobs.train_fx_model import create_target, fit_booster, prepare_features
+
+    features_df = _FEATURES
+    split_ts = pd.Timestamp(split)
+    train = features_df[features_df.index < split_ts]
+    test = features_df[features_df.index >= split_ts]
+
+    t0 = time.perf_counter()
+    target = create_target(train, forward_bars=forward_bars,
+                           buy_threshold=threshold, sell_threshold=-threshold)
+    X, feature_cols = prepare_features(train)
+    valid = ~target.isna()
+    booster = fit_booster(X[valid], target[valid].astype(int))
+    train_sec = time.perf_counter() - t0
+
+    agent = FXAnalysisAgent()
+    agent.set_model(booster, feature_cols)
+    results = sweep_cutoffs(agent, test, cutoffs, spread, skip_high_risk)
+    for r in results:
+        r["target_threshold"] = threshold
+        r["train_rows"] = int(valid.sum())
+        r["train_sec"] = round(train_sec, 3)
+    return results
+
+
+def print_results(results: List[dict]):
+    print(f"[INFO] {'threshold':>9} {'cutoff':>6} {'return':>9} {'sharpe':>7} {'maxDD':>8} "
+          f"{'trades':>7} {'exposure':>8} {'hit':>6}")
+    for r in sorted(results, key=lambda r: -r["sharpe"]):
+        th = r.get("target_threshold")
+        print(f"       {th if th is not None else '-':>9} {r['cutoff']:>6.2f} {r['total_return']:>+9.2%} "
+              f"{r['sharpe']:>7.2f} {r['max_drawdown']:>8.2%} {r['trades']:>7} {r['exposure']:>8.1%} "
+              f"{r['hit_rate']:>6.1%}")
+
+
+def _append_log(record: dict):
+    try:
+        RESULT_LOG.parent.mkdir(parents=True, exist_ok=True)
+        with open(RESULT_LOG, "a", encoding="utf-8") as f:
+            f.write(json.dumps(record, ensure_ascii=False, default=str) + "\n")
+    except OSError as e:
+        print(f"[WARN] could not write {RESULT_LOG}: {e}")
+
+
+def _floats(value: Optional[str]) -> List[float]:
+    return [float(x) for x in value.split(",") if x.strip()] if value else []
+
+
+def run(argv: list = None) -> dict:
+    """
+    ジョブのエントリポイント（app.run_job からプロセスプール内で呼ばれる）
+
+    Returns:
+        {"pair", "timeframe", "rows", "start", "end", "elapsed_sec", "results", "best"}
+    """
+    ap = argparse.ArgumentParser(description="Replay FXAnalysisAgent decisions over the feature store")
+    ap.add_argument("--pair", default="USDJPY")
+    ap.add_argument("--timeframe", default="M5")
+    ap.add_argument("--start", help="Backtest start (YYYY-MM-DD)")
+    ap.add_argument("--end", help="Backtest end (YYYY-MM-DD)")
+    ap.add_argument("--model", default=None,
+                    help=f"Model to replay (default: {DEFAULT_MODEL_PATH} if it exists, otherwise rules)")
+    ap.add_argument("--rules", action="store_true", help="Replay the rule-based analysis even if a model exists")
+    ap.add_argument("--confidence-cutoffs", default=",".join(str(c) for c in DEFAULT_CUTOFFS),
+                    help="Comma separated minimum confidence to take a position")
+    ap.add_argument("--target-thresholds", default=None,
+                    help="Comma separated create_target thresholds (e.g. 0.0005,0.001,0.002). "
+                         "Trains one model per threshold before --split and evaluates after it")
+    ap.add_argument("--split", default=None, help="Train/test split date for --target-thresholds (default: 70%% point)")
+    ap.add_argument("--forward-bars", type=int, default=60, help="Forward bars for create_target")
+    ap.add_argument("--spread", type=float, default=None,
+                    help="Fixed spread in price units (default: the features' spread column)")
+    ap.add_argument("--skip-high-risk", action="store_true", help="Stay flat when risk_level is high")
+    ap.add_argument("--workers", type=int, default=1, help="Processes for --target-thresholds")
+    ap.add_argument("--out", default=None, help="Write the results as JSON")
+    args = ap.parse_args(argv)
+
+    t0 = time.perf_counter()
+    pair = args.pair.upper()
+    tf = args.timeframe.upper()
+    features_df = load_features(pair, tf, args.start, args.end)
+    if len(features_df) < 2:
+        raise SystemExit(f"Not enough feature rows for {pair} {tf}: {len(features_df)}")
+    print(f"[INFO] Backtest {pair} {tf}: {len(features_df)} bars "
+          f"({features_df.index[0]} - {features_df.index[-1]})")
+
+    cutoffs = _floats(args.confidence_cutoffs) or [0.0]
+    thresholds = _floats(args.target_thresholds)
+
+    if thresholds:
+        if args.split:
+            # 日付だけの指定（YYYY-MM-DD）はUTCとみなす（特徴量の ts はUTC）
+            split_ts = pd.Timestamp(args.split)
+            split_ts = split_ts.tz_localize("UTC") if split_ts.tzinfo is None else split_ts.tz_convert("UTC")
+        else:
+            split_ts = features_df.index[int(len(features_df) * 0.7)]
+        split = split_ts.isoformat()
+        print(f"[INFO] Training {len(thresholds)} models before {split} (workers={args.workers})")
+        task_args = [(th, split, args.forward_bars, cutoffs, args.spread, args.skip_high_risk)
+                     for th in thresholds]
+        workers = max(1, min(args.workers, len(thresholds)))
+        if workers == 1:
+            _set_features(features_df)
+            nested = [_train_and_sweep(*a) for a in task_args]
+        else:
+            with ProcessPoolExecutor(max_workers=workers, initializer=_set_features,
+                                     initargs=(features_df,)) as pool:
+                nested = list(pool.map(_train_and_sweep, *zip(*task_args)))
+        results = [r for rs in nested for r in rs]
+    else:
+        split = None
+        model_path = None if args.rules else (args.model or DEFAULT_MODEL_PATH)
+        if model_path and model_bundle.resolve(model_path) is None:
+            model_path = None
+        agent = FXAnalysisAgent(model_path=model_path, feature_store=FeatureStore(pair, tf))
+        results = sweep_cutoffs(agent, features_df, cutoffs, args.spread, args.skip_high_risk)
+
+    print_results(results)
+    best = max(results, key=lambda r: r["sharpe"])
+    summary = {
+        "pair": pair,
+        "timeframe": tf,
+        "rows": len(features_df),
+        "start": features_df.index[0].isoformat(),
+        "end": features_df.index[-1].isoformat(),
+        "split": split,
+        "elapsed_sec": round(time.perf_counter() - t0, 3),
+        "results": results,
+        "best": best,
+    }
+    print(f"[OK] backtest done in {summary['elapsed_sec']:.1f}s: best sharpe={best['sharpe']:.2f} "
+          f"(cutoff={best['cutoff']}, threshold={best.get('target_threshold')})")
+
+    _append_log({"at": datetime.now(timezone.utc).isoformat(timespec="seconds"), **summary})
+    if args.out:
+        Path(args.out).parent.mkdir(parents=True, exist_ok=True)
+        with open(args.out, "w", encoding="utf-8") as f:
+            json.dump(summary, f, ensure_ascii=False, indent=2, default=str)
+        print(f"[OK] wrote {args.out}")
+    return summary
+
+
+def main():
+    run()
+
+
+if __name__ == "__main__":
+    main()
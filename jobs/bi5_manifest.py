@@ -0,0 +1,165 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+bi5ダウンロードのマニフェスト（data/raw_bi5/<PAIR>/_manifest.sqlite）
+時間ごとの取得結果を記録し、再実行時に本当に欠けている時間だけを取得する。
+M1ビルドの記録も持ち、前回ビルド以降に変化した日を求められる。
+"""
+
+import hashlib
+import sqlite3
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional
+
+MANIFEST_NAME = "_manifest.sqlite"
+
+# ステータス
+STATUS_OK = "ok"            # 200で中身あり
+STATUS_EMPTY = "empty"      # 200だが空（週末・休日など）
+STATUS_MISSING = "missing"  # 404などの4xx
+STATUS_ERROR = "error"      # リトライ上限・例外（次回も再取得する）
+
+# 時間が閉じてからこの時間以上経って空/404だったものは確定とみなす
+DEFAULT_SETTLE = timedelta(hours=24)
+
+HOUR_FMT = "%Y-%m-%dT%H"
+
+
+def hour_key(dt: datetime) -> str:
+    return dt.strftime(HOUR_FMT)
+
+
+def utc_now_iso() -> str:
+    return datetime.now(timezone.utc).isoformat(timespec="seconds")
+
+
+def sha256_file(path: Path) -> str:
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+class Bi5Manifest:
+    """1通貨ペア分のbi5取得状況とM1ビルド状況"""
+
+    def __init__(self, pair_root: Path):
+        self.pair_root = Path(pair_root)
+        self.pair_root.mkdir(parents=True, exist_ok=True)
+        self.path = self.pair_root / MANIFEST_NAME
+        self.conn = sqlite3.connect(self.path)
+        self.conn.executescript("""
+            CREATE TABLE IF NOT EXISTS hours (
+                hour TEXT PRIMARY KEY,
+                status TEXT NOT NULL,
+                size INTEGER NOT NULL DEFAULT 0,
+                sha256 TEXT,
+                fetched_at TEXT NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS m1_builds (
+                day TEXT PRIMARY KEY,
+                built_at TEXT NOT NULL
+            );
+        """)
+
+    def close(self):
+        self.conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    # --- 取得記録 ---
+
+    def record(self, hour: datetime, status: str, size: int = 0,
+               sha256: Optional[str] = None, fetched_at: Optional[str] = None):
+        self.record_many([(hour, status, size, sha256, fetched_at)])
+
+    def record_many(self, rows: Iterable[tuple]):
+        """(hour, status, size, sha256, fetched_at) をまとめて記録"""
+        now = utc_now_iso()
+        with self.conn:
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO hours (hour, status, size, sha256, fetched_at) VALUES (?, ?, ?, ?, ?)",
+                [(hour_key(h), st, int(size or 0), sha, fa or now) for h, st, size, sha, fa in rows],
+            )
+
+    def entries(self, hours: List[datetime]) -> Dict[str, tuple]:
+        """hour_key -> (status, size, sha256, fetched_at)"""
+        if not hours:
+            return {}
+        cur = self.conn.execute(
+            "SELECT hour, status, size, sha256, fetched_at FROM hours WHERE hour BETWEEN ? AND ?",
+            (hour_key(min(hours)), hour_key(max(hours))),
+        )
+        return {row[0]: row[1:] for row in cur}
+
+    def plan(self, hours: List[datetime], file_for, settle: timedelta = DEFAULT_SETTLE) -> List[datetime]:
+        """
+        ネットワークに問い合わせる必要がある時間だけを返す
+
+        - okで記録済み、かつファイルが残っている → スキップ
+        - 空/404で、時間が閉じてから settle 以上経ってから確認済み → スキップ
+        - マニフェスト導入前に取得済みのファイル → okとして登録してスキップ
+        """
+        known = self.entries(hours)
+        todo = []
+        backfill = []
+        for h in hours:
+            entry = known.get(hour_key(h))
+            path = file_for(h)
+            has_file = path.exists() and path.stat().st_size > 0
+
+            if entry is None:
+                if has_file:
+                    backfill.append((h, STATUS_OK, path.stat().st_size, sha256_file(path), None))
+                else:
+                    todo.append(h)
+                continue
+
+            status, _size, _sha, fetched_at = entry
+            if status == STATUS_OK and has_file:
+                continue
+            if status in (STATUS_EMPTY, STATUS_MISSING):
+                closed_at = h + timedelta(hours=1)
+                if datetime.fromisoformat(fetched_at) >= closed_at + settle:
+                    continue
+            todo.append(h)
+
+        if backfill:
+            self.record_many(backfill)
+        return todo
+
+    # --- M1ビルド記録 ---
+
+    def mark_built(self, day: str, built_at: Optional[str] = None):
+        with self.conn:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO m1_builds (day, built_at) VALUES (?, ?)",
+                (day, built_at or utc_now_iso()),
+            )
+
+    def changed_days(self, days: Iterable[str]) -> List[str]:
+        """前回のM1ビルド以降にokの時間が取得された日（未ビルドの日を含む）"""
+        days = sorted(days)
+        if not days:
+            return []
+        cur = self.conn.execute("""
+            SELECT substr(h.hour, 1, 10) AS day, MAX(h.fetched_at) AS last_fetch, b.built_at
+            FROM hours h LEFT JOIN m1_builds b ON b.day = substr(h.hour, 1, 10)
+            WHERE h.status = ? AND h.hour BETWEEN ? AND ?
+            GROUP BY day
+        """, (STATUS_OK, f"{days[0]}T00", f"{days[-1]}T23"))
+        changed = set()
+        tracked = set()
+        for day, last_fetch, built_at in cur:
+            tracked.add(day)
+            if built_at is None or last_fetch > built_at:
+                changed.add(day)
+        # マニフェストに記録が無い日は判断できないので対象に含める
+        return [d for d in days if d in changed or d not in tracked]
@@ -2,9 +2,21 @@
 # -*- coding: utf-8 -*-
 
 import argparse
+import json
+import os
+import shutil
+import sys
+from functools import partial
 from pathlib import Path
+from typing import NamedTuple, Optional
+
+import numpy as np
 import pandas as pd
 
+sys.path.insert(0, str(Path(__file__).parent.parent))
+
+from fx_pairs import parse_pairs, run_per_pair
+
 
 def resample_ohlc(df: pd.DataFrame, rule: str) -> pd.DataFrame:
     """Resample M1 to higher timeframes"""
@@ -44,23 +56,419 @@ def build_6m_from_1m(df_1m: pd.DataFrame) -> pd.DataFrame:
     return resample_ohlc(df_1m, "6M")
 
 
-def main():
-    ap = argparse.ArgumentParser()
-    ap.add_argument("--pair", required=True)
-    ap.add_argument("--m1-root", default="data/bars", help="bars root with tf=M1/date=...")
-    ap.add_argument("--out-root", default="data/bars")
-    ap.add_argument("--tfs", default="M5,M15,H1,H4,D1,W1,1M,6M")
-    args = ap.parse_args()
+# 時間足のマッピング（pandas resample形式）
+TF_MAP = {
+    "M5": "5T",    # 5分
+    "M15": "15T",  # 15分
+    "H1": "1H",    # 1時間
+    "H4": "4H",    # 4時間
+    "D1": "1D",    # 1日
+    "W1": "1W",    # 1週間
+}
+
+WATERMARK_FILE = "_watermarks.json"
+
+# --- 単一パスの多時間足集計エンジン ---
+# ソート済みM1配列を一度だけ読み、細かい足から粗い足を順に組み立てる
+# （M5→M15→H1→H4→D1、D1→W1、D1→1M→6M）。各段はビンの切れ目を求めて
+# ufunc.reduceat で集計するだけなので、時間足ごとにresampleを6回呼ぶ必要がない。
+
+NS_MIN = 60 * 1_000_000_000
+NS_DAY = 1440 * NS_MIN
+
+# 1日を割り切る固定幅の足（epoch基準の切り捨て = pandasのstart_day基準と一致）
+FIXED_TF_NS = {
+    "M5": 5 * NS_MIN,
+    "M15": 15 * NS_MIN,
+    "H1": 60 * NS_MIN,
+    "H4": 240 * NS_MIN,
+    "D1": NS_DAY,
+}
+CALENDAR_TFS = ("W1", "1M", "6M")
+ENGINE_TFS = tuple(FIXED_TF_NS) + CALENDAR_TFS
+
+
+class BarArrays(NamedTuple):
+    """集計途中の状態（start=ビン開始のns、スプレッドは合計と件数で持つ）"""
+    start: np.ndarray
+    open: np.ndarray
+    high: np.ndarray
+    low: np.ndarray
+    close: np.ndarray
+    vol: np.ndarray
+    spread_sum: np.ndarray
+    spread_cnt: np.ndarray
+
+
+def bar_arrays(df: pd.DataFrame) -> BarArrays:
+    """ts昇順のバー（M1または既存の足）を集計エンジンの入力に変換"""
+    idx = pd.DatetimeIndex(df.index)
+    start = (idx.tz_convert("UTC") if idx.tz is not None else idx).asi8
+    spread = df["spread"].to_numpy(dtype=np.float64) if "spread" in df.columns else np.full(len(df), np.nan)
+    vol = df["vol"].to_numpy(dtype=np.float64) if "vol" in df.columns else np.zeros(len(df))
+    has_spread = ~np.isnan(spread)
+    return BarArrays(
+        start=start,
+        open=df["open"].to_numpy(dtype=np.float64),
+        high=df["high"].to_numpy(dtype=np.float64),
+        low=df["low"].to_numpy(dtype=np.float64),
+        close=df["close"].to_numpy(dtype=np.float64),
+        vol=np.nan_to_num(vol, nan=0.0),
+        spread_sum=np.where(has_spread, spread, 0.0),
+        spread_cnt=has_spread.astype(np.float64),
+    )
+
+
+def _month_index(start_ns: np.ndarray) -> np.ndarray:
+    """1970-01からの通算月"""
+    return start_ns.astype("datetime64[ns]").astype("datetime64[M]").astype(np.int64)
+
+
+def _month_start_ns(month_idx: np.ndarray) -> np.ndarray:
+    return month_idx.astype("datetime64[M]").astype("datetime64[ns]").astype(np.int64)
+
+
+def bin_starts(tf: str, start_ns: np.ndarray, anchor_month: Optional[int] = None) -> np.ndarray:
+    """各行が属する上位足のビン開始時刻（ns）"""
+    if tf in FIXED_TF_NS:
+        step = FIXED_TF_NS[tf]
+        return start_ns - start_ns % step
+    if tf == "W1":
+        # 月曜00:00始まり（1970-01-01は木曜）
+        day = start_ns // NS_DAY
+        return (day - (day - 4) % 7) * NS_DAY
+    months = _month_index(start_ns)
+    if tf == "1M":
+        return _month_start_ns(months)
+    if tf == "6M":
+        # ラベル = anchor + 6k（月末）、ビン = (ラベル-6ヶ月, ラベル]
+        k = -((anchor_month - months) // 6)
+        return _month_start_ns(anchor_month + 6 * k - 5)
+    raise ValueError(f"Unsupported timeframe for engine: {tf}")
+
+
+def bin_labels(tf: str, starts: np.ndarray) -> np.ndarray:
+    """ビン開始時刻をpandasのresampleと同じラベルに変換"""
+    if tf in FIXED_TF_NS:
+        return starts
+    if tf == "W1":
+        return starts + 6 * NS_DAY  # 日曜ラベル
+    span = 6 if tf == "6M" else 1
+    # 月末ラベル = 次のビン開始の前日
+    return _month_start_ns(_month_index(starts) + span) - NS_DAY
+
+
+def reduce_bins(bars: BarArrays, starts: np.ndarray) -> BarArrays:
+    """同じビン開始を持つ連続行をreduceatでまとめる"""
+    if len(starts) == 0:
+        return bars
+    cut = np.flatnonzero(starts[1:] != starts[:-1]) + 1
+    first = np.concatenate(([0], cut))
+    last = np.concatenate((cut - 1, [len(starts) - 1]))
+    return BarArrays(
+        start=starts[first],
+        open=bars.open[first],
+        high=np.maximum.reduceat(bars.high, first),
+        low=np.minimum.reduceat(bars.low, first),
+        close=bars.close[last],
+        vol=np.add.reduceat(bars.vol, first),
+        spread_sum=np.add.reduceat(bars.spread_sum, first),
+        spread_cnt=np.add.reduceat(bars.spread_cnt, first),
+    )
+
+
+def as_means(bars: BarArrays) -> BarArrays:
+    """スプレッドを平均値1件として扱い直す（6Mは月足の平均の平均）"""
+    has_spread = bars.spread_cnt > 0
+    mean = np.divide(bars.spread_sum, bars.spread_cnt, out=np.zeros_like(bars.spread_sum), where=has_spread)
+    return bars._replace(spread_sum=mean, spread_cnt=has_spread.astype(np.float64))
+
+
+def to_frame(tf: str, bars: BarArrays, has_vol: bool = True) -> pd.DataFrame:
+    spread = np.divide(bars.spread_sum, bars.spread_cnt,
+                       out=np.full(len(bars.start), np.nan), where=bars.spread_cnt > 0)
+    index = pd.DatetimeIndex(bin_labels(tf, bars.start).astype("datetime64[ns]"), tz="UTC", name="ts")
+    return pd.DataFrame({
+        "open": bars.open,
+        "high": bars.high,
+        "low": bars.low,
+        "close": bars.close,
+        "vol": bars.vol if has_vol else np.full(len(bars.start), np.nan),
+        "spread": spread,
+    }, index=index)
+
+
+def _nests(child: str, parent: str) -> bool:
+    """childのビンがparentのビンに完全に含まれるか"""
+    if child == "M1":
+        return True
+    if child in FIXED_TF_NS:
+        if parent in FIXED_TF_NS:
+            return FIXED_TF_NS[parent] % FIXED_TF_NS[child] == 0
+        return NS_DAY % FIXED_TF_NS[child] == 0
+    return child == "1M" and parent == "6M"
+
+
+def aggregate_timeframes(m1: pd.DataFrame, tfs: list,
+                         anchor_6m: Optional[pd.Timestamp] = None) -> dict:
+    """
+    ts昇順のM1（DatetimeIndex）から、指定の全時間足を1回の走査で生成する
+
+    Args:
+        m1: open/high/low/close(/vol/spread) を持つバー
+        tfs: 時間足のリスト（エンジン対象外のものはresample_ohlcで処理）
+        anchor_6m: 6Mビンの基準となる月末ラベル（Noneなら最初の月）
+
+    Returns:
+        {tf: DataFrame}（resample_ohlcと同じ列・ラベル）
+    """
+    out = {}
+    if m1.empty:
+        return out
+    m1 = m1.dropna(subset=["open", "high", "low", "close"])
+    has_vol = "vol" in m1.columns
+
+    wanted = [tf for tf in tfs if tf in ENGINE_TFS]
+    # 6Mは常に月足（の平均）から作る
+    order = [tf for tf in ENGINE_TFS if tf in wanted or (tf == "1M" and "6M" in wanted)]
+
+    levels = {"M1": bar_arrays(m1)}
+    built = ["M1"]
+    for tf in order:
+        parent = next(p for p in reversed(built) if _nests(p, tf))
+        src = levels[parent]
+        anchor_month = None
+        if tf == "6M":
+            src = as_means(src)
+            if anchor_6m is not None:
+                anchor_month = int(_month_index(np.array([pd.Timestamp(anchor_6m).value]))[0])
+            else:
+                anchor_month = int(_month_index(src.start[:1])[0])
+        levels[tf] = reduce_bins(src, bin_starts(tf, src.start, anchor_month))
+        built.append(tf)
+
+    for tf in tfs:
+        if tf in levels:
+            out[tf] = to_frame(tf, levels[tf], has_vol)
+        elif tf not in ENGINE_TFS:
+            out[tf] = resample_ohlc(m1, TF_MAP.get(tf, tf))
+    return out
+
+
+def _concat_bars(a: BarArrays, b: BarArrays) -> BarArrays:
+    return BarArrays(*(np.concatenate((x, y)) for x, y in zip(a, b)))
+
+
+def _slice_bars(bars: BarArrays, sl: slice) -> BarArrays:
+    return BarArrays(*(x[sl] for x in bars))
+
+
+class StreamingAggregator:
+    """
+    時間順に届くM1バッチから全時間足を生成する（メモリはバッチサイズで上限）
+
+    各段は最後の（まだ閉じていない可能性がある）ビンだけを持ち越し、
+    閉じたビンは sink(tf, DataFrame) に渡すとともに上位の段へ流す。
+    """
+
+    def __init__(self, tfs: list, sink, has_vol: bool = True):
+        self.tfs = [tf for tf in tfs if tf in ENGINE_TFS]
+        unsupported = [tf for tf in tfs if tf not in ENGINE_TFS]
+        if unsupported:
+            raise ValueError(f"Streaming mode supports only {ENGINE_TFS}: {unsupported}")
+        self.sink = sink
+        self.has_vol = has_vol
+        self.order = [tf for tf in ENGINE_TFS if tf in self.tfs or (tf == "1M" and "6M" in self.tfs)]
+        built = ["M1"]
+        self.parent = {}
+        for tf in self.order:
+            self.parent[tf] = next(p for p in reversed(built) if _nests(p, tf))
+            built.append(tf)
+        self.carry = {}
+        self.anchor_month = None
+
+    def _feed(self, tf: str, src: BarArrays, final: bool) -> BarArrays:
+        """1段分を集計して閉じたビンを返す"""
+        if tf == "6M":
+            src = as_means(src)
+            if self.anchor_month is None and len(src.start):
+                self.anchor_month = int(_month_index(src.start[:1])[0])
+        carry = self.carry.pop(tf, None)
+        if carry is None and len(src.start) == 0:
+            return src
+
+        # 持ち越したビンの開始時刻は bin_starts を通しても変わらないので、そのまま連結して再集計する
+        keys = bin_starts(tf, src.start, self.anchor_month)
+        if carry is not None:
+            keys = np.concatenate((carry.start, keys))
+            src = _concat_bars(carry, src)
+        bars = reduce_bins(src, keys)
+        if final:
+            return bars
+        self.carry[tf] = _slice_bars(bars, slice(-1, None))
+        return _slice_bars(bars, slice(None, -1))
+
+    def _run(self, m1: BarArrays, final: bool):
+        closed = {"M1": m1}
+        for tf in self.order:
+            closed[tf] = self._feed(tf, closed[self.parent[tf]], final)
+            if tf in self.tfs and len(closed[tf].start):
+                self.sink(tf, to_frame(tf, closed[tf], self.has_vol))
+
+    def push(self, m1: pd.DataFrame):
+        m1 = m1.dropna(subset=["open", "high", "low", "close"])
+        if not m1.empty:
+            self._run(bar_arrays(m1), final=False)
+
+    def finish(self):
+        empty = BarArrays(*(np.empty(0, dtype=np.int64 if i == 0 else np.float64) for i in range(len(BarArrays._fields))))
+        self._run(empty, final=True)
+
+
+def scan_m1_batches(m1_root: Path, batch_rows: int = 500_000,
+                    start: Optional[str] = None, end: Optional[str] = None,
+                    columns: Optional[list] = None):
+    """
+    tf=M1 のdate=パーティションをpyarrow datasetとして時間順に読み、
+    batch_rows行程度ずつ ts をインデックスにしたDataFrameを返す
+
+    Args:
+        start, end: 読み込む日付範囲（YYYY-MM-DD、両端含む）。パーティション名で絞り込む
+    """
+    import pyarrow as pa
+    import pyarrow.dataset as ds
+
+    dataset = ds.dataset(str(m1_root), format="parquet", partitioning="hive")
+    names = dataset.schema.names
+    cols = [c for c in (columns or ["ts", "open", "high", "low", "close", "vol", "spread"]) if c in names]
+
+    # date=YYYY-MM-DD のディレクトリ名順 = 時間順
+    fragments = sorted(dataset.get_fragments(), key=lambda f: f.path)
+    pending, pending_rows = [], 0
+
+    def flush():
+        table = pa.Table.from_batches(pending)
+        df = table.to_pandas()
+        df["ts"] = pd.to_datetime(df["ts"], utc=True)
+        return df.set_index("ts").sort_index()
+
+    for frag in fragments:
+        day = Path(frag.path).parent.name.replace("date=", "")
+        if (start and day < start) or (end and day > end):
+            continue
+        for batch in frag.to_batches(columns=cols):
+            if batch.num_rows == 0:
+                continue
+            pending.append(batch)
+            pending_rows += batch.num_rows
+            if pending_rows >= batch_rows:
+                yield flush()
+                pending, pending_rows = [], 0
+    if pending:
+        yield flush()
+
 
-    pair = args.pair.upper()
-    m1_root = Path(args.m1_root) / pair / "tf=M1"
-    out_root = Path(args.out_root) / pair
+class MonthPartitionWriter:
+    """閉じたバーを受け取り、月が切り替わった時点でその月のパーティションを書き出す"""
 
+    def __init__(self, tf_dir: Path):
+        self.tf_dir = tf_dir
+        self.month = None
+        self.buffer = []
+        self.rows = 0
+        self.last_ts = None
+
+    def write(self, bars: pd.DataFrame):
+        out = bars.rename_axis("ts").reset_index()
+        months = out["ts"].dt.strftime("%Y-%m")
+        for month, part in out.groupby(months, sort=True):
+            if self.month is not None and month != self.month:
+                self._flush()
+            self.month = month
+            self.buffer.append(part)
+        self.last_ts = bars.index[-1]
+
+    def _flush(self):
+        if self.buffer:
+            part = pd.concat(self.buffer, ignore_index=True)
+            _write_parquet_atomic(part, self.tf_dir / f"month={self.month}" / "part-000.parquet")
+            self.rows += len(part)
+        self.buffer = []
+
+    def close(self) -> int:
+        self._flush()
+        return self.rows
+
+
+def build_streaming(m1_root: Path, out_root: Path, tf_list: list, batch_rows: int) -> dict:
+    """全履歴をバッチ単位で読み、全時間足を作り直す（戻り値は新しいwatermark）"""
+    writers = {}
+    for tf in tf_list:
+        reset_tf_dir(out_root / f"tf={tf}")
+        writers[tf] = MonthPartitionWriter(out_root / f"tf={tf}")
+
+    agg = StreamingAggregator(tf_list, sink=lambda tf, bars: writers[tf].write(bars))
+    total = 0
+    for batch in scan_m1_batches(m1_root, batch_rows):
+        if total == 0:
+            agg.has_vol = "vol" in batch.columns
+        agg.push(batch)
+        total += len(batch)
+    agg.finish()
+    print(f"[INFO] streamed M1 rows={total} batch_rows={batch_rows}")
+
+    watermarks = {}
+    for tf, w in writers.items():
+        rows = w.close()
+        if w.last_ts is None:
+            print(f"[WARN] No bars for {tf}")
+            continue
+        watermarks[tf] = w.last_ts
+        print(f"[OK] wrote {out_root / f'tf={tf}'} rows={rows} watermark={w.last_ts}")
+    return watermarks
+
+
+def prev_6m_label(label: pd.Timestamp) -> pd.Timestamp:
+    """6Mバーの1つ前のビンのラベル（途中から再計算するときのanchor）"""
+    return label - pd.DateOffset(months=6) + pd.offsets.MonthEnd(0)
+
+
+def bar_start(tf: str, label: pd.Timestamp) -> pd.Timestamp:
+    """バーのラベルから、そのバーを再計算するのに必要なM1の開始時刻を求める"""
+    if tf == "W1":
+        # W-SUN: 月曜00:00〜日曜23:59を日曜のラベルで集計
+        return label.normalize() - pd.Timedelta(days=6)
+    if tf == "1M":
+        return label.normalize() - pd.offsets.MonthBegin(1)
+    if tf == "6M":
+        return label.normalize() - pd.offsets.MonthBegin(6)
+    # 分足・時間足・日足は左端ラベル
+    return label
+
+
+def load_watermarks(out_root: Path) -> dict:
+    path = out_root / WATERMARK_FILE
+    if not path.exists():
+        return {}
+    with open(path, "r", encoding="utf-8") as f:
+        return {tf: pd.Timestamp(ts) for tf, ts in json.load(f).items()}
+
+
+def save_watermarks(out_root: Path, watermarks: dict):
+    out_root.mkdir(parents=True, exist_ok=True)
+    tmp = out_root / (WATERMARK_FILE + ".tmp")
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump({tf: ts.isoformat() for tf, ts in watermarks.items()}, f, indent=2)
+    os.replace(tmp, out_root / WATERMARK_FILE)
+
+
+def load_m1(m1_root: Path, start: Optional[pd.Timestamp] = None) -> pd.DataFrame:
+    """M1パーティションを読み込む（startがあればその日以降のパーティションのみ）"""
     files = sorted(m1_root.glob("date=*/part-*.parquet"))
-    if not files:
-        raise SystemExit("No M1 parquet files found")
+    if start is not None:
+        start_day = start.strftime("%Y-%m-%d")
+        files = [f for f in files if f.parent.name.replace("date=", "") >= start_day]
 
-    # Load all M1 data
     dfs = []
     for f in files:
         try:
@@ -73,44 +481,198 @@ def main():
             continue
 
     if not dfs:
-        raise SystemExit("No valid M1 data found")
+        return pd.DataFrame()
 
     m1 = pd.concat(dfs).sort_index()
+    if start is not None:
+        m1 = m1[m1.index >= start]
+    return m1
 
-    # 時間足のマッピング（pandas resample形式）
-    tf_map = {
-        "M5": "5T",    # 5分
-        "M15": "15T",  # 15分
-        "H1": "1H",    # 1時間
-        "H4": "4H",    # 4時間
-        "D1": "1D",    # 1日
-        "W1": "1W",    # 1週間
-    }
-    
-    tf_list = [x.strip() for x in args.tfs.split(",") if x.strip()]
+
+def read_bars(tf_dir: Path, start: Optional[pd.Timestamp] = None) -> pd.DataFrame:
+    """月別パーティションからバーを読み込む（startがあればその月以降）"""
+    files = sorted(tf_dir.glob("month=*/part-*.parquet"))
+    if start is not None:
+        start_month = start.strftime("%Y-%m")
+        files = [f for f in files if f.parent.name.replace("month=", "") >= start_month]
+    if not files:
+        return pd.DataFrame()
+    bars = pd.concat([pd.read_parquet(f) for f in files], ignore_index=True)
+    bars["ts"] = pd.to_datetime(bars["ts"], utc=True)
+    bars = bars.set_index("ts").sort_index()
+    return bars[bars.index >= start] if start is not None else bars
+
+
+def _write_parquet_atomic(df: pd.DataFrame, path: Path):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp = path.with_name(path.name + ".tmp")
+    df.to_parquet(tmp, index=False)
+    os.replace(tmp, path)
+
+
+def upsert_bars(tf_dir: Path, bars: pd.DataFrame) -> int:
+    """
+    月別パーティション（tf=XX/month=YYYY-MM/part-000.parquet）にバーを反映する
+    先頭バー以降の既存行は置き換え、影響する月のパーティションだけを書き直す
+    """
+    if bars.empty:
+        return 0
+    first_ts = bars.index[0]
+    out = bars.rename_axis("ts").reset_index()
+    months = out["ts"].dt.strftime("%Y-%m")
+
+    for month, part in out.groupby(months, sort=True):
+        path = tf_dir / f"month={month}" / "part-000.parquet"
+        if path.exists():
+            old = pd.read_parquet(path)
+            old["ts"] = pd.to_datetime(old["ts"], utc=True)
+            old = old[old["ts"] < first_ts]
+            part = pd.concat([old, part], ignore_index=True) if not old.empty else part
+        _write_parquet_atomic(part.reset_index(drop=True), path)
+    return len(out)
+
+
+def migrate_legacy_bars(tf_dir: Path) -> int:
+    """
+    旧形式の tf=XX/all.parquet を月別パーティションに移して削除する（月別パーティションがあれば削除のみ）
+
+    Returns:
+        移した行数
+    """
+    legacy = tf_dir / "all.parquet"
+    if not legacy.exists():
+        return 0
+    rows = 0
+    if not any(tf_dir.glob("month=*/part-*.parquet")):
+        bars = pd.read_parquet(legacy)
+        bars["ts"] = pd.to_datetime(bars["ts"], utc=True, errors="coerce")
+        bars = bars.dropna(subset=["ts"]).drop_duplicates("ts", keep="last").set_index("ts").sort_index()
+        rows = upsert_bars(tf_dir, bars)
+        print(f"[INFO] migrated {legacy} into month partitions (rows={rows})")
+    legacy.unlink()
+    return rows
+
+
+def reset_tf_dir(tf_dir: Path):
+    """フルリビルド用に既存の出力を削除する"""
+    if not tf_dir.exists():
+        return
+    for d in tf_dir.glob("month=*"):
+        shutil.rmtree(d)
+    legacy = tf_dir / "all.parquet"
+    if legacy.exists():
+        legacy.unlink()
+
+
+def build_pair(pair: str, m1_root, out_root, tf_list: list, full: bool = False,
+               stream: bool = False, batch_rows: int = 500_000) -> dict:
+    """1ペア分の全時間足を更新する（--pairs ではペアごとにプロセスプールで呼ばれる）"""
+    m1_root = Path(m1_root) / pair / "tf=M1"
+    out_root = Path(out_root) / pair
+
+    if not any(m1_root.glob("date=*/part-*.parquet")):
+        raise SystemExit(f"No M1 parquet files found for {pair}")
+
+    watermarks = {} if full else load_watermarks(out_root)
+
+    # 前回の最後のバー（未完成の可能性あり）以降だけを再計算する
+    starts = {tf: bar_start(tf, watermarks[tf]) if tf in watermarks else None for tf in tf_list}
+    # 6Mは同じ実行で更新した1Mパーティションから作れるので、M1の読み込み範囲に含めない
+    six_from_monthly = (
+        "6M" in tf_list and "1M" in tf_list and tf_list.index("1M") < tf_list.index("6M")
+        and starts.get("1M") is not None
+    )
+    m1_starts = [st for tf, st in starts.items() if not (tf == "6M" and six_from_monthly)]
+    need_all = any(st is None for st in m1_starts)
+    load_from = None if need_all else min(m1_starts)
+
+    if stream and need_all:
+        # 全履歴が必要な場合はメモリに載せずにバッチで作り直す
+        watermarks = build_streaming(m1_root, out_root, tf_list, batch_rows)
+        save_watermarks(out_root, watermarks)
+        return {
+            "pair": pair, "out_root": str(out_root), "mode": "stream",
+            "timeframes": {tf: {"rows": None, "watermark": wm.isoformat()} for tf, wm in watermarks.items()},
+        }
+
+    m1 = load_m1(m1_root, load_from)
+    if m1.empty:
+        raise SystemExit(f"No valid M1 data found for {pair}")
+    print(f"[INFO] loaded M1 rows={len(m1)} from={m1.index[0]} ({'full' if load_from is None else 'incremental'})")
+
+    # 全時間足を1回の走査で集計（読み込んだM1はどの時間足のwatermarkのバーも完全に含む）
+    six_wm = watermarks.get("6M")
+    engine_tfs = [tf for tf in tf_list if not (tf == "6M" and six_from_monthly)]
+    results = aggregate_timeframes(m1, engine_tfs, anchor_6m=prev_6m_label(six_wm) if six_wm is not None else None)
+
+    summary = {}
     for tf in tf_list:
-        if tf == "1M":
-            bars = build_monthly(m1)
-            rule_name = "1M"
-        elif tf == "6M":
-            m_1m = build_monthly(m1)
-            bars = build_6m_from_1m(m_1m)
-            rule_name = "6M"
+        wm = watermarks.get(tf)
+        tf_dir = out_root / f"tf={tf}"
+        if wm is None:
+            reset_tf_dir(tf_dir)
+
+        if tf == "6M" and six_from_monthly:
+            monthly = read_bars(out_root / "tf=1M", starts[tf])
+            bars = aggregate_timeframes(monthly, ["6M"], anchor_6m=prev_6m_label(wm)).get("6M", pd.DataFrame())
         else:
-            # 時間足をpandas resample形式に変換
-            rule = tf_map.get(tf, tf)
-            bars = resample_ohlc(m1, rule)
-            rule_name = tf
+            bars = results.get(tf, pd.DataFrame())
+        if wm is not None and not bars.empty:
+            bars = bars[bars.index >= wm]
 
         if bars.empty:
-            print(f"[WARN] No bars for {rule_name}")
+            print(f"[WARN] No bars for {tf}")
             continue
 
-        out_dir = out_root / f"tf={rule_name}"
-        out_dir.mkdir(parents=True, exist_ok=True)
-        out_path = out_dir / "all.parquet"
-        bars.reset_index().to_parquet(out_path, index=False)
-        print(f"[OK] wrote {out_path} rows={len(bars)}")
+        rows = upsert_bars(tf_dir, bars)
+        watermarks[tf] = bars.index[-1]
+        save_watermarks(out_root, watermarks)
+        print(f"[OK] upserted {tf_dir} rows={rows} watermark={watermarks[tf]}")
+        summary[tf] = {"rows": rows, "watermark": watermarks[tf].isoformat()}
+
+    return {
+        "pair": pair, "out_root": str(out_root),
+        "mode": "full" if load_from is None else "incremental",
+        "timeframes": summary,
+    }
+
+
+def run(argv: Optional[list] = None) -> dict:
+    """
+    ジョブのエントリポイント（app.run_job からプロセスプール内で呼ばれる）
+
+    Returns:
+        {"pair", "out_root", "mode", "timeframes": {tf: {"rows", "watermark"}}}
+        --pairs の場合は fx_pairs.run_per_pair のレポート（ペアごとに上記）
+    """
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--pair")
+    ap.add_argument("--pairs", help="comma separated pairs (or 'all') to build in one run")
+    ap.add_argument("--workers", type=int, default=1, help="worker processes to spread --pairs over")
+    ap.add_argument("--m1-root", default="data/bars", help="bars root with tf=M1/date=...")
+    ap.add_argument("--out-root", default="data/bars")
+    ap.add_argument("--tfs", default="M5,M15,H1,H4,D1,W1,1M,6M")
+    ap.add_argument("--full", action="store_true",
+                    help="rebuild all timeframes from the whole M1 history (maintenance, e.g. after backfills)")
+    ap.add_argument("--stream", action="store_true",
+                    help="do full rebuilds in bounded memory by scanning M1 in record batches")
+    ap.add_argument("--batch-rows", type=int, default=500_000, help="M1 rows per batch in --stream mode")
+    args = ap.parse_args(argv)
+
+    pairs = parse_pairs(args.pair, args.pairs)
+    if not pairs:
+        ap.error("--pair or --pairs is required")
+    tf_list = [x.strip() for x in args.tfs.split(",") if x.strip()]
+
+    build = partial(build_pair, m1_root=args.m1_root, out_root=args.out_root, tf_list=tf_list,
+                    full=args.full, stream=args.stream, batch_rows=args.batch_rows)
+    if args.pairs is None:
+        return build(pairs[0])
+    return run_per_pair("build_bars_from_m1", build, pairs, workers=args.workers)
+
+
+def main():
+    run()
 
 
 if __name__ == "__main__":
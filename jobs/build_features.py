@@ -2,138 +2,269 @@
 # -*- coding: utf-8 -*-
 
 import argparse
+import json
 import os
+import sys
+from functools import partial
 from pathlib import Path
+from typing import Dict, List, Optional, Tuple, Union
 import numpy as np
 import pandas as pd
 
+sys.path.insert(0, str(Path(__file__).parent.parent))
 
-def rsi(series: pd.Series, period: int = 14) -> pd.Series:
+from event_direction import pair_classifier
+from events_store import DEFAULT_DB as EVENTS_DB, EventsStore
+from feature_store import DEFAULT_ROOT as FEATURES_ROOT, FeatureStore
+from fx_pairs import parse_pairs, run_per_pair
+
+RSI_PERIOD = 14
+ATR_PERIOD = 14
+MA_WINDOWS = [5, 20, 60]
+SPREAD_MA_WINDOW = 60
+# ボラティリティの水準の閾値（vol_20 の直近 REGIME_WINDOW 本の分位点。fx_ai_agent のリスク判定が使う）
+REGIME_WINDOW = 5000
+REGIME_MIN_PERIODS = 21
+VOL_REGIME_QUANTILES = {"vol_20_p80": 0.8, "vol_20_p95": 0.95}
+# 移動窓の最大バー数（増分計算で読み直すルックバック。分位点は vol_20 の窓の分も遡る）
+MAX_BAR_WINDOW = max(MA_WINDOWS + [SPREAD_MA_WINDOW]) + REGIME_WINDOW
+
+# 増分計算の状態（特徴量ストアのディレクトリに置く）
+STATE_FILE = "_state.json"
+# イベント特徴量の計算方法の版（変わったら保存済みの状態を使わずに全件計算し直す）
+# 3: マクロ指標のセンチメントをペアごとの方向で付け直す（2: 保存された USDJPY 向けの値をそのまま使う）
+# 2: イベント時刻の累積和による t - w < ts <= t の集計（1: バーの時間幅に寄せてから rolling）
+EVENT_ENGINE = 3
+# イベントストアに残す変更の記録の上限（これより遅れた特徴量ストアは次回に全件計算し直す）
+EVENT_CHANGES_RETAIN = 100_000
+# イベントストアから読む列
+EVENT_COLUMNS = ["category", "sentiment", "sentiment_w", "surprise", "weight", "country", "event"]
+
+
+def ewm_from(x: pd.Series, alpha: float, seed: Optional[float] = None) -> pd.Series:
+    """adjust=FalseのEWM。seed があれば直前の値として続きから計算する"""
+    if seed is None or pd.isna(seed):
+        return x.ewm(alpha=alpha, adjust=False).mean()
+    s = pd.concat([pd.Series([seed]), pd.Series(x.to_numpy())], ignore_index=True)
+    out = s.ewm(alpha=alpha, adjust=False).mean().iloc[1:]
+    out.index = x.index
+    return out
+
+
+def rsi_parts(series: pd.Series, period: int = 14,
+              seed_up: Optional[float] = None, seed_down: Optional[float] = None,
+              new: Optional[np.ndarray] = None) -> Tuple[pd.Series, pd.Series]:
+    """
+    RSIの上昇幅・下落幅のEWM（増分計算ではこの末尾の値を状態として保存する）
+
+    new があれば差分はルックバックを含めて取り、EWMは new の行だけを seed から続けて計算する
+    """
     delta = series.diff()
+    if new is not None:
+        delta = delta[new]
     up = delta.clip(lower=0.0)
     down = -delta.clip(upper=0.0)
-    roll_up = up.ewm(alpha=1/period, adjust=False).mean()
-    roll_down = down.ewm(alpha=1/period, adjust=False).mean()
+    return ewm_from(up, 1/period, seed_up), ewm_from(down, 1/period, seed_down)
+
+
+def rsi_from_parts(roll_up: pd.Series, roll_down: pd.Series) -> pd.Series:
     rs = roll_up / (roll_down.replace(0, np.nan))
     return 100 - (100 / (1 + rs))
 
 
-def atr(df: pd.DataFrame, period: int = 14) -> pd.Series:
+def rsi(series: pd.Series, period: int = 14) -> pd.Series:
+    return rsi_from_parts(*rsi_parts(series, period))
+
+
+def true_range(df: pd.DataFrame) -> pd.Series:
     high, low, close = df["high"], df["low"], df["close"]
     prev_close = close.shift(1)
-    tr = pd.concat([(high-low), (high-prev_close).abs(), (low-prev_close).abs()], axis=1).max(axis=1)
-    return tr.ewm(alpha=1/period, adjust=False).mean()
+    return pd.concat([(high-low), (high-prev_close).abs(), (low-prev_close).abs()], axis=1).max(axis=1)
 
 
-def build_event_rolling(index_utc: pd.DatetimeIndex, events: pd.DataFrame, prefix: str, windows):
-    """Build rolling event features"""
-    out = pd.DataFrame(index=index_utc)
-    if events is None or events.empty:
-        for w in windows:
-            out[f"{prefix}_cnt_{w}"] = 0.0
-            out[f"{prefix}_sent_{w}"] = 0.0
-        return out
+def atr(df: pd.DataFrame, period: int = 14, seed: Optional[float] = None) -> pd.Series:
+    return ewm_from(true_range(df), 1/period, seed)
 
+
+def event_values(events: Optional[pd.DataFrame]) -> pd.DataFrame:
+    """イベントを (ts, val) の昇順にする（valは sentiment_w、その行に無ければ sentiment。欠損は0）"""
+    if events is None or events.empty:
+        return pd.DataFrame({"ts": pd.Series(dtype="datetime64[ns, UTC]"), "val": pd.Series(dtype=float)})
     ev = events.copy()
     ev["ts"] = pd.to_datetime(ev["ts"], utc=True, errors="coerce")
-    ev = ev.dropna(subset=["ts"]).sort_values("ts")
-    if ev.empty:
-        return out
+    ev = ev.dropna(subset=["ts"]).sort_values("ts", kind="stable")
 
-    # Use sentiment_w if available
-    if "sentiment_w" in ev.columns:
-        ev_val = ev[["ts", "sentiment_w"]].rename(columns={"sentiment_w": "val"})
-    else:
-        ev_val = ev[["ts", "sentiment"]].rename(columns={"sentiment": "val"})
-        ev_val["val"] = ev_val["val"].fillna(0.0)
+    # Use sentiment_w if available（イベントストアでは両方の列があり、無い行はNULL）
+    val = pd.Series(np.nan, index=ev.index)
+    for col in ("sentiment_w", "sentiment"):
+        if col in ev.columns:
+            val = val.fillna(pd.to_numeric(ev[col], errors="coerce"))
+    val = val.fillna(0.0)
+    return pd.DataFrame({"ts": ev["ts"], "val": val}).reset_index(drop=True)
 
-    # Bin to bar frequency
-    freq = pd.infer_freq(index_utc) or "T"
-    ev_val["bin"] = ev_val["ts"].dt.floor(freq)
-    b = ev_val.groupby("bin")["val"].agg(["count", "sum"]).rename(columns={"count": "cnt", "sum": "sum"})
-    b = b.reindex(index_utc, fill_value=0.0)
 
-    for w in windows:
-        out[f"{prefix}_cnt_{w}"] = b["cnt"].rolling(w, min_periods=1).sum().values
-        out[f"{prefix}_sent_{w}"] = b["sum"].rolling(w, min_periods=1).sum().values
+def pair_signed_events(events: Optional[pd.DataFrame], pair: Optional[str]) -> Optional[pd.DataFrame]:
+    """
+    マクロ指標の sentiment / sentiment_w をペアの方向で付け直す
 
-    return out
+    surprise のある行は surprise × 方向符号（event_direction のペアの分類器）× weight にする。
+    surprise の無い行（ニュースなど）と pair が None の場合は保存された値のまま
+    """
+    if pair is None or events is None or events.empty or "surprise" not in events.columns:
+        return events
+    surprise = pd.to_numeric(events["surprise"], errors="coerce")
+    has = surprise.notna().to_numpy()
+    if not has.any():
+        return events
+    ev = events.copy()
+    signs = pair_classifier(pair).signs(ev.loc[has, "event"], ev.loc[has, "country"])
+    sentiment = surprise.to_numpy()[has] * signs
+    weight = pd.to_numeric(ev.loc[has, "weight"], errors="coerce").to_numpy() if "weight" in ev.columns else np.nan
+    for col in ("sentiment", "sentiment_w"):
+        ev[col] = pd.to_numeric(ev[col], errors="coerce") if col in ev.columns else np.nan
+    ev.loc[has, "sentiment"] = sentiment
+    # weight が無ければ NaN のままにして event_values で sentiment を使う
+    ev.loc[has, "sentiment_w"] = sentiment * weight
+    return ev
 
 
-def main():
-    ap = argparse.ArgumentParser()
-    ap.add_argument("--bars", help="bars parquet path")
-    ap.add_argument("--out", help="output parquet path")
-    ap.add_argument("--events-cache", help="events cache parquet path")
-    ap.add_argument("--pair", help="currency pair (e.g., USDJPY)")
-    ap.add_argument("--timeframe", help="timeframe (e.g., M5, H1)")
-    ap.add_argument("--windows", default="15T,1H,6H,24H,72H,168H")
-    args = ap.parse_args()
+def window_deltas(windows) -> np.ndarray:
+    """窓（"15T", "24H" など）をナノ秒の配列にする"""
+    return np.array([pd.to_timedelta(w).value for w in windows], dtype=np.int64)
 
-    # 引数の組み合わせを処理
-    if args.pair and args.timeframe:
-        # --pair と --timeframe が指定された場合
-        pair = args.pair.upper()
-        tf = args.timeframe.upper()
-        
-        # バーファイルのパスを構築
-        bars_path = f"data/bars/{pair}/tf={tf}/all.parquet"
-        if not os.path.exists(bars_path):
-            # 日付別ディレクトリから読み込む
-            bars_dir = Path(f"data/bars/{pair}/tf={tf}")
-            bar_files = sorted(bars_dir.glob("date=*/part-*.parquet"))
-            if bar_files:
-                bars_list = []
-                for f in bar_files:
-                    bars_list.append(pd.read_parquet(f))
-                bars = pd.concat(bars_list, ignore_index=True)
-            else:
-                # フォールバック: Yahoo Financeデータを確認（H1の場合）
-                if tf == "H1":
-                    yahoo_path = Path(f"data/yahoo_finance/{pair}/1h.parquet")
-                    if yahoo_path.exists():
-                        print(f"[INFO] Using Yahoo Finance data from {yahoo_path}")
-                        bars = pd.read_parquet(yahoo_path)
-                        # タイムスタンプカラムを確認・修正
-                        if "ts" not in bars.columns:
-                            if isinstance(bars.index, pd.DatetimeIndex):
-                                bars = bars.reset_index()
-                                if bars.index.name == "ts" or len(bars.columns) > 0:
-                                    bars.columns = ["ts"] + list(bars.columns[1:])
-                        bars["ts"] = pd.to_datetime(bars["ts"], utc=True, errors="coerce")
-                    else:
-                        raise FileNotFoundError(f"No bars found for {pair} {tf}")
-                else:
-                    raise FileNotFoundError(f"No bars found for {pair} {tf}")
-        else:
-            bars = pd.read_parquet(bars_path)
-        
-        # 出力パスを構築
-        out_path = f"data/features/{pair}/{tf}_features.parquet"
-        
-        # イベントキャッシュのパス
-        events_cache = args.events_cache or "data/events/events_cache.parquet"
-    elif args.bars and args.out:
-        # 従来の引数形式
-        bars = pd.read_parquet(args.bars)
-        out_path = args.out
-        events_cache = args.events_cache
-    else:
-        ap.error("Either (--pair and --timeframe) or (--bars and --out) must be provided")
 
-    # Load bars
-    bars["ts"] = pd.to_datetime(bars["ts"], utc=True, errors="coerce")
-    bars = bars.dropna(subset=["ts"]).set_index("ts").sort_index()
+class EventTable:
+    """
+    カテゴリごとにイベント時刻（昇順）と件数・センチメントの累積和を持つ
+
+    バー時刻 t・窓 w の特徴量は t - w < ts <= t のイベントの件数と合計で、
+    累積和の2点の差（searchsorted）で求める（移動窓オブジェクトを使わず O(バー数 × 窓数)）。
+    マクロ指標のセンチメントはペアごとに符号が違うので、表はペアごとに作る
+    （--pairs ではイベントストアを1回だけ読み、全ペア分の表を作る）。
+    イベントストアから読んだ場合は path と読み込み時点の変更の通し番号 seq を持つ
+    """
+
+    CATEGORIES = ("news", "macro")
+
+    def __init__(self, events: Optional[pd.DataFrame] = None, categories=None, pair: Optional[str] = None):
+        """
+        Args:
+            categories: 持っておくカテゴリ（Noneならイベントにある全カテゴリ + news/macro）
+            pair: マクロ指標のセンチメントの符号を付けるペア（Noneなら保存された sentiment_w を使う）
+        """
+        events = pair_signed_events(events, pair)
+        self.pair = pair
+        has_cat = events is not None and not events.empty and "category" in events.columns
+        if categories is None:
+            found = events["category"].dropna().unique().tolist() if has_cat else []
+            categories = list(dict.fromkeys(list(self.CATEGORIES) + sorted(map(str, found))))
+        self.ts: dict = {}
+        self.cum_val: dict = {}
+        self.path: Optional[str] = None
+        self.seq: Optional[int] = None
+        for cat in categories:
+            ev_val = event_values(events[events["category"] == cat] if has_cat else None)
+            self.ts[cat] = ev_val["ts"].to_numpy(dtype="datetime64[ns]").view(np.int64)
+            self.cum_val[cat] = np.concatenate([[0.0], np.cumsum(ev_val["val"].to_numpy(dtype=np.float64))])
+
+    @classmethod
+    def from_path(cls, path: Optional[str], categories=None, pair: Optional[str] = None) -> "EventTable":
+        """イベントストア（--events-cache の値。Noneならイベント無し）から読み込む"""
+        return cls.for_pairs(path, [pair], categories)[pair]
+
+    @classmethod
+    def for_pairs(cls, path: Optional[str], pairs: List[Optional[str]], categories=None) -> Dict[str, "EventTable"]:
+        """ペアごとの表（イベントストアは1回だけ読む）"""
+        if not path:
+            return {pair: cls(pd.DataFrame(), categories, pair) for pair in pairs}
+        store = EventsStore.from_path(path)
+        # 通し番号は読み込みの前に取る（読み込み中に届いたイベントは次回に計算し直す）
+        seq = store.change_seq()
+        events = store.range(categories=categories, columns=EVENT_COLUMNS)
+        tables = {}
+        for pair in pairs:
+            table = tables[pair] = cls(events, categories, pair)
+            table.path, table.seq = str(store.path), seq
+        return tables
+
+    @property
+    def categories(self) -> list:
+        return list(self.ts)
+
+    def features(self, index_utc: pd.DatetimeIndex, windows, categories=None) -> pd.DataFrame:
+        """
+        全カテゴリ・全窓の特徴量（<cat>_cnt_<w>, <cat>_sent_<w>）を1回で計算する
+
+        Args:
+            index_utc: バー時刻（UTC、昇順）
+            windows: 窓の文字列のリスト（列名にそのまま使う）
+            categories: 計算するカテゴリ（Noneなら news/macro）
+        """
+        categories = list(categories or self.CATEGORIES)
+        t = np.asarray(index_utc.tz_convert("UTC").asi8 if index_utc.tz is not None else index_utc.asi8)
+        deltas = window_deltas(windows)
+        cols = {}
+        for cat in categories:
+            ts = self.ts.get(cat)
+            if ts is None or len(ts) == 0:
+                for w in windows:
+                    cols[f"{cat}_cnt_{w}"] = np.zeros(len(t))
+                    cols[f"{cat}_sent_{w}"] = np.zeros(len(t))
+                continue
+            cum = self.cum_val[cat]
+            hi = np.searchsorted(ts, t, side="right")
+            # 窓ごとの左端（t - w より後の最初のイベント）
+            lo = np.searchsorted(ts, t[None, :] - deltas[:, None], side="right")
+            for k, w in enumerate(windows):
+                cols[f"{cat}_cnt_{w}"] = (hi - lo[k]).astype(np.float64)
+                cols[f"{cat}_sent_{w}"] = cum[hi] - cum[lo[k]]
+        return pd.DataFrame(cols, index=index_utc)
 
-    # Technical features
+
+def build_event_rolling(index_utc: pd.DatetimeIndex, events: Optional[pd.DataFrame], prefix: str, windows):
+    """Build rolling event features for one category of events (t - w < ts <= t)"""
+    table = EventTable(pd.DataFrame() if events is None else events.assign(category=prefix), categories=[prefix])
+    return table.features(index_utc, windows, categories=[prefix])
+
+
+def compute_features(bars: pd.DataFrame, events: Union[pd.DataFrame, EventTable], windows,
+                     state: Optional[dict] = None) -> Tuple[pd.DataFrame, dict]:
+    """
+    バー（tsインデックス、昇順）から特徴量を計算する（events は EventTable でもよい）
+
+    state があれば bars は state["ts"] 以前のルックバックを含み、
+    RSI/ATRのEWMを状態から続けて計算し、state["ts"] より後の行だけを返す
+
+    Returns:
+        (特徴量, 返した行ごとのRSI/ATRのEWMの値)
+    """
+    if state is not None:
+        new = bars.index > pd.Timestamp(state["ts"])
+    else:
+        new = np.ones(len(bars), dtype=bool)
+
+    # Technical features（移動窓はルックバックを含めて計算し、新しい行だけを残す）
     feat = pd.DataFrame(index=bars.index)
     feat["logret_1"] = np.log(bars["close"]).diff()
-    for n in [5, 20, 60]:
+    for n in MA_WINDOWS:
         feat[f"ma_{n}"] = bars["close"].rolling(n).mean()
         feat[f"vol_{n}"] = feat["logret_1"].rolling(n).std()
+    vol_roll = feat["vol_20"].rolling(REGIME_WINDOW, min_periods=REGIME_MIN_PERIODS)
+    for col, q in VOL_REGIME_QUANTILES.items():
+        feat[col] = vol_roll.quantile(q)
 
-    feat["rsi_14"] = rsi(bars["close"], 14)
-    feat["atr_14"] = atr(bars, 14)
+    # RSI/ATRは再帰的なので、状態（直前のEWMの値）から新しい行だけを計算する
+    tr = true_range(bars)
+    if state is not None:
+        up_new, down_new = rsi_parts(bars["close"], RSI_PERIOD, state["rsi_up"], state["rsi_down"], new=new)
+        atr_new = ewm_from(tr[new], 1/ATR_PERIOD, state["atr"])
+    else:
+        up_new, down_new = rsi_parts(bars["close"], RSI_PERIOD)
+        atr_new = ewm_from(tr, 1/ATR_PERIOD)
+
+    feat = feat[new]
+    feat["rsi_14"] = rsi_from_parts(up_new, down_new)
+    feat["atr_14"] = atr_new
 
     # Time features
     idx = feat.index
@@ -142,22 +273,353 @@ def main():
 
     # Spread features
     if "spread" in bars.columns:
-        feat["spread"] = bars["spread"]
-        feat["spread_ma_60"] = bars["spread"].rolling(60).mean()
+        feat["spread"] = bars["spread"][new]
+        feat["spread_ma_60"] = bars["spread"].rolling(SPREAD_MA_WINDOW).mean()[new]
+
+    # Event features（イベント時刻から直接求めるので新しい行だけ計算すればよい）
+    table = events if isinstance(events, EventTable) else EventTable(events)
+    feat = feat.join(table.features(feat.index, windows))
+
+    ewm = {"rsi_up": up_new.to_numpy(), "rsi_down": down_new.to_numpy(), "atr": atr_new.to_numpy()}
+    return feat, ewm
+
+
+def next_state(bars: pd.DataFrame, feat: pd.DataFrame, ewm: dict, windows,
+               events_seq: Optional[int] = None) -> Optional[dict]:
+    """
+    次回の増分計算の状態
+
+    最後のバーは未確定（次回のバー更新で値が変わる）ことがあるため、
+    最後から2本目の時点の状態を保存し、次回は最後のバーから計算し直す
+    events_seq は計算に使ったイベントストアの変更の通し番号（次回はそれ以降の変更を計算し直す）
+    """
+    if len(feat) < 2:
+        return None
+    ts = feat.index[-2]
+    pos = bars.index.get_loc(ts)
+    # イベントの窓はイベント時刻から求めるので、ルックバックはバーの移動窓の分だけでよい
+    lookback_from = bars.index[max(0, pos - MAX_BAR_WINDOW)]
+    return {
+        "ts": ts.isoformat(),
+        "lookback_from": lookback_from.isoformat(),
+        "close": float(bars["close"].iloc[pos]),
+        "rsi_up": float(ewm["rsi_up"][-2]),
+        "rsi_down": float(ewm["rsi_down"][-2]),
+        "atr": float(ewm["atr"][-2]),
+        "event_engine": EVENT_ENGINE,
+        "events_seq": events_seq,
+        "windows": list(windows),
+        "columns": feat.columns.tolist(),
+    }
+
+
+def load_state(store: FeatureStore) -> Optional[dict]:
+    path = store.path / STATE_FILE
+    if not path.exists():
+        return None
+    with open(path, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def save_state(store: FeatureStore, state: Optional[dict]):
+    path = store.path / STATE_FILE
+    if state is None:
+        path.unlink(missing_ok=True)
+        return
+    store.path.mkdir(parents=True, exist_ok=True)
+    tmp = store.path / (STATE_FILE + ".tmp")
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(state, f, indent=2)
+    os.replace(tmp, path)
+
+
+def load_bars(pair: str, tf: str, since: Optional[pd.Timestamp] = None) -> pd.DataFrame:
+    """
+    data/bars/<PAIR>/tf=<TF> のバーを読み込む（sinceがあればその時点を含むパーティション以降のみ）
+    旧形式の all.parquet はパーティションが1つも無いときだけ読む（全件を読むので since は効かない）
+    """
+    bars_dir = Path(f"data/bars/{pair}/tf={tf}")
+    bar_files = sorted(bars_dir.glob("date=*/part-*.parquet")) or sorted(bars_dir.glob("month=*/part-*.parquet"))
+    if since is not None:
+        day, month = since.strftime("%Y-%m-%d"), since.strftime("%Y-%m")
+        bar_files = [f for f in bar_files
+                     if f.parent.name.split("=", 1)[1] >= (day if f.parent.name.startswith("date=") else month)]
+    if bar_files:
+        return pd.concat([pd.read_parquet(f) for f in bar_files], ignore_index=True)
+
+    legacy_path = bars_dir / "all.parquet"
+    if legacy_path.exists():
+        return pd.read_parquet(legacy_path)
+
+    # フォールバック: Yahoo Financeデータを確認（H1の場合）
+    if tf == "H1":
+        yahoo_path = Path(f"data/yahoo_finance/{pair}/1h.parquet")
+        if yahoo_path.exists():
+            print(f"[INFO] Using Yahoo Finance data from {yahoo_path}")
+            bars = pd.read_parquet(yahoo_path)
+            # タイムスタンプカラムを確認・修正
+            if "ts" not in bars.columns:
+                if isinstance(bars.index, pd.DatetimeIndex):
+                    bars = bars.reset_index()
+                    if bars.index.name == "ts" or len(bars.columns) > 0:
+                        bars.columns = ["ts"] + list(bars.columns[1:])
+            bars["ts"] = pd.to_datetime(bars["ts"], utc=True, errors="coerce")
+            return bars
+    raise FileNotFoundError(f"No bars found for {pair} {tf}")
+
+
+def usable_state(state: Optional[dict], windows, bars: pd.DataFrame) -> bool:
+    """保存された状態で増分計算できるか（窓の設定が同じで、ルックバックのバーが揃っている）"""
+    if state is None or state.get("windows") != list(windows):
+        return False
+    if state.get("event_engine") != EVENT_ENGINE:
+        return False
+    # イベントの変更の通し番号が無い頃の状態は、それ以前の遅れたイベントを反映できているか分からない
+    if "events_seq" not in state:
+        return False
+    if ("spread" in bars.columns) != ("spread" in state.get("columns", [])):
+        return False
+    # 分位点の列が無い頃の状態はルックバックが足りない
+    if not set(VOL_REGIME_QUANTILES) <= set(state.get("columns", [])):
+        return False
+    ts = pd.Timestamp(state["ts"])
+    if ts not in bars.index or bars.index[0] > pd.Timestamp(state["lookback_from"]):
+        return False
+    # 状態の時点の終値が変わっていれば（バーの取り直しなど）全件計算する
+    return bool(np.isclose(bars.at[ts, "close"], state["close"], rtol=0, atol=1e-12))
+
+
+def events_seq(events: Union[EventTable, str, None]) -> Optional[int]:
+    """イベントストアの変更の通し番号（EventTable は読み込み時点。イベント無しなら None）"""
+    if isinstance(events, EventTable):
+        return events.seq
+    return EventsStore.from_path(events).change_seq() if events else None
+
+
+def events_changed_from(state: dict, events: Union[EventTable, str, None],
+                        seq: Optional[int]) -> Union[pd.Timestamp, bool, None]:
+    """
+    前回の計算以降に変わったイベントが影響する最初のバー時刻
+
+    Returns:
+        pd.Timestamp: その時刻以降の保存済みの行のイベント特徴量を計算し直す
+        None: 計算し直す行は無い
+        True: 変更を追えない（イベントストアが作り直された・変更の記録が消された・初めて使うなど）ので全件計算する
+    """
+    prev = state.get("events_seq")
+    if seq == prev:
+        return None
+    if seq is None or prev is None or seq < prev:
+        return True
+    path = events.path if isinstance(events, EventTable) else events
+    events_store = EventsStore.from_path(path)
+    if prev < events_store.changes_floor():
+        return True
+    changed = events_store.changed_since(prev, upto=seq)
+    # 時刻 ts のイベントが影響するのは t - w < ts <= t のバー、つまり ts 以降のバーだけ
+    if changed is None or changed > pd.Timestamp(state["ts"]):
+        return None
+    return changed
+
+
+def compact_event_changes(events: Union[EventTable, str, None], root: Union[str, Path] = FEATURES_ROOT) -> int:
+    """
+    root 以下の全ての特徴量ストアの状態が読み終えたイベントの変更の記録を消す（消した件数）
+
+    最も遅れた状態でも EVENT_CHANGES_RETAIN 件より前の変更は消す（その特徴量ストアは次回に全件計算し直す）
+    """
+    path = events.path if isinstance(events, EventTable) else events
+    if not path:
+        return 0
+    seqs = []
+    for state_path in Path(root).glob(f"*/tf=*/{STATE_FILE}"):
+        try:
+            with open(state_path, "r", encoding="utf-8") as f:
+                seq = json.load(f).get("events_seq")
+        except (OSError, ValueError):
+            continue
+        if seq is not None:
+            seqs.append(seq)
+    events_store = EventsStore.from_path(path)
+    latest = events_store.change_seq()
+    upto = min(max(min(seqs, default=0), latest - EVENT_CHANGES_RETAIN), latest)
+    if upto <= 0:
+        return 0
+    pruned = events_store.prune_changes(upto)
+    if pruned:
+        print(f"[INFO] pruned {pruned} event changes up to seq {upto}")
+    return pruned
+
+
+def refresh_event_features(store: FeatureStore, events: EventTable, windows,
+                           start: pd.Timestamp, end: pd.Timestamp) -> pd.DataFrame:
+    """保存済みの start <= ts <= end の行のイベント特徴量を計算し直した行（tsインデックス）"""
+    saved = store.range(start, end).set_index("ts")
+    if saved.empty:
+        return saved
+    ev = events.features(saved.index, windows)
+    saved[ev.columns] = ev
+    return saved
+
+
+def update_features(bars: pd.DataFrame, store: Optional[FeatureStore], out_path: Optional[str],
+                    state: Optional[dict], events: Union[EventTable, str, None], windows,
+                    pair: Optional[str] = None) -> dict:
+    """
+    バーから特徴量を計算して書き出す（state があれば増分）
+
+    events は EventTable か イベントキャッシュのパス（最新なら読み込まない。pair の方向で読み込む）
+    前回以降にイベントが遅れて届いた・更新された場合は、影響する保存済みの行のイベント特徴量も計算し直す
+    """
+    bars["ts"] = pd.to_datetime(bars["ts"], utc=True, errors="coerce")
+    bars = bars.dropna(subset=["ts"]).set_index("ts").sort_index()
+
+    if state is not None and not usable_state(state, windows, bars):
+        print("[INFO] Saved feature state does not match the bars. Recomputing all bars.")
+        state = None
+    seq = events_seq(events)
+    refresh_from = None
+    if state is not None:
+        refresh_from = events_changed_from(state, events, seq)
+        if refresh_from is True:
+            print("[INFO] Events store changed in a way that cannot be tracked. Recomputing all bars.")
+            state, refresh_from = None, None
+    if state is not None:
+        bars = bars[bars.index >= pd.Timestamp(state["lookback_from"])]
+        if not (bars.index > pd.Timestamp(state["ts"])).any() and refresh_from is None:
+            if state.get("events_seq") != seq:
+                save_state(store, {**state, "events_seq": seq})
+            print(f"[OK] features up to date ({state['ts']})")
+            return {"path": str(store.path), "mode": "up_to_date", "rows": 0, "cols": None, "last_ts": state["ts"]}
 
     # Event features
-    events = pd.read_parquet(events_cache) if events_cache and os.path.exists(events_cache) else pd.DataFrame()
+    if not isinstance(events, EventTable):
+        events = EventTable.from_path(events, pair=pair)
+        seq = events.seq
+
+    feat, ewm = compute_features(bars, events, windows, state)
+
+    refreshed = 0
+    if refresh_from is not None:
+        old = refresh_event_features(store, events, windows, refresh_from, pd.Timestamp(state["ts"]))
+        refreshed = len(old)
+        feat = pd.concat([old[feat.columns], feat]) if len(feat) else old
+        print(f"[INFO] events changed since the last run; recomputing event features from {refresh_from} "
+              f"(rows={refreshed})")
+
+    if store is not None:
+        if state is not None:
+            store.append(feat)
+            print(f"[OK] appended features {store.path} new_rows={len(feat) - refreshed} since={state['ts']} "
+                  f"refreshed_rows={refreshed} cols={feat.shape[1]}")
+        else:
+            months = store.write(feat)
+            print(f"[OK] wrote features {store.path} months={months} rows={len(feat)} cols={feat.shape[1]}")
+        new_state = next_state(bars, feat[feat.index > pd.Timestamp(state["ts"])] if state is not None else feat,
+                               ewm, windows, seq)
+        if new_state is not None or state is None:
+            save_state(store, new_state)
+        else:
+            # 新しい行が1本だけ（最後のバーの再計算のみ）なら今の状態がそのまま使える
+            save_state(store, {**state, "events_seq": seq})
+        out_path = str(store.path)
+    else:
+        os.makedirs(os.path.dirname(out_path) or ".", exist_ok=True)
+        feat.reset_index().to_parquet(out_path, index=False)
+        print(f"[OK] wrote features {out_path} rows={len(feat)} cols={feat.shape[1]}")
+
+    return {
+        "path": out_path,
+        "mode": "incremental" if state is not None else "full",
+        "rows": len(feat),
+        "refreshed_rows": refreshed,
+        "cols": feat.shape[1],
+        "last_ts": feat.index[-1].isoformat() if len(feat) else None,
+    }
+
+
+def build_pair_features(pair: str, tf: str, windows, events: Union[EventTable, str, None],
+                        full: bool = False) -> dict:
+    """data/bars/<PAIR>/tf=<TF> から特徴量ストア（data/features/<PAIR>/tf=<TF>/month=*/）を更新する"""
+    store = FeatureStore(pair, tf)
+    state = None if full else load_state(store)
+    since = pd.Timestamp(state["lookback_from"]) if state else None
+    bars = load_bars(pair, tf, since)
+    result = update_features(bars, store, None, state, events, windows, pair=pair)
+    return {"pair": pair, **result}
+
+
+# --pairs のワーカープロセスで使うペアごとのイベントの表（プールの初期化時に1回だけ受け取る）
+_SHARED_EVENTS: Dict[str, EventTable] = {}
+
+
+def _set_shared_events(tables: Dict[str, EventTable]):
+    global _SHARED_EVENTS
+    _SHARED_EVENTS = tables
+
+
+def _build_shared(pair: str, tf: str, windows, full: bool) -> dict:
+    return build_pair_features(pair, tf, windows, _SHARED_EVENTS[pair], full=full)
+
+
+def run(argv: Optional[list] = None) -> dict:
+    """
+    ジョブのエントリポイント（app.run_job からプロセスプール内で呼ばれる）
+
+    Returns:
+        {"path", "mode", "rows", "cols", "last_ts"}
+        --pairs の場合は fx_pairs.run_per_pair のレポート（ペアごとに上記 + "pair"）
+    """
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--bars", help="bars parquet path")
+    ap.add_argument("--out", help="output parquet path")
+    ap.add_argument("--events-cache", help="events store path (.sqlite, or a legacy events_cache.parquet to migrate)")
+    ap.add_argument("--pair", help="currency pair (e.g., USDJPY)")
+    ap.add_argument("--pairs", help="comma separated pairs (or 'all'); events are loaded once for all pairs")
+    ap.add_argument("--workers", type=int, default=1, help="worker processes to spread --pairs over")
+    ap.add_argument("--timeframe", help="timeframe (e.g., M5, H1)")
+    ap.add_argument("--windows", default="15T,1H,6H,24H,72H,168H")
+    ap.add_argument("--full", action="store_true", help="Recompute all bars instead of appending new ones")
+    args = ap.parse_args(argv)
+
     windows = [w.strip() for w in args.windows.split(",") if w.strip()]
+    # イベントストアのパス
+    events_cache = args.events_cache or EVENTS_DB
 
-    news = events[events.get("category", "") == "news"] if not events.empty else pd.DataFrame()
-    macro = events[events.get("category", "") == "macro"] if not events.empty else pd.DataFrame()
+    # 引数の組み合わせを処理
+    if args.pairs and args.timeframe:
+        # 複数ペア: イベントは親プロセスで1回だけ読み込み、ペアごとの方向で累積和にしておく
+        tf = args.timeframe.upper()
+        pairs = parse_pairs(pairs=args.pairs)
+        tables = EventTable.for_pairs(events_cache, pairs)
+        build = partial(_build_shared, tf=tf, windows=windows, full=args.full)
+        report = run_per_pair("build_features", build, pairs, workers=args.workers,
+                              initializer=_set_shared_events, initargs=(tables,))
+        compact_event_changes(events_cache)
+        return report
+    elif args.pair and args.timeframe:
+        # --pair と --timeframe が指定された場合
+        result = build_pair_features(args.pair.upper(), args.timeframe.upper(), windows, events_cache,
+                                     full=args.full)
+        compact_event_changes(events_cache)
+        return result
+    elif args.bars and args.out:
+        # 従来の引数形式
+        bars = pd.read_parquet(args.bars)
+        # <TF>_features.parquet 形式の出力先は同じ場所の特徴量ストアに書く
+        store = FeatureStore.from_path(args.out)
+        state = None if args.full or store is None else load_state(store)
+        pair = args.pair.upper() if args.pair else (store.pair if store is not None else None)
+        result = update_features(bars, store, args.out, state, args.events_cache, windows, pair=pair)
+        if store is not None:
+            compact_event_changes(args.events_cache, store.root)
+        return result
+    else:
+        ap.error("Either (--pair/--pairs and --timeframe) or (--bars and --out) must be provided")
 
-    feat = feat.join(build_event_rolling(feat.index, news, "news", windows))
-    feat = feat.join(build_event_rolling(feat.index, macro, "macro", windows))
 
-    os.makedirs(os.path.dirname(out_path), exist_ok=True)
-    feat.reset_index().to_parquet(out_path, index=False)
-    print(f"[OK] wrote features {out_path} rows={len(feat)} cols={feat.shape[1]}")
+def main():
+    run()
 
 
 if __name__ == "__main__":
@@ -5,16 +5,35 @@ from __future__ import annotations
 import argparse
 import lzma
 import struct
+import sys
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from datetime import datetime, timezone, timedelta
+from functools import partial
 from pathlib import Path
 
+import numpy as np
 import pandas as pd
 
+sys.path.insert(0, str(Path(__file__).parent.parent))
+
+from fx_pairs import bi5_price_scale, parse_pairs, run_per_pair
+from jobs.bi5_manifest import Bi5Manifest
+
 RECORD = struct.Struct(">3I2f")  # time(ms), ask(int), bid(int), askVol(float), bidVol(float)
 
+# RECORDと同じレイアウトの構造化dtype（ビッグエンディアン、1レコード20バイト）
+RECORD_DTYPE = np.dtype([
+    ("t_ms", ">u4"),
+    ("ask", ">u4"),
+    ("bid", ">u4"),
+    ("ask_vol", ">f4"),
+    ("bid_vol", ">f4"),
+])
+assert RECORD_DTYPE.itemsize == RECORD.size
 
-def parse_bi5(path: Path, price_scale: int) -> pd.DataFrame:
-    """Parse .bi5 file to tick DataFrame"""
+
+def hour_base(path: Path) -> datetime:
+    """bi5ファイルのパスからその時間の開始時刻（UTC）を求める"""
     parts = path.parts
     hour = int(path.name.split("h_")[0])
     # パス構造: data/raw_bi5/USDJPY/2026/00/27/10h_ticks.bi5
@@ -22,7 +41,37 @@ def parse_bi5(path: Path, price_scale: int) -> pd.DataFrame:
     year = int(parts[-4])
     month0 = int(parts[-3])  # 00-11
     day = int(parts[-2])
-    base = datetime(year, month0 + 1, day, hour, 0, 0, tzinfo=timezone.utc)
+    return datetime(year, month0 + 1, day, hour, 0, 0, tzinfo=timezone.utc)
+
+
+def decode_ticks(buf: bytes, base: datetime, price_scale: int) -> pd.DataFrame:
+    """解凍済みbi5バッファをティックDataFrameに変換（行ごとのPython処理なし）"""
+    record_count = len(buf) // RECORD_DTYPE.itemsize
+    if record_count == 0:
+        return pd.DataFrame()
+
+    # バッファをコピーせずに構造化配列として参照する（末尾の端数バイトは無視）
+    rec = np.frombuffer(buf, dtype=RECORD_DTYPE, count=record_count)
+
+    base_ns = pd.Timestamp(base).value
+    ts_ns = base_ns + rec["t_ms"].astype(np.int64) * 1_000_000
+
+    df = pd.DataFrame({
+        "ts": pd.DatetimeIndex(ts_ns.view("datetime64[ns]"), tz="UTC"),
+        "bid": rec["bid"] / price_scale,
+        "ask": rec["ask"] / price_scale,
+        "bid_vol": rec["bid_vol"].astype(np.float64),
+        "ask_vol": rec["ask_vol"].astype(np.float64),
+    })
+    df = df.sort_values("ts")
+    df["mid"] = (df["bid"] + df["ask"]) / 2.0
+    df["spread"] = df["ask"] - df["bid"]
+    return df
+
+
+def parse_bi5(path: Path, price_scale: int) -> pd.DataFrame:
+    """Parse .bi5 file to tick DataFrame"""
+    base = hour_base(path)
 
     try:
         with lzma.open(path, "rb") as f:
@@ -36,33 +85,9 @@ def parse_bi5(path: Path, price_scale: int) -> pd.DataFrame:
         traceback.print_exc()
         return pd.DataFrame()
 
-    rows = []
-    record_count = len(buf) // RECORD.size
-    if record_count == 0:
+    df = decode_ticks(buf, base, price_scale)
+    if df.empty:
         print(f"[WARN] No records in {path}")
-        return pd.DataFrame()
-    
-    print(f"[DEBUG] Processing {record_count} records from {path.name}")
-    for off in range(0, len(buf), RECORD.size):
-        if off + RECORD.size > len(buf):
-            break
-        try:
-            t_ms, ask_i, bid_i, ask_v, bid_v = RECORD.unpack_from(buf, off)
-            ts = base + timedelta(milliseconds=int(t_ms))
-            ask = ask_i / price_scale
-            bid = bid_i / price_scale
-            rows.append((ts, bid, ask, float(bid_v), float(ask_v)))
-        except Exception as e:
-            print(f"[WARN] Failed to unpack record at offset {off}: {e}")
-            continue
-
-    if not rows:
-        return pd.DataFrame()
-
-    df = pd.DataFrame(rows, columns=["ts", "bid", "ask", "bid_vol", "ask_vol"])
-    df = df.sort_values("ts")
-    df["mid"] = (df["bid"] + df["ask"]) / 2.0
-    df["spread"] = df["ask"] - df["bid"]
     return df
 
 
@@ -82,52 +107,152 @@ def ticks_to_m1(ticks: pd.DataFrame) -> pd.DataFrame:
     return out.dropna(subset=["open","high","low","close"])
 
 
-def main():
+def hour_to_m1(path: Path, price_scale: int) -> pd.DataFrame:
+    """1時間分のbi5をM1バーに変換（ワーカープロセスからも呼ばれる）"""
+    ticks = parse_bi5(path, price_scale=price_scale)
+    if ticks.empty:
+        return pd.DataFrame()
+    return ticks_to_m1(ticks)
+
+
+def day_bi5_files(in_root: Path, day: datetime) -> list:
+    """指定日の時間別bi5ファイル一覧"""
+    return sorted((in_root / f"{day.year}" / f"{day.month-1:02d}" / f"{day.day:02d}").glob("*h_ticks.bi5"))
+
+
+def write_day(out_root: Path, day_str: str, m1_list: list) -> int:
+    """1日分のM1をdate=パーティションに書き出す"""
+    m1_list = [m1 for m1 in m1_list if not m1.empty]
+    if not m1_list:
+        print(f"[WARN] no M1 data for {day_str}")
+        return 0
+
+    m1_all = pd.concat(m1_list).sort_index()
+    out_dir = out_root / f"date={day_str}"
+    out_dir.mkdir(parents=True, exist_ok=True)
+    out_path = out_dir / "part-000.parquet"
+    df_out = m1_all.reset_index().rename(columns={"ts": "ts"})
+    df_out.to_parquet(out_path, index=False)
+    print(f"[OK] wrote {out_path} rows={len(df_out)}")
+    return len(df_out)
+
+
+def build_days_serial(days: dict, out_root: Path, price_scale: int, on_written=None) -> dict:
+    """日ごとの書き出し行数を返す"""
+    rows = {}
+    for day_str, bi5s in days.items():
+        rows[day_str] = write_day(out_root, day_str, [hour_to_m1(f, price_scale) for f in bi5s])
+        if on_written:
+            on_written(day_str)
+    return rows
+
+
+def build_days_parallel(days: dict, out_root: Path, price_scale: int, workers: int, on_written=None) -> dict:
+    """
+    全日の時間ファイルをプロセスプールに投入し、
+    その日の全時間が揃った時点でパーティションを書き出す（日ごとの書き出し行数を返す）
+    """
+    pending = {day_str: len(bi5s) for day_str, bi5s in days.items()}
+    results = {day_str: [] for day_str in days}
+    rows = {}
+
+    with ProcessPoolExecutor(max_workers=workers) as ex:
+        futures = {}
+        for day_str, bi5s in days.items():
+            for f in bi5s:
+                futures[ex.submit(hour_to_m1, f, price_scale)] = (day_str, f)
+
+        for fut in as_completed(futures):
+            day_str, f = futures[fut]
+            try:
+                results[day_str].append(fut.result())
+            except Exception as e:
+                print(f"[ERROR] Failed to convert {f}: {e}")
+            pending[day_str] -= 1
+            if pending[day_str] == 0:
+                rows[day_str] = write_day(out_root, day_str, results.pop(day_str))
+                if on_written:
+                    on_written(day_str)
+    return rows
+
+
+def build_pair(pair: str, in_root: Path, out_root: Path, start: datetime, end: datetime,
+               price_scale: int | None = None, workers: int = 1, changed_only: bool = False) -> dict:
+    """1ペア分のM1を作る（--pairs ではペアごとにプロセスプールで呼ばれる）"""
+    price_scale = price_scale or bi5_price_scale(pair)
+    pair_in = in_root / pair
+    pair_out = out_root / pair / "tf=M1"
+
+    days = {}
+    day = start
+    while day < end:
+        day_str = day.strftime("%Y-%m-%d")
+        bi5s = day_bi5_files(pair_in, day)
+        if bi5s:
+            days[day_str] = bi5s
+        else:
+            print(f"[WARN] {pair}: no bi5 for {day_str}")
+        day += timedelta(days=1)
+
+    with Bi5Manifest(pair_in) as manifest:
+        if changed_only:
+            changed = set(manifest.changed_days(days))
+            print(f"[INFO] {pair}: {len(changed)}/{len(days)} days changed since last M1 build")
+            days = {d: f for d, f in days.items() if d in changed}
+
+        if workers > 1:
+            rows = build_days_parallel(days, pair_out, price_scale, workers, on_written=manifest.mark_built)
+        else:
+            rows = build_days_serial(days, pair_out, price_scale, on_written=manifest.mark_built)
+
+    return {
+        "pair": pair,
+        "out_root": str(pair_out),
+        "days": sorted(d for d, n in rows.items() if n > 0),
+        "rows": sum(rows.values()),
+    }
+
+
+def run(argv: list | None = None) -> dict:
+    """
+    ジョブのエントリポイント（app.run_job からプロセスプール内で呼ばれる）
+
+    Returns:
+        {"pair", "out_root", "days", "rows"}
+        --pairs の場合は fx_pairs.run_per_pair のレポート（ペアごとに上記）
+    """
     ap = argparse.ArgumentParser()
-    ap.add_argument("--pair", required=True)
+    ap.add_argument("--pair")
+    ap.add_argument("--pairs", help="comma separated pairs (or 'all') to build in one run")
     ap.add_argument("--in-root", default="data/raw_bi5")
     ap.add_argument("--out-root", default="data/bars")
-    ap.add_argument("--price-scale", type=int, default=1000, help="USDJPY: 1000 or 100000")
+    ap.add_argument("--price-scale", type=int, default=None,
+                    help="price divisor of bi5 integers (default: 1000 for JPY pairs, 100000 otherwise)")
     ap.add_argument("--start-date", required=True, help="UTC date like 2025-01-01")
     ap.add_argument("--end-date", required=True, help="UTC date like 2025-01-03 (exclusive)")
-    args = ap.parse_args()
-
-    pair = args.pair.upper()
-    in_root = Path(args.in_root) / pair
-    out_root = Path(args.out_root) / pair / "tf=M1"
+    ap.add_argument("--workers", type=int, default=1,
+                    help="parallel worker processes (1 = serial). With --pairs, pairs are spread over the workers")
+    ap.add_argument("--changed-only", action="store_true",
+                    help="only rebuild days whose bi5 files changed since the last M1 build (per download manifest)")
+    args = ap.parse_args(argv)
 
+    pairs = parse_pairs(args.pair, args.pairs)
+    if not pairs:
+        ap.error("--pair or --pairs is required")
     start = datetime.fromisoformat(args.start_date).replace(tzinfo=timezone.utc)
     end = datetime.fromisoformat(args.end_date).replace(tzinfo=timezone.utc)
 
-    day = start
-    while day < end:
-        day_str = day.strftime("%Y-%m-%d")
-        bi5s = sorted((in_root / f"{day.year}" / f"{day.month-1:02d}" / f"{day.day:02d}").glob("*h_ticks.bi5"))
-        if not bi5s:
-            print(f"[WARN] no bi5 for {day_str}")
-            day += timedelta(days=1)
-            continue
-
-        m1_list = []
-        for f in bi5s:
-            ticks = parse_bi5(f, price_scale=args.price_scale)
-            if not ticks.empty:
-                m1 = ticks_to_m1(ticks)
-                if not m1.empty:
-                    m1_list.append(m1)
-
-        if m1_list:
-            m1_all = pd.concat(m1_list).sort_index()
-            out_dir = out_root / f"date={day_str}"
-            out_dir.mkdir(parents=True, exist_ok=True)
-            out_path = out_dir / "part-000.parquet"
-            df_out = m1_all.reset_index().rename(columns={"ts": "ts"})
-            df_out.to_parquet(out_path, index=False)
-            print(f"[OK] wrote {out_path} rows={len(df_out)}")
-        else:
-            print(f"[WARN] no M1 data for {day_str}")
+    build = partial(build_pair, in_root=Path(args.in_root), out_root=Path(args.out_root),
+                    start=start, end=end, price_scale=args.price_scale,
+                    changed_only=args.changed_only)
+    if args.pairs is None:
+        return build(pairs[0], workers=args.workers)
+    # ペア単位でプロセスに割り振る（ペア内は直列）
+    return run_per_pair("build_m1_from_bi5", build, pairs, workers=args.workers)
 
-        day += timedelta(days=1)
+
+def main():
+    run()
 
 
 if __name__ == "__main__":
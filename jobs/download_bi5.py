@@ -2,71 +2,233 @@
 # -*- coding: utf-8 -*-
 
 import argparse
+import hashlib
+import os
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta, timezone
+from functools import partial
 from pathlib import Path
 
 import requests
+from requests.adapters import HTTPAdapter
+
+sys.path.insert(0, str(Path(__file__).parent.parent))
+
+from fx_pairs import parse_pairs, run_per_pair
+from jobs.bi5_manifest import (
+    Bi5Manifest, STATUS_EMPTY, STATUS_ERROR, STATUS_MISSING, STATUS_OK, hour_key,
+)
 
 
 BASE = "https://datafeed.dukascopy.com/datafeed"
 
+DEFAULT_CONCURRENCY = 8
+DEFAULT_RETRIES = 3
+DEFAULT_BACKOFF_SEC = 1.0
+CHUNK_SIZE = 64 * 1024
+
+
+class RetryableError(Exception):
+    """5xxなど、時間をおいて再試行すべき失敗"""
+
 
 def month0(dt: datetime) -> str:
     """Dukascopyは月が0始まり（01月=00）"""
     return f"{dt.month - 1:02d}"
 
 
-def bi5_url(pair: str, dt_utc: datetime) -> str:
+def bi5_url(pair: str, dt_utc: datetime, base: str = BASE) -> str:
     y = dt_utc.year
     m = month0(dt_utc)
     d = f"{dt_utc.day:02d}"
     h = f"{dt_utc.hour:02d}"
-    return f"{BASE}/{pair}/{y}/{m}/{d}/{h}h_ticks.bi5"
-
-
-def download(url: str, out_path: Path, timeout: int = 60) -> bool:
+    return f"{base}/{pair}/{y}/{m}/{d}/{h}h_ticks.bi5"
+
+
+def bi5_path(out_root: Path, dt_utc: datetime) -> Path:
+    return out_root / f"{dt_utc.year}" / month0(dt_utc) / f"{dt_utc.day:02d}" / f"{dt_utc.hour:02d}h_ticks.bi5"
+
+
+def make_session(pool_size: int = DEFAULT_CONCURRENCY) -> requests.Session:
+    """接続を使い回すためのSession（プールサイズは同時実行数に合わせる）"""
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+def _fetch_to(session: requests.Session, url: str, out_path: Path, timeout: int) -> tuple:
+    """
+    レスポンスを一時ファイルにストリーミングし、完了後にリネームする
+    （途中で失敗したファイルが st_size > 0 のスキップ判定を通らないように）
+
+    Returns:
+        (status, size, sha256)
+    """
+    with session.get(url, timeout=timeout, stream=True) as r:
+        if r.status_code >= 500:
+            raise RetryableError(f"HTTP {r.status_code}")
+        if r.status_code != 200:
+            return STATUS_MISSING, 0, None
+
+        fd, tmp_name = tempfile.mkstemp(dir=out_path.parent, prefix=out_path.name, suffix=".part")
+        tmp = Path(tmp_name)
+        try:
+            size = 0
+            digest = hashlib.sha256()
+            with os.fdopen(fd, "wb") as f:
+                for chunk in r.iter_content(chunk_size=CHUNK_SIZE):
+                    f.write(chunk)
+                    digest.update(chunk)
+                    size += len(chunk)
+            if size == 0:
+                return STATUS_EMPTY, 0, None
+            os.replace(tmp, out_path)
+            return STATUS_OK, size, digest.hexdigest()
+        finally:
+            tmp.unlink(missing_ok=True)
+
+
+def fetch_hour(url: str, out_path: Path, timeout: int = 60,
+               session: requests.Session = None,
+               retries: int = DEFAULT_RETRIES,
+               backoff: float = DEFAULT_BACKOFF_SEC) -> tuple:
+    """1時間分を取得して (status, size, sha256) を返す"""
     out_path.parent.mkdir(parents=True, exist_ok=True)
+    session = session or requests.Session()
+    for attempt in range(retries + 1):
+        try:
+            return _fetch_to(session, url, out_path, timeout)
+        except (RetryableError, requests.Timeout, requests.ConnectionError,
+                requests.exceptions.ChunkedEncodingError) as e:
+            # ChunkedEncodingError: 本文が Content-Length に満たないまま切れた
+            if attempt == retries:
+                print(f"[ERROR] Failed to download {url} after {retries + 1} attempts: {e}")
+                return STATUS_ERROR, 0, None
+            # 指数バックオフ（1s, 2s, 4s, ...）
+            time.sleep(backoff * (2 ** attempt))
+        except Exception as e:
+            print(f"[ERROR] Failed to download {url}: {e}")
+            return STATUS_ERROR, 0, None
+    return STATUS_ERROR, 0, None
+
+
+def download(url: str, out_path: Path, timeout: int = 60,
+             session: requests.Session = None,
+             retries: int = DEFAULT_RETRIES,
+             backoff: float = DEFAULT_BACKOFF_SEC) -> bool:
     if out_path.exists() and out_path.stat().st_size > 0:
         return True
+    status, _size, _sha = fetch_hour(url, out_path, timeout=timeout, session=session,
+                                     retries=retries, backoff=backoff)
+    return status == STATUS_OK
+
+
+def download_range(pair: str, start: datetime, end: datetime, out_root: Path,
+                   base: str = BASE,
+                   concurrency: int = DEFAULT_CONCURRENCY,
+                   timeout: int = 60,
+                   retries: int = DEFAULT_RETRIES,
+                   backoff: float = DEFAULT_BACKOFF_SEC,
+                   use_manifest: bool = True) -> tuple[int, int]:
+    """
+    [start, end) の全時間を同時実行数を制限して取得し、(ok, ng) を返す
+    マニフェストで取得済み・空確定の時間はネットワークに問い合わせない
+    """
+    hours = []
+    cur = start
+    while cur < end:
+        hours.append(cur)
+        cur += timedelta(hours=1)
 
-    try:
-        r = requests.get(url, timeout=timeout)
-        if r.status_code != 200 or not r.content:
-            return False
-        out_path.write_bytes(r.content)
-        return True
-    except Exception as e:
-        print(f"[ERROR] Failed to download {url}: {e}")
-        return False
+    with Bi5Manifest(out_root) as manifest:
+        if use_manifest:
+            todo = manifest.plan(hours, lambda dt: bi5_path(out_root, dt))
+        else:
+            todo = [dt for dt in hours
+                    if not (bi5_path(out_root, dt).exists() and bi5_path(out_root, dt).stat().st_size > 0)]
+        print(f"[INFO] {pair}: {len(hours)} hours requested, {len(todo)} to fetch")
+
+        session = make_session(concurrency)
+        try:
+            with ThreadPoolExecutor(max_workers=concurrency) as ex:
+                results = list(ex.map(
+                    lambda dt: fetch_hour(bi5_url(pair, dt, base), bi5_path(out_root, dt),
+                                          timeout=timeout, session=session,
+                                          retries=retries, backoff=backoff),
+                    todo,
+                ))
+        finally:
+            session.close()
+
+        manifest.record_many((dt, status, size, sha, None) for dt, (status, size, sha) in zip(todo, results))
+        fetched = {dt: status for dt, (status, _size, _sha) in zip(todo, results)}
+        entries = manifest.entries(hours)
 
+    ok = 0
+    for dt in hours:
+        status = fetched.get(dt) or entries.get(hour_key(dt), (None,))[0]
+        if status == STATUS_OK or (status is None and bi5_path(out_root, dt).exists()):
+            ok += 1
+    return ok, len(hours) - ok
 
-def main():
+
+def download_pair(pair: str, start: datetime, end: datetime, out_root: Path, **kwargs) -> dict:
+    """1ペア分を取得する（--pairs ではペアごとにスレッドで呼ばれる）"""
+    pair_root = out_root / pair
+    ok, ng = download_range(pair, start, end, pair_root, **kwargs)
+    print(f"[OK] done pair={pair} ok_hours={ok} missing_hours={ng}")
+    return {"pair": pair, "out_root": str(pair_root), "ok_hours": ok, "missing_hours": ng}
+
+
+def run(argv: list = None) -> dict:
+    """
+    ジョブのエントリポイント（app.run_job からプロセスプール内で呼ばれる）
+
+    Returns:
+        {"pair", "out_root", "ok_hours", "missing_hours"}
+        --pairs の場合は fx_pairs.run_per_pair のレポート（ペアごとに上記）
+    """
     ap = argparse.ArgumentParser()
-    ap.add_argument("--pair", required=True, help="e.g. USDJPY")
+    ap.add_argument("--pair", help="e.g. USDJPY")
+    ap.add_argument("--pairs", help="comma separated pairs (or 'all') to download in one run")
+    ap.add_argument("--pair-workers", type=int, default=4, help="Pairs downloaded at the same time with --pairs")
     ap.add_argument("--start", required=True, help="UTC start like 2025-01-01T00")
     ap.add_argument("--end", required=True, help="UTC end like 2025-01-02T00 (exclusive)")
     ap.add_argument("--out-root", default="data/raw_bi5", help="Output root")
-    args = ap.parse_args()
-
-    pair = args.pair.upper()
+    ap.add_argument("--base-url", default=BASE, help="Datafeed base URL")
+    ap.add_argument("--concurrency", type=int, default=DEFAULT_CONCURRENCY, help="Max parallel requests")
+    ap.add_argument("--retries", type=int, default=DEFAULT_RETRIES, help="Retries on 5xx/timeouts")
+    ap.add_argument("--timeout", type=int, default=60, help="Per-request timeout (sec)")
+    ap.add_argument("--no-manifest", action="store_true", help="Ignore the manifest and refetch every non-existing hour")
+    args = ap.parse_args(argv)
+
+    pairs = parse_pairs(args.pair, args.pairs)
+    if not pairs:
+        ap.error("--pair or --pairs is required")
     start = datetime.fromisoformat(args.start).replace(tzinfo=timezone.utc)
     end = datetime.fromisoformat(args.end).replace(tzinfo=timezone.utc)
 
-    out_root = Path(args.out_root) / pair
-    cur = start
-    ok = 0
-    ng = 0
+    fetch_pair = partial(
+        download_pair, start=start, end=end, out_root=Path(args.out_root),
+        base=args.base_url.rstrip("/"),
+        concurrency=max(1, args.concurrency),
+        timeout=args.timeout,
+        retries=args.retries,
+        use_manifest=not args.no_manifest,
+    )
+    if args.pairs is None:
+        return fetch_pair(pairs[0])
+    # 通信待ちが主なのでスレッドで並列にする（ペアごとに --concurrency の同時接続）
+    return run_per_pair("download_bi5", fetch_pair, pairs, workers=args.pair_workers, processes=False)
 
-    while cur < end:
-        url = bi5_url(pair, cur)
-        out = out_root / f"{cur.year}" / month0(cur) / f"{cur.day:02d}" / f"{cur.hour:02d}h_ticks.bi5"
-        if download(url, out):
-            ok += 1
-        else:
-            ng += 1
-        cur += timedelta(hours=1)
 
-    print(f"[OK] done pair={pair} ok_hours={ok} missing_hours={ng}")
+def main():
+    run()
 
 
 if __name__ == "__main__":
@@ -116,7 +116,13 @@ def download_oanda_candles(
         return pd.DataFrame()
 
 
-def main():
+def run(argv: list = None) -> dict:
+    """
+    ジョブのエントリポイント（app.run_job からプロセスプール内で呼ばれる）
+
+    Returns:
+        {"ok", "pair", "path", "rows", "start", "end"}
+    """
     ap = argparse.ArgumentParser(description="Download FX data from OANDA API")
     ap.add_argument("--pair", required=True, help="Currency pair (e.g., USDJPY)")
     ap.add_argument("--start", required=True, help="Start datetime (YYYY-MM-DDTHH:MM:SS)")
@@ -124,7 +130,7 @@ def main():
     ap.add_argument("--granularity", default="H1", help="Granularity (M1, M5, M15, H1, H4, D)")
     ap.add_argument("--api-key", help="OANDA API key (or set OANDA_API_KEY env var)")
     ap.add_argument("--out-dir", default="data/oanda", help="Output directory")
-    args = ap.parse_args()
+    args = ap.parse_args(argv)
     
     pair = args.pair.upper()
     out_dir = Path(args.out_dir) / pair
@@ -145,7 +151,7 @@ def main():
     
     if df.empty:
         print("[ERROR] No data downloaded")
-        return
+        return {"ok": False, "pair": pair, "path": None, "rows": 0, "error": "No data downloaded"}
     
     # ファイル名を生成
     start_str = start.strftime("%Y%m%dT%H%M%S")
@@ -158,6 +164,14 @@ def main():
     print(f"[OK] Saved to {out_path}")
     print(f"[INFO] Data shape: {df.shape}")
     print(f"[INFO] Date range: {df['ts'].min()} to {df['ts'].max()}")
+    return {
+        "ok": True, "pair": pair, "path": str(out_path), "rows": len(df),
+        "start": df['ts'].min().isoformat(), "end": df['ts'].max().isoformat(),
+    }
+
+
+def main():
+    run()
 
 
 if __name__ == "__main__":
@@ -131,18 +131,24 @@ def download_yahoo_fx(pair: str, start_date: str, end_date: str, interval: str =
         return pd.DataFrame()
 
 
-def main():
+def run(argv: list = None) -> dict:
+    """
+    ジョブのエントリポイント（app.run_job からプロセスプール内で呼ばれる）
+
+    Returns:
+        {"ok", "pair", "path", "rows", "start", "end"}
+    """
     ap = argparse.ArgumentParser(description="Download FX data from Yahoo Finance")
     ap.add_argument("--pair", required=True, help="Currency pair (e.g., USDJPY)")
     ap.add_argument("--start-date", required=True, help="Start date (YYYY-MM-DD)")
     ap.add_argument("--end-date", required=True, help="End date (YYYY-MM-DD)")
     ap.add_argument("--interval", default="1h", help="Interval (1m, 5m, 15m, 30m, 1h, 1d)")
     ap.add_argument("--out-dir", default="data/yahoo_finance", help="Output directory")
-    args = ap.parse_args()
+    args = ap.parse_args(argv)
     
     if not YFINANCE_AVAILABLE:
         print("[ERROR] yfinance not installed. Install with: pip install yfinance")
-        return
+        return {"ok": False, "pair": args.pair.upper(), "path": None, "rows": 0, "error": "yfinance not installed"}
     
     pair = args.pair.upper()
     out_dir = Path(args.out_dir) / pair
@@ -158,7 +164,7 @@ def main():
     
     if df.empty:
         print("[ERROR] No data downloaded")
-        return
+        return {"ok": False, "pair": pair, "path": None, "rows": 0, "error": "No data downloaded"}
     
     # ファイル名を生成（期間を含む）
     start_str = args.start_date.replace("-", "")
@@ -171,6 +177,14 @@ def main():
     print(f"[OK] Saved to {out_path}")
     print(f"[INFO] Data shape: {df.shape}")
     print(f"[INFO] Date range: {df['ts'].min()} to {df['ts'].max()}")
+    return {
+        "ok": True, "pair": pair, "path": str(out_path), "rows": len(df),
+        "start": df['ts'].min().isoformat(), "end": df['ts'].max().isoformat(),
+    }
+
+
+def main():
+    run()
 
 
 if __name__ == "__main__":
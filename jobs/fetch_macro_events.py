@@ -2,152 +2,301 @@
 # -*- coding: utf-8 -*-
 
 import argparse
+import hashlib
+import json
 import os
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta, timezone
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple, Union
+
 import pandas as pd
 import requests
+from requests.adapters import HTTPAdapter
+
+sys.path.insert(0, str(Path(__file__).parent.parent))
+
+from event_direction import DirectionClassifier, direction_classifier, pair_classifier
+from events_store import DEFAULT_DB, EventsStore
 
 WEIGHT_BY_IMPORTANCE = {3: 1.0, 2: 0.35, 1: 0.15}
 
 
 def usd_jpy_direction(event: str, country: str) -> float:
-    """USDJPY向けの方向付きサプライズ符号"""
-    e = (event or "").lower()
-    c = (country or "").lower()
+    """USDJPY向けの方向付きサプライズ符号（event_direction の USDJPY 用の分類器を使う）"""
+    return direction_classifier("USD", "JPY").sign(event, country)
+
+
+TE_BASE = "https://api.tradingeconomics.com"
+
+DEFAULT_WORKERS = 4
+DEFAULT_MAX_RPS = 1.0
+# 終わってから1日以上経った期間は実績値がほぼ変わらないので長く使う
+DEFAULT_PAST_TTL_HOURS = 24 * 7
+DEFAULT_FUTURE_TTL_HOURS = 1
+PAST_SETTLE = timedelta(days=1)
+
+# チャンクの境界の基準（月曜日）。境界を固定して実行日が変わってもキャッシュのキーを同じにする
+_CHUNK_EPOCH = datetime(1970, 1, 5, tzinfo=timezone.utc)
+
+
+def make_session(pool_size: int = DEFAULT_WORKERS) -> requests.Session:
+    """接続を使い回すためのSession（プールサイズは同時実行数に合わせる）"""
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+class RateLimiter:
+    """リクエストの開始間隔を 1/max_rps 秒以上あける（スレッド間で共有）"""
+
+    def __init__(self, max_rps: float):
+        self.interval = 1.0 / max_rps if max_rps > 0 else 0.0
+        self._next = 0.0
+        self._lock = threading.Lock()
 
-    if "unemployment" in e and "rate" in e:
-        return -1.0
-    if "jobless" in e or "claims" in e:
-        return -1.0
+    def wait(self):
+        if self.interval <= 0:
+            return
+        with self._lock:
+            now = time.monotonic()
+            start = max(now, self._next)
+            self._next = start + self.interval
+        if start > now:
+            time.sleep(start - now)
 
-    infl_kw = ["cpi", "pce", "ppi", "inflation", "deflator", "core"]
-    labor_kw = ["payroll", "employment", "wage", "earnings"]
-    rates_kw = ["interest rate", "rate decision", "fomc", "fed", "powell", "minutes", "policy", "statement", "boj"]
-    growth_kw = ["gdp", "pmi", "ism", "retail sales", "industrial", "production", "tankan"]
 
-    is_us = ("united states" in c) or (c == "us") or ("u.s." in c)
-    is_jp = ("japan" in c) or (c == "jp")
+class CalendarCache:
+    """
+    カレンダーAPIの応答のキャッシュ（1応答1ファイルのJSON）
 
-    if is_us and any(k in e for k in infl_kw + labor_kw + rates_kw + growth_kw):
-        return +1.0
-    if is_jp and any(k in e for k in infl_kw + labor_kw + rates_kw + growth_kw):
-        return -1.0
+    キーは (countries, チャンクの期間, importance)。保存時刻と ttl で有効かを判定する。
+    """
 
-    return +1.0
+    def __init__(self, root: Union[str, Path]):
+        self.root = Path(root)
 
+    @staticmethod
+    def key(countries: str, start: str, end: str, importance: int) -> str:
+        return f"{countries}|{start}|{end}|{importance}"
 
-def te_get_calendar_country(countries: str, start: str, end: str, key: str, importance: int):
-    """TradingEconomics calendar API"""
-    base = f"https://api.tradingeconomics.com/calendar/country/{countries}/{start}/{end}"
+    def _path(self, key: str) -> Path:
+        return self.root / f"{hashlib.sha1(key.encode('utf-8')).hexdigest()}.json"
+
+    def get(self, key: str, ttl: timedelta, now: datetime) -> Optional[list]:
+        try:
+            with open(self._path(key), encoding="utf-8") as f:
+                entry = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if entry.get("key") != key:
+            return None
+        fetched_at = datetime.fromisoformat(entry["fetched_at"])
+        if now - fetched_at > ttl:
+            return None
+        return entry["data"]
+
+    def put(self, key: str, data: list, now: datetime):
+        self.root.mkdir(parents=True, exist_ok=True)
+        path = self._path(key)
+        tmp = path.with_suffix(f".{os.getpid()}.{threading.get_ident()}.tmp")
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump({"key": key, "fetched_at": now.isoformat(), "data": data}, f, ensure_ascii=False)
+        os.replace(tmp, path)
+
+
+def calendar_chunks(start_dt: datetime, end_dt: datetime, chunk_days: int) -> List[Tuple[datetime, datetime]]:
+    """
+    [start_dt, end_dt) を覆う chunk_days 日ごとの期間（境界は暦に固定、最後のチャンクは未来を含む）
+
+    Returns:
+        [(チャンクの開始, 次のチャンクの開始)]
+    """
+    step = timedelta(days=max(1, chunk_days))
+    n = (start_dt - _CHUNK_EPOCH) // step
+    cur = _CHUNK_EPOCH + n * step
+    chunks = []
+    while cur < end_dt:
+        chunks.append((cur, cur + step))
+        cur += step
+    return chunks
+
+
+def te_get_calendar_country(countries: str, start: str, end: str, key: str, importance: int,
+                            session: requests.Session = None, base: str = TE_BASE) -> Optional[list]:
+    """TradingEconomics calendar API（失敗時は None）"""
+    url = f"{base}/calendar/country/{countries}/{start}/{end}"
     params = {"c": key, "f": "json", "importance": str(importance), "values": "true"}
     try:
-        r = requests.get(base, params=params, timeout=30)
+        r = (session or requests).get(url, params=params, timeout=30)
         r.raise_for_status()
-        return r.json()
+        data = r.json()
     except Exception as e:
         print(f"[ERROR] TE API error: {e}")
-        return []
+        return None
+    if isinstance(data, dict) and data.get("status"):
+        # エラー応答（キャッシュしない）
+        print(f"[ERROR] TE API error: {data}")
+        return None
+    return data or []
 
 
-def main():
+def calendar_rows(data: list, imp: int, classifier: DirectionClassifier = None) -> List[dict]:
+    """
+    カレンダーAPIの応答をイベントの行にする
+
+    surprise（実績 - 予想）と country/event はペアに依らない値として保存し、
+    特徴量の計算（build_features）がペアごとに方向の符号を付ける。
+    sentiment / sentiment_w / dir_sign は classifier のペア（デフォルトはUSDJPY）で符号を付けた参考値
+    """
+    classifier = classifier or direction_classifier("USD", "JPY")
+    rows = []
+    for it in data:
+        cal_id = it.get("CalendarId") or it.get("CalendarID")
+        ts = pd.to_datetime(it.get("Date"), utc=True, errors="coerce")
+        if pd.isna(ts):
+            continue
+
+        event = it.get("Event", "") or ""
+        country = it.get("Country", "") or ""
+        url = it.get("URL", "") or ""
+
+        actual = it.get("ActualValue")
+        forecast = it.get("ForecastValue")
+        previous = it.get("PreviousValue")
+
+        surprise = None
+        if actual is not None and forecast is not None:
+            try:
+                surprise = float(actual) - float(forecast)
+            except Exception:
+                surprise = None
+
+        try:
+            importance = int(it.get("Importance", imp))
+        except Exception:
+            importance = imp
+
+        rows.append({
+            "id": str(cal_id) if cal_id is not None else f"te_{country}_{event}_{ts.isoformat()}",
+            "ts": ts,
+            "source": "te",
+            "category": "macro",
+            "importance": importance,
+            "weight": WEIGHT_BY_IMPORTANCE.get(importance, 0.2),
+            "country": country,
+            "event": event,
+            "actual": actual,
+            "forecast": forecast,
+            "previous": previous,
+            "surprise": surprise,
+            "url": url,
+        })
+
+    # 方向符号は全行まとめて判定する
+    signs = classifier.signs([r["event"] for r in rows], [r["country"] for r in rows])
+    for r, dir_sign in zip(rows, signs.tolist()):
+        dir_surprise = float(r["surprise"]) * dir_sign if r["surprise"] is not None else 0.0
+        r["sentiment"] = dir_surprise
+        r["sentiment_w"] = dir_surprise * r["weight"]
+        r["dir_sign"] = dir_sign
+        r["dir_surprise"] = dir_surprise
+    return rows
+
+
+def run(argv: list = None) -> dict:
+    """
+    ジョブのエントリポイント（app.run_job からプロセスプール内で呼ばれる）
+
+    Returns:
+        {"events_cache", "fetched", "inserted", "updated", "rows", "requests", "cache_hits", "errors"}
+    """
     ap = argparse.ArgumentParser()
-    ap.add_argument("--events-cache", required=True)
+    ap.add_argument("--events-cache", default=DEFAULT_DB,
+                    help="events store (.sqlite). A legacy events_cache.parquet path is migrated into events.sqlite next to it")
     ap.add_argument("--te-key", default=os.getenv("TE_API_KEY", "guest:guest"))
+    ap.add_argument("--te-base", default=TE_BASE, help="API base URL")
+    ap.add_argument("--pair", default="USDJPY", help="Pair the stored sentiment/sentiment_w are signed for "
+                         "(build_features signs the raw surprise for each pair itself)")
     ap.add_argument("--countries", default="japan,united%20states")
     ap.add_argument("--importance-list", default="2,3")
     ap.add_argument("--days-back", type=int, default=21)
     ap.add_argument("--chunk-days", type=int, default=7)
-    args = ap.parse_args()
+    ap.add_argument("--workers", type=int, default=DEFAULT_WORKERS, help="Parallel API requests")
+    ap.add_argument("--max-rps", type=float, default=DEFAULT_MAX_RPS, help="Max API requests per second (0: no limit)")
+    ap.add_argument("--cache-dir", default=None,
+                    help="Calendar response cache (default: te_cache/ next to the events store)")
+    ap.add_argument("--past-ttl-hours", type=float, default=DEFAULT_PAST_TTL_HOURS,
+                    help="Cache TTL for chunks that ended more than a day ago")
+    ap.add_argument("--future-ttl-hours", type=float, default=DEFAULT_FUTURE_TTL_HOURS,
+                    help="Cache TTL for chunks that include recent or upcoming days")
+    ap.add_argument("--no-cache", action="store_true", help="Ignore cached responses (responses are still saved)")
+    args = ap.parse_args(argv)
 
     importance_list = [int(x.strip()) for x in args.importance_list.split(",") if x.strip()]
     now = datetime.now(timezone.utc)
     start_dt = (now - timedelta(days=args.days_back)).replace(hour=0, minute=0, second=0, microsecond=0)
-    end_dt = now
 
-    # Load cache
-    if os.path.exists(args.events_cache):
-        try:
-            cache = pd.read_parquet(args.events_cache)
-            cache["ts"] = pd.to_datetime(cache["ts"], utc=True, errors="coerce")
-        except Exception:
-            cache = pd.DataFrame()
-    else:
-        cache = pd.DataFrame()
-
-    rows = []
-    cur = start_dt
-    while cur < end_dt:
-        nxt = min(cur + timedelta(days=args.chunk_days), end_dt)
-        s = cur.strftime("%Y-%m-%d")
-        e = nxt.strftime("%Y-%m-%d")
+    store = EventsStore.from_path(args.events_cache)
+    cache = CalendarCache(args.cache_dir or store.path.parent / "te_cache")
+    past_ttl = timedelta(hours=args.past_ttl_hours)
+    future_ttl = timedelta(hours=args.future_ttl_hours)
 
+    # キャッシュで足りない (チャンク, importance) だけを取得する
+    responses: Dict[str, list] = {}
+    todo = []
+    for chunk_start, chunk_end in calendar_chunks(start_dt, now, args.chunk_days):
+        s = chunk_start.strftime("%Y-%m-%d")
+        e = (chunk_end - timedelta(days=1)).strftime("%Y-%m-%d")
+        ttl = past_ttl if chunk_end + PAST_SETTLE <= now else future_ttl
         for imp in importance_list:
-            data = te_get_calendar_country(args.countries, s, e, args.te_key, imp)
-            if isinstance(data, dict) and data.get("status"):
-                continue
-
-            for it in (data or []):
-                cal_id = it.get("CalendarId") or it.get("CalendarID")
-                ts = pd.to_datetime(it.get("Date"), utc=True, errors="coerce")
-                if pd.isna(ts):
+            key = CalendarCache.key(args.countries, s, e, imp)
+            data = None if args.no_cache else cache.get(key, ttl, now)
+            if data is not None:
+                responses[key] = data
+            else:
+                todo.append((key, s, e, imp))
+    cache_hits = len(responses)
+
+    errors = 0
+    if todo:
+        workers = max(1, min(args.workers, len(todo)))
+        session = make_session(workers)
+        limiter = RateLimiter(args.max_rps)
+
+        def fetch(item):
+            key, s, e, imp = item
+            limiter.wait()
+            return key, te_get_calendar_country(args.countries, s, e, args.te_key, imp,
+                                                session=session, base=args.te_base)
+
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            for key, data in pool.map(fetch, todo):
+                if data is None:
+                    errors += 1
                     continue
+                cache.put(key, data, datetime.now(timezone.utc))
+                responses[key] = data
+    print(f"[INFO] TE calendar: {cache_hits} cached, {len(todo)} requested, {errors} failed")
+
+    classifier = pair_classifier(args.pair)
+    rows = []
+    for key, data in responses.items():
+        rows.extend(calendar_rows(data, int(key.rsplit("|", 1)[1]), classifier))
 
-                event = it.get("Event", "") or ""
-                country = it.get("Country", "") or ""
-                url = it.get("URL", "") or ""
+    res = store.upsert(rows)
+    print(f"[OK] events_cache updated inserted={res['inserted']} updated={res['updated']} rows={res['rows']} -> {store.path}")
+    return {"events_cache": str(store.path), "fetched": len(rows), **res,
+            "requests": len(todo), "cache_hits": cache_hits, "errors": errors}
 
-                actual = it.get("ActualValue")
-                forecast = it.get("ForecastValue")
-                previous = it.get("PreviousValue")
 
-                surprise = None
-                if actual is not None and forecast is not None:
-                    try:
-                        surprise = float(actual) - float(forecast)
-                    except Exception:
-                        surprise = None
-
-                try:
-                    importance = int(it.get("Importance", imp))
-                except Exception:
-                    importance = imp
-
-                weight = WEIGHT_BY_IMPORTANCE.get(importance, 0.2)
-                dir_sign = usd_jpy_direction(event, country)
-                dir_surprise = (float(surprise) * dir_sign) if surprise is not None else 0.0
-
-                rows.append({
-                    "id": str(cal_id) if cal_id is not None else f"te_{country}_{event}_{ts.isoformat()}",
-                    "ts": ts,
-                    "source": "te",
-                    "category": "macro",
-                    "importance": importance,
-                    "weight": weight,
-                    "sentiment": dir_surprise,
-                    "sentiment_w": dir_surprise * weight,
-                    "country": country,
-                    "event": event,
-                    "actual": actual,
-                    "forecast": forecast,
-                    "previous": previous,
-                    "surprise": surprise,
-                    "dir_sign": dir_sign,
-                    "dir_surprise": dir_surprise,
-                    "url": url,
-                })
-
-        cur = nxt
-
-    merged = cache
-    if rows:
-        new_df = pd.DataFrame(rows)
-        new_df["ts"] = pd.to_datetime(new_df["ts"], utc=True, errors="coerce")
-        merged = pd.concat([cache, new_df], ignore_index=True) if not cache.empty else new_df
-        merged = merged.dropna(subset=["ts"]).drop_duplicates(subset=["id"], keep="last").sort_values("ts")
-
-    os.makedirs(os.path.dirname(args.events_cache), exist_ok=True)
-    merged.to_parquet(args.events_cache, index=False)
-    print(f"[OK] events_cache updated rows={len(merged)} -> {args.events_cache}")
+def main():
+    run()
 
 
 if __name__ == "__main__":
@@ -1,12 +1,32 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
+"""
+中央銀行のRSSの取得
+
+全フィードを同時に取得する（フィードごとにタイムアウト）。
+各フィードの ETag / Last-Modified をイベントストアの meta に保存し、次回は条件付きGET
+（If-None-Match / If-Modified-Since）で取得する。更新の無いフィードは 304 で本文を受け取らない。
+"""
+
 import argparse
-import os
 import hashlib
+import json
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timezone
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
 import pandas as pd
 import feedparser
+import requests
+from requests.adapters import HTTPAdapter
+
+sys.path.insert(0, str(Path(__file__).parent.parent))
+
+from events_store import DEFAULT_DB, EventsStore
 
 RSS = {
     "boj": "https://www.boj.or.jp/rss/whatsnew.rdf",
@@ -15,64 +35,204 @@ RSS = {
     "boe": "https://www.bankofengland.co.uk/rss/speeches"
 }
 
+DEFAULT_TIMEOUT = 15
+MAX_ENTRIES = 200
+USER_AGENT = "fx-events/1.0 (+feedparser)"
+
 
 def make_id(src: str, link: str, title: str) -> str:
     h = hashlib.sha1(f"{src}|{link}|{title}".encode("utf-8")).hexdigest()
     return f"rss_{h}"
 
 
-def main():
+def make_session(pool_size: int) -> requests.Session:
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    session.headers["User-Agent"] = USER_AGENT
+    return session
+
+
+def _meta_key(src: str) -> str:
+    return f"rss:{src}"
+
+
+def load_validators(store: EventsStore, src: str, url: str) -> dict:
+    """前回の ETag / Last-Modified（URLが変わっていれば使わない）"""
+    raw = store.get_meta(_meta_key(src))
+    if not raw:
+        return {}
+    try:
+        v = json.loads(raw)
+    except ValueError:
+        return {}
+    return v if v.get("url") == url else {}
+
+
+def save_validators(store: EventsStore, src: str, url: str, etag: Optional[str], last_modified: Optional[str]):
+    store.set_meta(_meta_key(src), json.dumps({
+        "url": url,
+        "etag": etag,
+        "last_modified": last_modified,
+        "checked_at": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+    }))
+
+
+def fetch_feed(session: requests.Session, src: str, url: str, validators: dict, timeout: float) -> dict:
+    """
+    1フィードを条件付きGETで取得する（例外は投げずに結果に入れる）
+
+    Returns:
+        {"source", "status", "elapsed_sec", "entries", "etag", "last_modified"}
+        status は HTTPステータス（304 なら entries は空）、失敗時は "error"
+    """
+    headers = {}
+    if validators.get("etag"):
+        headers["If-None-Match"] = validators["etag"]
+    if validators.get("last_modified"):
+        headers["If-Modified-Since"] = validators["last_modified"]
+
+    t0 = time.perf_counter()
+    result = {"source": src, "url": url, "entries": [], "etag": None, "last_modified": None}
+    try:
+        r = session.get(url, headers=headers, timeout=timeout)
+        result["status"] = r.status_code
+        if r.status_code == 304:
+            # 304 で新しい値が返らなければ前回の値を使い続ける
+            result["etag"] = r.headers.get("ETag") or validators.get("etag")
+            result["last_modified"] = r.headers.get("Last-Modified") or validators.get("last_modified")
+        else:
+            r.raise_for_status()
+            d = feedparser.parse(r.content)
+            if d.bozo and not d.entries:
+                raise ValueError(f"unparsable feed: {d.get('bozo_exception')}")
+            result["entries"] = list(d.entries[:MAX_ENTRIES])
+            result["etag"] = r.headers.get("ETag")
+            result["last_modified"] = r.headers.get("Last-Modified")
+    except Exception as e:
+        result["status"] = "error"
+        result["error"] = f"{type(e).__name__}: {e}"
+    result["elapsed_sec"] = round(time.perf_counter() - t0, 3)
+    return result
+
+
+def entries_to_rows(src: str, entries: list) -> Tuple[List[dict], List[dict]]:
+    """
+    フィードの項目 → イベントの行
+
+    Returns:
+        (公開時刻のある行, 公開時刻の無い行)。時刻の無い行の ts は取得時刻
+    """
+    dated, undated = [], []
+    seen_at = datetime.now(timezone.utc)
+    for e in entries:
+        title = getattr(e, "title", "") or ""
+        link = getattr(e, "link", "") or ""
+        published = getattr(e, "published", "") or ""
+        ts = pd.to_datetime(published, utc=True, errors="coerce")
+        rows = dated
+        if pd.isna(ts):
+            ts, rows = seen_at, undated
+
+        rows.append({
+            "id": make_id(src, link, title),
+            "ts": ts,
+            "source": src,
+            "category": "news",
+            "importance": 2,
+            "weight": 0.35,
+            "sentiment": 0.0,
+            "sentiment_w": 0.0,
+            "event": title,
+            "url": link
+        })
+    return dated, undated
+
+
+def fetch_feeds(feeds: Dict[str, str], store: EventsStore, timeout: float = DEFAULT_TIMEOUT,
+                conditional: bool = True, session: requests.Session = None) -> List[dict]:
+    """全フィードを同時に取得する（結果は feeds の順）"""
+    session = session or make_session(max(1, len(feeds)))
+    validators = {src: (load_validators(store, src, url) if conditional else {}) for src, url in feeds.items()}
+    with ThreadPoolExecutor(max_workers=max(1, len(feeds))) as pool:
+        futures = [pool.submit(fetch_feed, session, src, url, validators[src], timeout)
+                   for src, url in feeds.items()]
+        return [f.result() for f in futures]
+
+
+def parse_feed_args(values: Optional[List[str]]) -> Dict[str, str]:
+    """--feed NAME=URL の一覧（指定が無ければ RSS）"""
+    if not values:
+        return dict(RSS)
+    feeds = {}
+    for v in values:
+        name, sep, url = v.partition("=")
+        if not sep or not name.strip() or not url.strip():
+            raise SystemExit(f"--feed must be NAME=URL: {v}")
+        feeds[name.strip()] = url.strip()
+    return feeds
+
+
+def run(argv: list = None) -> dict:
+    """
+    ジョブのエントリポイント（app.run_job からプロセスプール内で呼ばれる）
+
+    Returns:
+        {"events_cache", "fetched", "inserted", "updated", "rows", "not_modified", "failed", "feeds"}
+    """
     ap = argparse.ArgumentParser()
-    ap.add_argument("--events-cache", required=True)
-    args = ap.parse_args()
-
-    if os.path.exists(args.events_cache):
-        try:
-            cache = pd.read_parquet(args.events_cache)
-            cache["ts"] = pd.to_datetime(cache["ts"], utc=True, errors="coerce")
-        except Exception:
-            cache = pd.DataFrame()
-    else:
-        cache = pd.DataFrame()
-
-    rows = []
-    for src, url in RSS.items():
-        try:
-            d = feedparser.parse(url)
-            for e in d.entries[:200]:
-                title = getattr(e, "title", "") or ""
-                link = getattr(e, "link", "") or ""
-                published = getattr(e, "published", "") or ""
-                ts = pd.to_datetime(published, utc=True, errors="coerce")
-                if pd.isna(ts):
-                    ts = datetime.now(timezone.utc)
-
-                rows.append({
-                    "id": make_id(src, link, title),
-                    "ts": ts,
-                    "source": src,
-                    "category": "news",
-                    "importance": 2,
-                    "weight": 0.35,
-                    "sentiment": 0.0,
-                    "sentiment_w": 0.0,
-                    "event": title,
-                    "url": link
-                })
-        except Exception as e:
-            print(f"[WARN] Failed to fetch {src}: {e}")
-
-    if rows:
-        new_df = pd.DataFrame(rows)
-        new_df["ts"] = pd.to_datetime(new_df["ts"], utc=True, errors="coerce")
-        merged = pd.concat([cache, new_df], ignore_index=True) if not cache.empty else new_df
-        merged = merged.dropna(subset=["ts"]).drop_duplicates(subset=["id"], keep="last").sort_values("ts")
-    else:
-        merged = cache
-
-    os.makedirs(os.path.dirname(args.events_cache), exist_ok=True)
-    merged.to_parquet(args.events_cache, index=False)
-    print(f"[OK] rss merged rows={len(merged)} -> {args.events_cache}")
+    ap.add_argument("--events-cache", default=DEFAULT_DB,
+                    help="events store (.sqlite). A legacy events_cache.parquet path is migrated into events.sqlite next to it")
+    ap.add_argument("--feed", action="append", metavar="NAME=URL",
+                    help="Feed to fetch (repeatable). Replaces the built-in central bank feeds")
+    ap.add_argument("--timeout", type=float, default=DEFAULT_TIMEOUT, help="Per-feed timeout seconds")
+    ap.add_argument("--no-conditional", action="store_true",
+                    help="Ignore stored ETag/Last-Modified and download every feed")
+    args = ap.parse_args(argv)
+
+    feeds = parse_feed_args(args.feed)
+    store = EventsStore.from_path(args.events_cache)
+
+    results = fetch_feeds(feeds, store, timeout=args.timeout, conditional=not args.no_conditional)
+
+    dated, undated = [], []
+    for r in results:
+        if r["status"] == "error":
+            print(f"[WARN] Failed to fetch {r['source']}: {r['error']}")
+            continue
+        d, u = entries_to_rows(r["source"], r["entries"])
+        dated.extend(d)
+        undated.extend(u)
+
+    res = store.upsert(dated)
+    if undated:
+        # 時刻の無い項目は初めて見た時刻を残す（取得のたびに ts を書き換えると、変更として記録され
+        # その時刻からイベント特徴量が計算し直される）
+        kept = store.upsert(undated, keep_ts=True)
+        res = {"inserted": res["inserted"] + kept["inserted"], "updated": res["updated"] + kept["updated"],
+               "rows": kept["rows"]}
+
+    # 取り込みが済んでから保存する（途中で失敗したら次回も本文を取り直す）
+    for r in results:
+        if r["status"] != "error":
+            save_validators(store, r["source"], r["url"], r["etag"], r["last_modified"])
+
+    feed_status = {r["source"]: {"status": r["status"], "entries": len(r["entries"]),
+                                 "elapsed_sec": r["elapsed_sec"], **({"error": r["error"]} if "error" in r else {})}
+                   for r in results}
+    not_modified = sum(1 for r in results if r["status"] == 304)
+    failed = [r["source"] for r in results if r["status"] == "error"]
+    for src, s in feed_status.items():
+        print(f"    {src:<6} {str(s['status']):>5}  entries={s['entries']:<4} {s['elapsed_sec']:.2f}s")
+    print(f"[OK] rss merged inserted={res['inserted']} updated={res['updated']} rows={res['rows']} "
+          f"not_modified={not_modified}/{len(results)} -> {store.path}")
+    return {"events_cache": str(store.path), "fetched": len(dated) + len(undated), **res,
+            "not_modified": not_modified, "failed": failed, "feeds": feed_status}
+
+
+def main():
+    run()
 
 
 if __name__ == "__main__":
@@ -7,87 +7,167 @@
 """
 
 import argparse
+import sys
 from pathlib import Path
+import numpy as np
 import pandas as pd
-from typing import List, Optional
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+from typing import Dict, List, Optional
+
+sys.path.insert(0, str(Path(__file__).parent.parent))
+
+from jobs.build_bars_from_m1 import scan_m1_batches
+
+# ストリーミング出力のスキーマ（ソースによって欠ける列はNaN）
+MERGED_COLUMNS = ["ts", "open", "high", "low", "close", "vol", "spread", "source"]
+
+
+def date_bounds(start_date: Optional[str], end_date: Optional[str]) -> tuple:
+    """開始日・終了日（両端含む）を [start, end) のUTCのタイムスタンプにする"""
+    start = pd.Timestamp(start_date, tz="UTC") if start_date else None
+    end = pd.Timestamp(end_date, tz="UTC") + pd.Timedelta(days=1) if end_date else None
+    return start, end
+
+
+def _ts_filter(ts_type: pa.DataType, start: Optional[pd.Timestamp], end: Optional[pd.Timestamp]):
+    """ts列の型に合わせた範囲のフィルタ式（タイムスタンプ型でなければ None）"""
+    if not pa.types.is_timestamp(ts_type):
+        return None
+    expr = None
+    for bound, op in ((start, "greater_equal"), (end, "less")):
+        if bound is None:
+            continue
+        value = bound if ts_type.tz else bound.tz_localize(None)
+        cond = getattr(pc, op)(pc.field("ts"), pa.scalar(value, type=ts_type))
+        expr = cond if expr is None else expr & cond
+    return expr
+
+
+def read_parquet_range(path: Path, start: Optional[pd.Timestamp], end: Optional[pd.Timestamp]) -> pd.DataFrame:
+    """
+    parquetから start <= ts < end の行だけを読む
+    （範囲外の行グループは統計で読み飛ばす。ts列はUTCにする）
+    """
+    schema = pq.read_schema(path)
+    expr = _ts_filter(schema.field("ts").type, start, end) if "ts" in schema.names else None
+    df = pq.read_table(path, filters=expr).to_pandas() if expr is not None else pd.read_parquet(path)
+    df["ts"] = pd.to_datetime(df["ts"], utc=True)
+    if expr is None:
+        # ts が文字列などで式にできない場合はここで絞る
+        mask = np.ones(len(df), dtype=bool)
+        if start is not None:
+            mask &= (df["ts"] >= start).to_numpy()
+        if end is not None:
+            mask &= (df["ts"] < end).to_numpy()
+        df = df[mask]
+    return df
+
+
+def _concat_sorted(dfs: List[pd.DataFrame], source: str) -> pd.DataFrame:
+    dfs = [df for df in dfs if not df.empty]
+    if not dfs:
+        return pd.DataFrame()
+    result = pd.concat(dfs, ignore_index=True)
+    if not result['ts'].is_monotonic_increasing:
+        result = result.sort_values('ts', kind='stable').reset_index(drop=True)
+    result['source'] = source
+    return result
 
 
 def load_dukascopy_data(m1_dir: Path, start_date: str, end_date: str) -> pd.DataFrame:
-    """DukascopyのM1バーデータを読み込む"""
-    dfs = []
+    """DukascopyのM1バーデータを読み込む（date=パーティション名で日付を絞る）"""
+    tables = []
     m1_path = m1_dir / "tf=M1"
-    
+
     for date_dir in sorted(m1_path.glob("date=*")):
         date_str = date_dir.name.replace("date=", "")
-        if start_date <= date_str <= end_date:
-            for parquet_file in date_dir.glob("part-*.parquet"):
-                try:
-                    df = pd.read_parquet(parquet_file)
-                    dfs.append(df)
-                except Exception as e:
-                    print(f"[WARN] Failed to load {parquet_file}: {e}")
-    
-    if not dfs:
+        if (start_date and date_str < start_date) or (end_date and date_str > end_date):
+            continue
+        for parquet_file in sorted(date_dir.glob("part-*.parquet")):
+            try:
+                tables.append(pq.read_table(parquet_file))
+            except Exception as e:
+                print(f"[WARN] Failed to load {parquet_file}: {e}")
+
+    if not tables:
         return pd.DataFrame()
-    
-    result = pd.concat(dfs, ignore_index=True)
-    result = result.sort_values('ts').reset_index(drop=True)
-    result['source'] = 'dukascopy'
-    return result
+    df = pa.concat_tables(tables, promote_options="default").to_pandas()
+    df["ts"] = pd.to_datetime(df["ts"], utc=True)
+    return _concat_sorted([df], 'dukascopy')
 
 
-def load_yahoo_data(yahoo_dir: Path, start_date: str, end_date: str) -> pd.DataFrame:
-    """Yahoo Financeのデータを読み込む"""
+def load_range_files(data_dir: Path, start_date: str, end_date: str, source: str) -> pd.DataFrame:
+    """ディレクトリ内のparquetから日付範囲（両端含む）の行だけを読み込む"""
+    start, end = date_bounds(start_date, end_date)
     dfs = []
-    
-    for parquet_file in sorted(yahoo_dir.glob("*.parquet")):
+    for parquet_file in sorted(data_dir.glob("*.parquet")):
         try:
-            df = pd.read_parquet(parquet_file)
-            # 日付範囲でフィルタ
-            df['date'] = pd.to_datetime(df['ts']).dt.date
-            start = pd.to_datetime(start_date).date()
-            end = pd.to_datetime(end_date).date()
-            df = df[(df['date'] >= start) & (df['date'] <= end)]
-            if not df.empty:
-                df = df.drop('date', axis=1)
-                dfs.append(df)
+            dfs.append(read_parquet_range(parquet_file, start, end))
         except Exception as e:
             print(f"[WARN] Failed to load {parquet_file}: {e}")
-    
-    if not dfs:
-        return pd.DataFrame()
-    
-    result = pd.concat(dfs, ignore_index=True)
-    result = result.sort_values('ts').reset_index(drop=True)
-    result['source'] = 'yahoo'
-    return result
+    return _concat_sorted(dfs, source)
+
+
+def load_yahoo_data(yahoo_dir: Path, start_date: str, end_date: str) -> pd.DataFrame:
+    """Yahoo Financeのデータを読み込む"""
+    return load_range_files(yahoo_dir, start_date, end_date, 'yahoo')
 
 
 def load_oanda_data(oanda_dir: Path, start_date: str, end_date: str) -> pd.DataFrame:
     """OANDAのデータを読み込む"""
-    dfs = []
-    
-    for parquet_file in sorted(oanda_dir.glob("*.parquet")):
-        try:
-            df = pd.read_parquet(parquet_file)
-            # 日付範囲でフィルタ
-            df['date'] = pd.to_datetime(df['ts']).dt.date
-            start = pd.to_datetime(start_date).date()
-            end = pd.to_datetime(end_date).date()
-            df = df[(df['date'] >= start) & (df['date'] <= end)]
-            if not df.empty:
-                df = df.drop('date', axis=1)
-                dfs.append(df)
-        except Exception as e:
-            print(f"[WARN] Failed to load {parquet_file}: {e}")
-    
-    if not dfs:
-        return pd.DataFrame()
-    
-    result = pd.concat(dfs, ignore_index=True)
-    result = result.sort_values('ts').reset_index(drop=True)
-    result['source'] = 'oanda'
-    return result
+    return load_range_files(oanda_dir, start_date, end_date, 'oanda')
+
+
+class SourceCoverage:
+    """ソースごとの読み込み行数・期間と、マージ後に採用された行数"""
+
+    def __init__(self, priority: List[str]):
+        self.priority = list(priority)
+        self.loaded: Dict[str, dict] = {}
+        self.used: Dict[str, int] = {}
+
+    def add_loaded(self, source: str, ts: pd.Series):
+        if ts.empty:
+            return
+        cur = self.loaded.setdefault(source, {"rows": 0, "first": None, "last": None})
+        cur["rows"] += len(ts)
+        first, last = ts.iloc[0], ts.iloc[-1]
+        cur["first"] = first if cur["first"] is None else min(cur["first"], first)
+        cur["last"] = last if cur["last"] is None else max(cur["last"], last)
+
+    def add_used(self, merged: pd.DataFrame):
+        for src, n in merged['source'].value_counts().items():
+            self.used[src] = self.used.get(src, 0) + int(n)
+
+    def report(self) -> Dict[str, dict]:
+        """
+        Returns:
+            {source: {"rows", "used", "shadowed", "share", "first", "last"}}
+            shadowed は優先順位の高いソースと時刻が重なって使われなかった行数、share はマージ後に占める割合
+        """
+        total = sum(self.used.values())
+        sources = [s for s in self.priority if s in self.loaded] + [s for s in self.loaded if s not in self.priority]
+        out = {}
+        for src in sources:
+            info = self.loaded[src]
+            used = self.used.get(src, 0)
+            out[src] = {
+                "rows": info["rows"],
+                "used": used,
+                "shadowed": info["rows"] - used,
+                "share": round(used / total, 4) if total else 0.0,
+                "first": info["first"].isoformat(),
+                "last": info["last"].isoformat(),
+            }
+        return out
+
+    def print(self):
+        print("[INFO] Source coverage:")
+        for src, r in self.report().items():
+            print(f"    {src:<10} rows={r['rows']:>10,} used={r['used']:>10,} shadowed={r['shadowed']:>10,} "
+                  f"share={r['share']:6.1%}  {r['first']} - {r['last']}")
 
 
 def merge_data_sources(
@@ -96,7 +176,8 @@ def merge_data_sources(
     oanda_dir: Optional[Path] = None,
     start_date: str = None,
     end_date: str = None,
-    priority: List[str] = None
+    priority: List[str] = None,
+    coverage: Optional[SourceCoverage] = None
 ) -> pd.DataFrame:
     """
     複数のデータソースをマージ
@@ -108,12 +189,14 @@ def merge_data_sources(
         start_date: 開始日（YYYY-MM-DD）
         end_date: 終了日（YYYY-MM-DD）
         priority: データソースの優先順位（例: ['dukascopy', 'yahoo', 'oanda']）
+        coverage: ソースごとのカバレッジを集計する先（省略時は表示のみ）
     
     Returns:
         マージされたDataFrame
     """
     if priority is None:
         priority = ['dukascopy', 'yahoo', 'oanda']
+    coverage = coverage or SourceCoverage(priority)
     
     all_data = {}
     
@@ -145,34 +228,127 @@ def merge_data_sources(
         print("[WARN] No data sources available")
         return pd.DataFrame()
     
-    # 優先順位に基づいてマージ
-    # 同じタイムスタンプのデータがある場合、優先順位の高いソースを使用
-    merged_df = None
-    
-    for source in priority:
-        if source in all_data:
-            df = all_data[source].copy()
-            
-            if merged_df is None:
-                merged_df = df
-            else:
-                # 既存データとマージ（同じタイムスタンプは優先順位の高いソースで上書き）
-                # まず、既存データにないタイムスタンプを追加
-                existing_ts = set(merged_df['ts'])
-                new_rows = df[~df['ts'].isin(existing_ts)]
-                
-                if not new_rows.empty:
-                    merged_df = pd.concat([merged_df, new_rows], ignore_index=True)
-                    merged_df = merged_df.sort_values('ts').reset_index(drop=True)
+    for src, df in all_data.items():
+        coverage.add_loaded(src, df['ts'])
+    merged_df = merge_frames(all_data, priority)
     
     if merged_df is not None:
+        coverage.add_used(merged_df)
         print(f"[OK] Merged data: {len(merged_df)} bars")
-        print(f"[INFO] Sources: {merged_df['source'].value_counts().to_dict()}")
+        coverage.print()
     
     return merged_df if merged_df is not None else pd.DataFrame()
 
 
-def main():
+def merge_frames(all_data: Dict[str, pd.DataFrame], priority: List[str]) -> Optional[pd.DataFrame]:
+    """
+    読み込み済みのソースを優先順位に基づいてマージ
+    同じタイムスタンプのデータがある場合、優先順位の高いソースを使用
+
+    全ソースを縦に並べ、(ts, 優先順位) で安定ソートして各 ts の先頭の行だけを残す（1回のソートで決まる）。
+    """
+    frames = [(rank, all_data[src]) for rank, src in enumerate(priority)
+              if src in all_data and not all_data[src].empty]
+    if not frames:
+        return None
+    if len(frames) == 1:
+        return frames[0][1].reset_index(drop=True)
+
+    combined = pd.concat([df for _, df in frames], ignore_index=True)
+    ts = combined['ts'].to_numpy(dtype="datetime64[ns]").view("int64")
+    rank = np.concatenate([np.full(len(df), r, dtype=np.int8) for r, df in frames])
+    order = np.lexsort((rank, ts))
+    ts_sorted = ts[order]
+    keep = np.empty(len(order), dtype=bool)
+    keep[:1] = True
+    np.not_equal(ts_sorted[1:], ts_sorted[:-1], out=keep[1:])
+    return combined.take(order[keep]).reset_index(drop=True)
+
+
+def merge_data_sources_streaming(
+    out_path: Path,
+    dukascopy_dir: Optional[Path] = None,
+    yahoo_dir: Optional[Path] = None,
+    oanda_dir: Optional[Path] = None,
+    start_date: str = None,
+    end_date: str = None,
+    priority: List[str] = None,
+    batch_rows: int = 500_000,
+    coverage: Optional[SourceCoverage] = None
+) -> int:
+    """
+    DukascopyのM1をバッチ単位で読み、同じ時間範囲の他ソースとマージして
+    行グループごとに書き出す（メモリはバッチサイズ＋時間足ソースの量で上限）
+    
+    Returns:
+        書き出した行数
+    """
+    if priority is None:
+        priority = ['dukascopy', 'yahoo', 'oanda']
+    coverage = coverage or SourceCoverage(priority)
+
+    # Yahoo/OANDAは時間足で小さいため先に読み込む
+    others = {}
+    if yahoo_dir and yahoo_dir.exists():
+        others['yahoo'] = load_yahoo_data(yahoo_dir, start_date, end_date)
+    if oanda_dir and oanda_dir.exists():
+        others['oanda'] = load_oanda_data(oanda_dir, start_date, end_date)
+    others = {k: v for k, v in others.items() if not v.empty}
+    for src, df in others.items():
+        coverage.add_loaded(src, df['ts'])
+    # 各ソースの ts（昇順）。ウィンドウの切り出しは二分探索で行う
+    others_ts = {src: df['ts'].to_numpy(dtype="datetime64[ns]") for src, df in others.items()}
+    others_pos = {src: 0 for src in others}
+
+    schema = pa.schema([
+        ("ts", pa.timestamp("ns", tz="UTC")),
+        *[(c, pa.float64()) for c in MERGED_COLUMNS[1:-1]],
+        ("source", pa.string()),
+    ])
+    writer = pq.ParquetWriter(out_path, schema, compression='snappy')
+
+    def write_window(frames: Dict[str, pd.DataFrame]):
+        frames = {k: v for k, v in frames.items() if not v.empty}
+        merged = merge_frames(frames, priority) if frames else None
+        if merged is None or merged.empty:
+            return
+        merged = merged.reindex(columns=MERGED_COLUMNS)
+        coverage.add_used(merged)
+        writer.write_table(pa.Table.from_pandas(merged, schema=schema, preserve_index=False))
+
+    try:
+        if dukascopy_dir and dukascopy_dir.exists():
+            for batch in scan_m1_batches(dukascopy_dir / "tf=M1", batch_rows, start=start_date, end=end_date):
+                duka = batch.reset_index()
+                duka['source'] = 'dukascopy'
+                coverage.add_loaded('dukascopy', duka['ts'])
+                upper = duka['ts'].iloc[-1].to_datetime64()
+                # 他ソースは (前回の上限, 今回の上限] の範囲だけを同じウィンドウでマージする
+                frames = {'dukascopy': duka}
+                for src, df in others.items():
+                    stop = int(np.searchsorted(others_ts[src], upper, side="right"))
+                    frames[src] = df.iloc[others_pos[src]:stop]
+                    others_pos[src] = stop
+                write_window(frames)
+
+        # Dukascopyの最終バッチより後ろ（またはDukascopy無し）の残り
+        write_window({src: df.iloc[others_pos[src]:] for src, df in others.items()})
+    finally:
+        writer.close()
+
+    total = sum(coverage.used.values())
+    print(f"[OK] Merged data: {total} bars")
+    coverage.print()
+    return total
+
+
+def run(argv: Optional[list] = None) -> dict:
+    """
+    ジョブのエントリポイント（app.run_job からプロセスプール内で呼ばれる）
+
+    Returns:
+        {"ok", "pair", "path", "rows", "sources", "coverage"}
+    """
     ap = argparse.ArgumentParser(description="Merge data from multiple sources")
     ap.add_argument("--pair", required=True, help="Currency pair (e.g., USDJPY)")
     ap.add_argument("--start-date", required=True, help="Start date (YYYY-MM-DD)")
@@ -183,16 +359,43 @@ def main():
     ap.add_argument("--priority", default="dukascopy,yahoo,oanda", 
                     help="Data source priority (comma-separated)")
     ap.add_argument("--out-dir", default="data/merged", help="Output directory")
-    args = ap.parse_args()
+    ap.add_argument("--stream", action="store_true",
+                    help="Merge Dukascopy M1 in record batches and write row groups as they are merged")
+    ap.add_argument("--batch-rows", type=int, default=500_000, help="Dukascopy M1 rows per batch in --stream mode")
+    args = ap.parse_args(argv)
     
     pair = args.pair.upper()
     priority = [s.strip() for s in args.priority.split(",")]
+    coverage = SourceCoverage(priority)
     
     # ディレクトリパス
     dukascopy_dir = Path(args.dukascopy_dir) / pair if args.dukascopy_dir else None
     yahoo_dir = Path(args.yahoo_dir) / pair if args.yahoo_dir else None
     oanda_dir = Path(args.oanda_dir) / pair if args.oanda_dir else None
     
+    if args.stream:
+        out_dir = Path(args.out_dir) / pair
+        out_dir.mkdir(parents=True, exist_ok=True)
+        out_path = out_dir / f"{pair}_merged_{args.start_date}_{args.end_date}.parquet"
+        rows = merge_data_sources_streaming(
+            out_path,
+            dukascopy_dir=dukascopy_dir,
+            yahoo_dir=yahoo_dir,
+            oanda_dir=oanda_dir,
+            start_date=args.start_date,
+            end_date=args.end_date,
+            priority=priority,
+            batch_rows=args.batch_rows,
+            coverage=coverage
+        )
+        if rows == 0:
+            print("[ERROR] No data to merge")
+            out_path.unlink(missing_ok=True)
+            return {"ok": False, "pair": pair, "path": None, "rows": 0, "error": "No data to merge"}
+        print(f"[OK] Saved merged data to {out_path}")
+        return {"ok": True, "pair": pair, "path": str(out_path), "rows": rows,
+                "sources": dict(coverage.used), "coverage": coverage.report()}
+    
     # データをマージ
     merged_df = merge_data_sources(
         dukascopy_dir=dukascopy_dir,
@@ -200,12 +403,13 @@ def main():
         oanda_dir=oanda_dir,
         start_date=args.start_date,
         end_date=args.end_date,
-        priority=priority
+        priority=priority,
+        coverage=coverage
     )
     
     if merged_df.empty:
         print("[ERROR] No data to merge")
-        return
+        return {"ok": False, "pair": pair, "path": None, "rows": 0, "error": "No data to merge"}
     
     # 出力ディレクトリを作成
     out_dir = Path(args.out_dir) / pair
@@ -220,6 +424,14 @@ def main():
     print(f"[OK] Saved merged data to {out_path}")
     print(f"[INFO] Data shape: {merged_df.shape}")
     print(f"[INFO] Date range: {merged_df['ts'].min()} to {merged_df['ts'].max()}")
+    return {
+        "ok": True, "pair": pair, "path": str(out_path), "rows": len(merged_df),
+        "sources": dict(coverage.used), "coverage": coverage.report(),
+    }
+
+
+def main():
+    run()
 
 
 if __name__ == "__main__":
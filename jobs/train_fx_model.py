@@ -7,11 +7,16 @@ LightGBMを使用して買い/売り/様子見を予測
 """
 
 import argparse
-import pickle
+import sys
 from pathlib import Path
 import pandas as pd
 import numpy as np
 
+sys.path.insert(0, str(Path(__file__).parent.parent))
+
+from feature_store import FeatureStore
+from model_bundle import frame_types, save_bundle
+
 try:
     import lightgbm as lgb
     from sklearn.model_selection import TimeSeriesSplit
@@ -22,13 +27,35 @@ except ImportError:
     print("[ERROR] LightGBM and scikit-learn required. Install with: pip install lightgbm scikit-learn")
 
 
-def create_target(features_df: pd.DataFrame, forward_bars: int = 60) -> pd.Series:
+# 買い/売りのラベルの閾値（forward_bars 先の変動率）
+BUY_THRESHOLD = 0.001    # 0.1%以上上昇 → 買い
+SELL_THRESHOLD = -0.001  # 0.1%以上下落 → 売り
+
+LGB_PARAMS = {
+    'objective': 'multiclass',
+    'num_class': 3,
+    'metric': 'multi_logloss',
+    'boosting_type': 'gbdt',
+    'num_leaves': 31,
+    'learning_rate': 0.05,
+    'feature_fraction': 0.9,
+    'bagging_fraction': 0.8,
+    'bagging_freq': 5,
+    'verbose': -1,
+    'random_state': 42
+}
+
+
+def create_target(features_df: pd.DataFrame, forward_bars: int = 60,
+                  buy_threshold: float = BUY_THRESHOLD, sell_threshold: float = SELL_THRESHOLD) -> pd.Series:
     """
     ターゲット変数を作成（将来の価格変動から買い/売り/様子見を判定）
     
     Args:
         features_df: 特徴量DataFrame
         forward_bars: 何バー先の価格と比較するか（デフォルト: 60バー = 5時間）
+        buy_threshold: これより上昇したら買い
+        sell_threshold: これより下落したら売り（負の値）
     
     Returns:
         0=売り, 1=様子見, 2=買い
@@ -45,10 +72,7 @@ def create_target(features_df: pd.DataFrame, forward_bars: int = 60) -> pd.Serie
     # 将来の価格変動率
     future_return = (close.shift(-forward_bars) / close - 1.0)
     
-    # 閾値で分類（調整可能）
-    buy_threshold = 0.001   # 0.1%以上上昇 → 買い
-    sell_threshold = -0.001  # 0.1%以上下落 → 売り
-    
+    # 閾値で分類
     target = pd.Series(1, index=features_df.index, dtype=int)  # デフォルト: 様子見
     target[future_return > buy_threshold] = 2   # 買い
     target[future_return < sell_threshold] = 0  # 売り
@@ -79,24 +103,40 @@ def prepare_features(features_df: pd.DataFrame) -> pd.DataFrame:
     return X, feature_cols
 
 
+def fit_booster(X: pd.DataFrame, y: pd.Series, num_boost_round: int = 100):
+    """全データでLightGBMを学習する（最終モデル・バックテストのスイープ用）"""
+    return lgb.train(LGB_PARAMS, lgb.Dataset(X, label=y), num_boost_round=num_boost_round,
+                     callbacks=[lgb.log_evaluation(10)])
+
+
 def train_model(features_path: str, output_path: str, 
                 train_start: str = None, train_end: str = None,
-                forward_bars: int = 60):
+                forward_bars: int = 60,
+                buy_threshold: float = BUY_THRESHOLD, sell_threshold: float = SELL_THRESHOLD):
     """
     モデルを学習
     
     Args:
-        features_path: 特徴量Parquetファイルのパス
-        output_path: モデル保存先パス
+        features_path: 特徴量ストア（data/features/<PAIR>/tf=<TF>）または特徴量Parquetファイルのパス
+        output_path: モデルのバンドルの保存先（ディレクトリ。xxx.pkl なら xxx/ に書く）
         train_start: 学習開始日（YYYY-MM-DD）
         train_end: 学習終了日（YYYY-MM-DD）
         forward_bars: 予測先のバー数
+        buy_threshold / sell_threshold: 買い/売りのラベルの閾値（create_target）
+    
+    Returns:
+        学習結果の要約（保存先、行数、CVスコア、上位の特徴量）
     """
     if not LIGHTGBM_AVAILABLE:
         raise ImportError("LightGBM and scikit-learn required")
     
     print(f"[INFO] Loading features from {features_path}")
-    features_df = pd.read_parquet(features_path)
+    store = FeatureStore.from_path(features_path)
+    if store is not None:
+        # 学習期間の月・行グループだけを読む（train_end は下で < で絞る）
+        features_df = store.range(train_start, train_end)
+    else:
+        features_df = pd.read_parquet(features_path)
     
     # タイムスタンプ処理
     if 'ts' in features_df.columns:
@@ -118,7 +158,8 @@ def train_model(features_path: str, output_path: str,
     
     # ターゲット作成
     print("[INFO] Creating target variable...")
-    target = create_target(features_df, forward_bars=forward_bars)
+    target = create_target(features_df, forward_bars=forward_bars,
+                           buy_threshold=buy_threshold, sell_threshold=sell_threshold)
     
     # 特徴量準備
     X, feature_cols = prepare_features(features_df)
@@ -152,22 +193,8 @@ def train_model(features_path: str, output_path: str,
         train_data = lgb.Dataset(X_train, label=y_train)
         val_data = lgb.Dataset(X_val, label=y_val, reference=train_data)
         
-        params = {
-            'objective': 'multiclass',
-            'num_class': 3,
-            'metric': 'multi_logloss',
-            'boosting_type': 'gbdt',
-            'num_leaves': 31,
-            'learning_rate': 0.05,
-            'feature_fraction': 0.9,
-            'bagging_fraction': 0.8,
-            'bagging_freq': 5,
-            'verbose': -1,
-            'random_state': 42
-        }
-        
         model = lgb.train(
-            params,
+            LGB_PARAMS,
             train_data,
             valid_sets=[val_data],
             num_boost_round=100,
@@ -192,35 +219,26 @@ def train_model(features_path: str, output_path: str,
     
     # 最終モデル（全データで学習）
     print("[INFO] Training final model on all data...")
-    train_data = lgb.Dataset(X, label=y)
-    final_model = lgb.train(
-        params,
-        train_data,
-        num_boost_round=best_model.best_iteration if best_model else 100,
-        callbacks=[lgb.log_evaluation(10)]
-    )
+    final_model = fit_booster(X, y, num_boost_round=best_model.best_iteration if best_model else 100)
     
-    # 保存
-    output_path_obj = Path(output_path)
-    output_path_obj.parent.mkdir(parents=True, exist_ok=True)
-    
-    model_data = {
-        'model': final_model,
-        'feature_columns': feature_cols,
-        'forward_bars': forward_bars,
-        'train_date_range': (features_df.index.min(), features_df.index.max()),
-        'target_distribution': y.value_counts().to_dict(),
-        'cv_scores': {
-            'train_mean': np.mean(train_scores),
-            'val_mean': np.mean(val_scores),
-            'val_std': np.std(val_scores)
-        }
+    # 保存（LightGBMのネイティブ形式のモデル + manifest.json）
+    cv_scores = {
+        'train_mean': float(np.mean(train_scores)),
+        'val_mean': float(np.mean(val_scores)),
+        'val_std': float(np.std(val_scores))
     }
+    bundle = save_bundle(
+        output_path, final_model, feature_cols, frame_types(features_df[feature_cols]),
+        forward_bars=forward_bars,
+        target_thresholds={'buy': buy_threshold, 'sell': sell_threshold},
+        train_date_range=[features_df.index.min().isoformat(), features_df.index.max().isoformat()],
+        target_distribution={str(int(k)): int(v) for k, v in y.value_counts().sort_index().items()},
+        train_rows=int(len(X)),
+        best_iteration=final_model.current_iteration(),
+        cv_scores=cv_scores,
+    )
     
-    with open(output_path, 'wb') as f:
-        pickle.dump(model_data, f)
-    
-    print(f"[OK] Model saved to {output_path}")
+    print(f"[OK] Model saved to {bundle}")
     print(f"[INFO] Cross-validation scores: Train={np.mean(train_scores):.3f}, Val={np.mean(val_scores):.3f}±{np.std(val_scores):.3f}")
     
     # 特徴量重要度
@@ -231,25 +249,52 @@ def train_model(features_path: str, output_path: str,
     
     print("\n[INFO] Top 10 important features:")
     print(feature_importance.head(10).to_string(index=False))
+    
+    return {
+        "output": str(bundle),
+        "rows": int(len(X)),
+        "feature_count": len(feature_cols),
+        "train_date_range": [features_df.index.min().isoformat(), features_df.index.max().isoformat()],
+        "cv_scores": cv_scores,
+        "top_features": feature_importance['feature'].head(10).tolist(),
+    }
 
 
-def main():
+def run(argv: list = None) -> dict:
+    """
+    ジョブのエントリポイント（app.run_job からプロセスプール内で呼ばれる）
+
+    Returns:
+        train_model の結果
+    """
     ap = argparse.ArgumentParser()
-    ap.add_argument("--features", required=True, help="Features parquet path")
-    ap.add_argument("--output", default="models/fx_usdjpy_model.pkl", help="Output model path")
+    ap.add_argument("--features", required=True,
+                    help="Feature store dir (data/features/<PAIR>/tf=<TF>) or features parquet path")
+    ap.add_argument("--output", default="models/fx_usdjpy_model",
+                    help="Output model bundle directory (a legacy .pkl path writes the bundle next to it)")
     ap.add_argument("--train-start", help="Training start date (YYYY-MM-DD)")
     ap.add_argument("--train-end", help="Training end date (YYYY-MM-DD)")
     ap.add_argument("--forward-bars", type=int, default=60, help="Forward bars for target (default: 60)")
-    args = ap.parse_args()
+    ap.add_argument("--buy-threshold", type=float, default=BUY_THRESHOLD,
+                    help="Forward return above which the label is buy (default: 0.001)")
+    ap.add_argument("--sell-threshold", type=float, default=SELL_THRESHOLD,
+                    help="Forward return below which the label is sell (default: -0.001)")
+    args = ap.parse_args(argv)
     
-    train_model(
+    return train_model(
         features_path=args.features,
         output_path=args.output,
         train_start=args.train_start,
         train_end=args.train_end,
-        forward_bars=args.forward_bars
+        forward_bars=args.forward_bars,
+        buy_threshold=args.buy_threshold,
+        sell_threshold=args.sell_threshold
     )
 
 
+def main():
+    run()
+
+
 if __name__ == "__main__":
     main()
@@ -0,0 +1,148 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+学習済みモデルの推論アダプタ
+
+lgb.Booster（学習ジョブが保存する形式。predict がクラス確率を返す）と
+sklearnのモデル（predict_proba。LGBMClassifier など）のどちらも、1回の推論で
+クラス確率（行数 × num_class、列は クラス 0..num_class-1 の順）を返す。
+
+入力行列は学習時の特徴量の列順に並べ、プロセス内で使い回すバッファに書く（NaN/inf は学習時と同じく0）。
+バッファは推論ごとに確保し直さず、足りなくなったときだけ大きくする。
+同じエージェントを複数スレッドから使うため、バッファへの書き込みと推論はロックの中で行う。
+"""
+
+import threading
+from typing import Dict, List, Optional
+
+import numpy as np
+import pandas as pd
+
+
+class ModelAdapter:
+    """モデル（Booster / sklearn）→ クラス確率"""
+
+    def __init__(self, model, feature_columns: Optional[List[str]] = None, num_class: int = 3,
+                 initial_rows: int = 1):
+        """
+        Args:
+            model: lgb.Booster または predict_proba を持つモデル
+            feature_columns: 学習時の特徴量の列（None ならモデルの特徴量名、それも無ければ数値列すべて）
+            num_class: クラス数（0=売り, 1=様子見, 2=買い）
+            initial_rows: 最初に確保するバッファの行数
+        """
+        self.model = model
+        self.num_class = num_class
+        self.kind = "sklearn" if hasattr(model, "predict_proba") else "booster"
+        self.feature_columns = list(feature_columns) if feature_columns else self._model_feature_names(model)
+
+        # sklearnのモデルは classes_ の順に確率を返すので、クラス番号の列に並べ替える
+        self._class_index = None
+        classes = getattr(model, "classes_", None) if self.kind == "sklearn" else None
+        if classes is not None:
+            self._class_index = np.asarray(classes, dtype=np.int64)
+            if ((self._class_index < 0) | (self._class_index >= num_class)).any():
+                raise ValueError(f"model classes {list(classes)} are outside 0..{num_class - 1}")
+
+        self._buffer = np.zeros((max(initial_rows, 1), len(self.feature_columns or [])), dtype=np.float64)
+        self._columns = None  # 直近の入力の列（Index）
+        self._positions = None  # 入力での各特徴量の位置（無い列は -1）
+        self._lock = threading.Lock()
+
+        self.calls = 0
+        self.rows = 0
+        self.errors = 0
+
+    def __repr__(self):
+        n = len(self.feature_columns) if self.feature_columns else "auto"
+        return f"ModelAdapter({self.kind}, features={n}, classes={self.num_class})"
+
+    @staticmethod
+    def _model_feature_names(model) -> Optional[List[str]]:
+        for attr in ("feature_name", "feature_name_", "feature_names_in_"):
+            names = getattr(model, attr, None)
+            if callable(names):
+                names = names()
+            if names is not None and len(names) > 0:
+                return list(names)
+        return None
+
+    def _indexer(self, features_df: pd.DataFrame) -> np.ndarray:
+        """特徴量の列 → features_df の列位置（列が同じ Index なら前回の結果を使う）"""
+        if self._columns is not features_df.columns:
+            positions = features_df.columns.get_indexer(self.feature_columns)
+            missing = [c for c, p in zip(self.feature_columns, positions) if p < 0]
+            if missing:
+                print(f"[WARN] {len(missing)} model features missing from features_df (filled with 0): {missing[:5]}")
+            self._columns, self._positions = features_df.columns, positions
+        return self._positions
+
+    def _fill(self, features_df: pd.DataFrame) -> np.ndarray:
+        """入力行列をバッファに書いて、その先頭 n 行のビューを返す（ロックの中で呼ぶ）"""
+        n = len(features_df)
+        if n > len(self._buffer):
+            self._buffer = np.zeros((max(n, 2 * len(self._buffer)), self._buffer.shape[1]), dtype=np.float64)
+        X = self._buffer[:n]
+
+        positions = self._indexer(features_df)
+        present = positions >= 0
+        if present.all():
+            X[:] = features_df.iloc[:, positions].to_numpy(dtype=np.float64, na_value=np.nan)
+        else:
+            X[:, ~present] = 0.0
+            X[:, present] = features_df.iloc[:, positions[present]].to_numpy(dtype=np.float64, na_value=np.nan)
+        np.nan_to_num(X, copy=False, nan=0.0, posinf=0.0, neginf=0.0)
+        return X
+
+    def _proba(self, X: np.ndarray) -> np.ndarray:
+        if self.kind == "sklearn":
+            raw = np.asarray(self.model.predict_proba(X), dtype=np.float64)
+        else:
+            raw = np.asarray(self.model.predict(X), dtype=np.float64)
+        if raw.ndim != 2 or len(raw) != len(X):
+            raise ValueError(f"model returned shape {raw.shape}, expected ({len(X)}, {self.num_class}) "
+                             "class probabilities")
+        if self._class_index is not None:
+            proba = np.zeros((len(X), self.num_class), dtype=np.float64)
+            proba[:, self._class_index] = raw
+            return proba
+        if raw.shape[1] != self.num_class:
+            raise ValueError(f"model returned {raw.shape[1]} classes, expected {self.num_class}")
+        return raw
+
+    def predict_proba(self, features_df: pd.DataFrame) -> np.ndarray:
+        """
+        クラス確率（len(features_df) × num_class）
+
+        Raises:
+            ValueError: モデルがクラス確率を返さない（2値・回帰モデルなど）
+        """
+        if self.feature_columns is None:
+            # 特徴量名の無い旧モデル: 数値列すべて（列の組が入力ごとに変わりうるのでバッファは使わない）
+            X = features_df.select_dtypes(include=[np.number]).to_numpy(dtype=np.float64, na_value=0.0)
+            X[~np.isfinite(X)] = 0.0
+            with self._lock:
+                return self._count(X)
+        with self._lock:
+            return self._count(self._fill(features_df))
+
+    def _count(self, X: np.ndarray) -> np.ndarray:
+        self.calls += 1
+        try:
+            proba = self._proba(X)
+        except Exception:
+            self.errors += 1
+            raise
+        self.rows += len(X)
+        return proba
+
+    def stats(self) -> Dict:
+        return {
+            "kind": self.kind,
+            "features": len(self.feature_columns) if self.feature_columns else None,
+            "calls": self.calls,
+            "rows": self.rows,
+            "errors": self.errors,
+            "buffer_rows": len(self._buffer),
+        }
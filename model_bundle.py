@@ -0,0 +1,210 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+学習済みモデルのバンドル（models/fx_<pair>_model/）
+
+    manifest.json  特徴量の列・学習条件・CVスコア・特徴量スキーマのハッシュ・モデルファイルのsha256
+    model.txt      LightGBMのネイティブ形式（テキスト）のモデル
+
+読み込みはモデルファイルを1回だけ読んでsha256を確かめ、同じバイト列からBoosterを作る（pickleを使わない）。
+特徴量ストアを渡すと、マニフェストの特徴量スキーマと実際のパーティションのスキーマを比べる。
+バンドルが無く旧形式の .pkl だけがある場合はそれを読む（自分で作ったファイルに限ること）。
+"""
+
+import hashlib
+import json
+import os
+import pickle
+import shutil
+import tempfile
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple, Union
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+PathLike = Union[str, Path]
+
+FORMAT = "fx-model-bundle"
+FORMAT_VERSION = 1
+MANIFEST_NAME = "manifest.json"
+MODEL_NAME = "model.txt"
+
+
+class BundleError(Exception):
+    """バンドルが壊れている・形式が違う・特徴量と合わない"""
+
+
+def bundle_path(path: PathLike) -> Path:
+    """モデルのパス（旧形式の xxx.pkl でもよい）からバンドルのディレクトリ"""
+    path = Path(path)
+    return path.with_suffix("") if path.suffix == ".pkl" else path
+
+
+def is_bundle(path: PathLike) -> bool:
+    return (Path(path) / MANIFEST_NAME).is_file()
+
+
+def resolve(path: PathLike) -> Optional[Path]:
+    """
+    読み込むモデルのパス
+    バンドルがあればバンドル、無ければ旧形式の .pkl、どちらも無ければ None
+    """
+    bundle = bundle_path(path)
+    if is_bundle(bundle):
+        return bundle
+    legacy = Path(path) if Path(path).suffix == ".pkl" else bundle.with_suffix(".pkl")
+    return legacy if legacy.is_file() else None
+
+
+def artifact_files(path: PathLike) -> List[Path]:
+    """モデルの更新判定に使うファイル（バンドルはマニフェストとモデル、旧形式は .pkl）"""
+    bundle = bundle_path(path)
+    resolved = resolve(path)
+    if resolved is None:
+        return [bundle / MANIFEST_NAME, bundle / MODEL_NAME]
+    if resolved.is_dir():
+        return [resolved / MANIFEST_NAME, resolved / MODEL_NAME]
+    return [resolved]
+
+
+def feature_schema(columns: List[str], types: Dict[str, pa.DataType]) -> List[List[str]]:
+    """[[列名, Arrowの型], ...]（列は学習時の順）"""
+    return [[c, str(types[c]) if c in types else "missing"] for c in columns]
+
+
+def schema_hash(schema: List[List[str]]) -> str:
+    return hashlib.sha256(json.dumps(schema, separators=(",", ":")).encode("utf-8")).hexdigest()
+
+
+def frame_types(df: pd.DataFrame) -> Dict[str, pa.DataType]:
+    schema = pa.Schema.from_pandas(df.iloc[:0], preserve_index=False)
+    return {f.name: f.type for f in schema}
+
+
+def store_types(store) -> Optional[Dict[str, pa.DataType]]:
+    """特徴量ストアの最新パーティション（無ければ旧形式のファイル）の列の型"""
+    files = store.partitions() or ([store.legacy_path] if store.legacy_path.exists() else [])
+    if not files:
+        return None
+    return {f.name: f.type for f in pq.read_schema(files[-1])}
+
+
+def save_bundle(path: PathLike, booster, feature_columns: List[str], feature_types: Dict[str, pa.DataType],
+                **metadata) -> Path:
+    """
+    バンドルを書き出す（一時ディレクトリに作ってから置き換えるので、読み込み中のプロセスは古い方を読み切る）
+
+    Args:
+        booster: lgb.Booster
+        feature_types: 特徴量の列の型（frame_types(学習データ)）
+        metadata: forward_bars, cv_scores, train_date_range などマニフェストに入れる値（JSONにできること）
+    """
+    import lightgbm as lgb
+
+    path = bundle_path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp = Path(tempfile.mkdtemp(prefix=f".{path.name}.", dir=path.parent))
+    try:
+        model_file = tmp / MODEL_NAME
+        booster.save_model(str(model_file))
+        with open(model_file, "rb") as f:
+            digest = hashlib.sha256(f.read()).hexdigest()
+
+        schema = feature_schema(feature_columns, feature_types)
+        manifest = {
+            "format": FORMAT,
+            "format_version": FORMAT_VERSION,
+            "created_at": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+            "lightgbm_version": lgb.__version__,
+            "model_file": MODEL_NAME,
+            "model_sha256": digest,
+            "model_size": model_file.stat().st_size,
+            "num_class": booster.num_model_per_iteration(),
+            "feature_columns": list(feature_columns),
+            "feature_schema": schema,
+            "feature_schema_hash": schema_hash(schema),
+            **metadata,
+        }
+        with open(tmp / MANIFEST_NAME, "w", encoding="utf-8") as f:
+            json.dump(manifest, f, ensure_ascii=False, indent=2, default=str)
+
+        # 古いバンドルを退避してから入れ替える
+        old = None
+        if path.exists():
+            old = path.with_name(f".{path.name}.old-{os.getpid()}")
+            os.replace(path, old)
+        os.replace(tmp, path)
+        if old is not None:
+            shutil.rmtree(old, ignore_errors=True)
+    except Exception:
+        shutil.rmtree(tmp, ignore_errors=True)
+        raise
+    return path
+
+
+def read_manifest(path: PathLike) -> dict:
+    with open(Path(path) / MANIFEST_NAME, "r", encoding="utf-8") as f:
+        manifest = json.load(f)
+    if manifest.get("format") != FORMAT:
+        raise BundleError(f"not a model bundle: {path}")
+    if manifest.get("format_version", 0) > FORMAT_VERSION:
+        raise BundleError(f"unsupported bundle version {manifest.get('format_version')} (max {FORMAT_VERSION})")
+    return manifest
+
+
+def check_schema(manifest: dict, types: Optional[Dict[str, pa.DataType]]) -> Tuple[List[str], List[str]]:
+    """
+    マニフェストの特徴量スキーマと実際の列の型を比べる
+
+    Returns:
+        (足りない列, 型が変わった列)
+    """
+    if types is None:
+        return [], []
+    live = feature_schema(manifest["feature_columns"], types)
+    if schema_hash(live) == manifest.get("feature_schema_hash"):
+        return [], []
+    expected = dict(map(tuple, manifest.get("feature_schema", [])))
+    missing = [c for c, t in live if t == "missing"]
+    changed = [c for c, t in live if t != "missing" and expected.get(c) not in (None, t)]
+    return missing, changed
+
+
+def load_bundle(path: PathLike, types: Optional[Dict[str, pa.DataType]] = None) -> Tuple[object, dict]:
+    """
+    バンドルを読み込む
+
+    Args:
+        types: 実際の特徴量の列の型（store_types(store)）。足りない列があれば BundleError
+
+    Returns:
+        (lgb.Booster, manifest)
+    """
+    import lightgbm as lgb
+
+    path = Path(path)
+    manifest = read_manifest(path)
+    missing, changed = check_schema(manifest, types)
+    if missing:
+        raise BundleError(f"{len(missing)} model features are missing from the feature store: {missing[:5]}")
+    if changed:
+        print(f"[WARN] feature types changed since training: {changed[:5]}")
+
+    data = (path / manifest.get("model_file", MODEL_NAME)).read_bytes()
+    digest = hashlib.sha256(data).hexdigest()
+    if digest != manifest["model_sha256"]:
+        raise BundleError(f"model file hash mismatch: {digest} != {manifest['model_sha256']}")
+    # ハッシュを確かめたのと同じバイト列から作る
+    booster = lgb.Booster(model_str=data.decode("utf-8"))
+    return booster, manifest
+
+
+def load_legacy_pickle(path: PathLike) -> dict:
+    """旧形式（pickleしたdict）。任意のコードを実行できるので自分で作ったファイルに限る"""
+    print(f"[WARN] Loading legacy pickled model {path}. Retrain to write a model bundle.")
+    with open(path, "rb") as f:
+        return pickle.load(f)
@@ -0,0 +1,367 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+データパイプライン（DAG）
+
+各ステップの入力・出力（ファイル/ディレクトリ）と依存関係を宣言し、依存の終わったステップから
+JobRunner のプロセスプールで実行する（イベント取得とバー生成のように独立した枝は並列に動く）。
+
+ステップのキーは「ジョブのコード + 引数 + 入力ファイルの内容ハッシュ」で、前回成功時と同じキーで
+出力も残っていれば実行をスキップする。ファイルのハッシュは (mtime_ns, size) が変わったものだけ
+計算し直す（data/pipeline/hashes.json）。
+実行ごとのステップの結果と所要時間は data/logs/pipeline_runs.jsonl に1行で追記する。
+
+使い方:
+    python3 pipeline.py --pair USDJPY --days-back 7
+    python3 pipeline.py --pair USDJPY --days-back 7 --dry-run   # 何が実行されるかだけ表示
+    python3 pipeline.py --pairs USDJPY,EURUSD,GBPJPY --days-back 7
+"""
+
+import argparse
+import hashlib
+import json
+import os
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from dataclasses import dataclass, field
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+from typing import Dict, List, Optional, Union
+
+from fx_pairs import parse_pairs
+from job_runner import JOBS_DIR, JobRunner
+
+STATE_DIR = Path("data/pipeline")
+LOG_PATH = Path("data/logs/pipeline_runs.jsonl")
+
+HASH_CHUNK = 1 << 20
+
+
+@dataclass
+class Step:
+    """パイプラインの1ステップ（jobs/<job>.py の run(args) を実行する）"""
+    name: str
+    job: str
+    args: List[str]
+    inputs: List[str] = field(default_factory=list)
+    outputs: List[str] = field(default_factory=list)
+    deps: List[str] = field(default_factory=list)
+    optional: bool = False  # 失敗しても後続を止めない
+    always: bool = False    # 外部から取得するステップ（入力をハッシュできないので毎回実行）
+    timeout: int = 3600
+
+
+# --- 内容ハッシュ ---
+
+class HashCache:
+    """ファイルパス → (mtime_ns, size, sha256)。stat が変わらないファイルは読み直さない"""
+
+    def __init__(self, path: Path):
+        self.path = path
+        self.entries: Dict[str, list] = {}
+        if path.exists():
+            try:
+                self.entries = json.loads(path.read_text(encoding="utf-8"))
+            except (OSError, ValueError):
+                self.entries = {}
+        self.hashed = 0
+
+    def file_hash(self, p: Path) -> str:
+        st = p.stat()
+        key = str(p)
+        entry = self.entries.get(key)
+        if entry and entry[0] == st.st_mtime_ns and entry[1] == st.st_size:
+            return entry[2]
+        h = hashlib.sha256()
+        with open(p, "rb") as f:
+            for chunk in iter(lambda: f.read(HASH_CHUNK), b""):
+                h.update(chunk)
+        digest = h.hexdigest()
+        self.entries[key] = [st.st_mtime_ns, st.st_size, digest]
+        self.hashed += 1
+        return digest
+
+    def path_hash(self, path: str) -> str:
+        """ファイルならその内容、ディレクトリなら配下の全ファイルの（相対パス, 内容）のハッシュ"""
+        p = Path(path)
+        if p.is_file():
+            return self.file_hash(p)
+        if not p.is_dir():
+            return "missing"
+        h = hashlib.sha256()
+        for f in sorted(x for x in p.rglob("*") if x.is_file() and not x.name.endswith(".tmp")):
+            h.update(str(f.relative_to(p)).encode())
+            h.update(self.file_hash(f).encode())
+        return h.hexdigest()
+
+    def save(self):
+        # 消えたファイルのエントリは捨てる
+        self.entries = {k: v for k, v in self.entries.items() if os.path.exists(k)}
+        _write_json(self.path, self.entries)
+
+
+def _write_json(path: Path, obj):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp = path.with_name(path.name + ".tmp")
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(obj, f, indent=1)
+    os.replace(tmp, path)
+
+
+def step_key(step: Step, hashes: HashCache) -> str:
+    """ジョブのコード・引数・入力の内容から求めたキー"""
+    h = hashlib.sha256()
+    h.update(hashes.file_hash(JOBS_DIR / f"{step.job}.py").encode())
+    h.update(json.dumps(step.args).encode())
+    for path in step.inputs:
+        h.update(path.encode())
+        h.update(hashes.path_hash(path).encode())
+    return h.hexdigest()
+
+
+def outputs_exist(step: Step) -> bool:
+    return all(Path(p).exists() for p in step.outputs)
+
+
+# --- パイプラインの定義 ---
+
+def build_pipeline(pairs: Union[str, List[str]], start_date: str, end_date: str,
+                   tf: str = "M5", events_db: str = "data/events/events.sqlite",
+                   train: bool = True, pair_workers: int = 1) -> List[Step]:
+    """
+    download_bi5 → build_m1_from_bi5 → build_bars_from_m1 ─┐
+    fetch_macro_events ────────────────────────────────────┤
+    fetch_rss_events ──────────────────────────────────────┴→ build_features → auto_train
+
+    start_date / end_date は YYYY-MM-DD（end_date は含まない）
+    pairs が複数なら各ジョブを --pairs で1回ずつ実行する（イベントは全ペアで1回だけ読み込む）。
+    auto_train はペアごとのステップになる
+    """
+    pairs = [pairs] if isinstance(pairs, str) else list(pairs)
+    pairs = [p.upper() for p in pairs]
+    if len(pairs) == 1:
+        pair_args = ["--pair", pairs[0]]
+        worker_args = []
+    else:
+        pair_args = ["--pairs", ",".join(pairs)]
+        worker_args = ["--workers", str(pair_workers)]
+
+    def each(fmt: str) -> List[str]:
+        return [fmt.format(pair=p, tf=tf) for p in pairs]
+
+    raw_dirs = each("data/raw_bi5/{pair}")
+    m1_dirs = each("data/bars/{pair}/tf=M1")
+    bars_dirs = each("data/bars/{pair}/tf={tf}")
+    features_dirs = each("data/features/{pair}/tf={tf}")
+
+    steps = [
+        Step("download_bi5", "download_bi5",
+             pair_args + ["--start", f"{start_date}T00", "--end", f"{end_date}T00"],
+             outputs=raw_dirs),
+        Step("build_m1", "build_m1_from_bi5",
+             pair_args + worker_args + ["--start-date", start_date, "--end-date", end_date],
+             inputs=raw_dirs, outputs=m1_dirs, deps=["download_bi5"]),
+        Step("build_bars", "build_bars_from_m1",
+             pair_args + worker_args,
+             inputs=m1_dirs, outputs=bars_dirs, deps=["build_m1"]),
+        # イベントストアはSQLite（WAL）なので2つの取得を同時に書き込んでよい
+        Step("fetch_macro_events", "fetch_macro_events",
+             ["--events-cache", events_db],
+             outputs=[events_db], optional=True, always=True, timeout=600),
+        Step("fetch_rss_events", "fetch_rss_events",
+             ["--events-cache", events_db],
+             outputs=[events_db], optional=True, always=True, timeout=600),
+        # WALに残っている書き込みも入力に含める
+        Step("build_features", "build_features",
+             pair_args + worker_args + ["--timeframe", tf, "--events-cache", events_db],
+             inputs=bars_dirs + [events_db, events_db + "-wal"], outputs=features_dirs,
+             deps=["build_bars", "fetch_macro_events", "fetch_rss_events"]),
+    ]
+    if train:
+        for pair, features_dir in zip(pairs, features_dirs):
+            name = "auto_train" if len(pairs) == 1 else f"auto_train_{pair}"
+            steps.append(Step(name, "auto_train_model",
+                              ["--pair", pair, "--features-tf", tf],
+                              inputs=[features_dir], deps=["build_features"]))
+    return steps
+
+
+def _check_dag(steps: List[Step]):
+    names = {s.name for s in steps}
+    if len(names) != len(steps):
+        raise ValueError("duplicate step names")
+    for s in steps:
+        missing = [d for d in s.deps if d not in names]
+        if missing:
+            raise ValueError(f"step {s.name} depends on unknown steps: {missing}")
+    # 循環の検出
+    done, pending = set(), {s.name: set(s.deps) for s in steps}
+    while pending:
+        ready = [n for n, deps in pending.items() if deps <= done]
+        if not ready:
+            raise ValueError(f"dependency cycle among: {sorted(pending)}")
+        for n in ready:
+            done.add(n)
+            del pending[n]
+
+
+# --- 実行 ---
+
+def run_pipeline(steps: List[Step], runner: Optional[JobRunner] = None, workers: int = 2,
+                 force: bool = False, dry_run: bool = False,
+                 state_dir: Path = STATE_DIR, log_path: Optional[Path] = LOG_PATH) -> dict:
+    """
+    DAGを実行する
+
+    ステップの状態:
+        done: 実行して成功 / skipped: 入力が前回と同じ / failed: 失敗
+        blocked: 依存ステップが失敗した / planned: --dry-run で実行対象
+
+    Returns:
+        {"ok", "run_id", "elapsed_sec", "steps": {name: {"status", "elapsed_sec", ...}}}
+    """
+    _check_dag(steps)
+    state_path = state_dir / "state.json"
+    state = json.loads(state_path.read_text(encoding="utf-8")) if state_path.exists() else {}
+    hashes = HashCache(state_dir / "hashes.json")
+
+    own_runner = runner is None and not dry_run
+    if own_runner:
+        # 相対パスの入出力をこのプロセスと同じ場所で解決させる
+        runner = JobRunner(workers=workers, cwd=os.getcwd())
+
+    run_id = datetime.now(timezone.utc).strftime("%Y%m%dT%H%M%SZ")
+    t_start = time.perf_counter()
+    by_name = {s.name: s for s in steps}
+    results: Dict[str, dict] = {}
+    running = {}  # future -> (step, 実行前のキー, t0)
+    started = set()
+    ok_status = ("done", "skipped", "planned")
+
+    def settled(name: str) -> bool:
+        return name in results
+
+    def dep_ok(name: str) -> bool:
+        res = results[name]
+        return res["status"] in ok_status or by_name[name].optional
+
+    try:
+        with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+            while len(results) < len(steps):
+                launched = False
+                for step in steps:
+                    if settled(step.name) or step.name in started:
+                        continue
+                    if not all(settled(d) for d in step.deps):
+                        continue
+                    if not all(dep_ok(d) for d in step.deps):
+                        failed = [d for d in step.deps if not dep_ok(d)]
+                        results[step.name] = {"status": "blocked", "reason": f"failed deps: {failed}"}
+                        print(f"[WARN] {step.name}: blocked by {failed}")
+                        launched = True
+                        continue
+
+                    if dry_run and any(results[d]["status"] == "planned" for d in step.deps):
+                        results[step.name] = {"status": "planned", "reason": "upstream will run"}
+                        print(f"[INFO] {step.name}: would run (upstream will run)")
+                        launched = True
+                        continue
+
+                    key = step_key(step, hashes)
+                    if not (force or step.always) and state.get(step.name, {}).get("key") == key and outputs_exist(step):
+                        results[step.name] = {"status": "skipped", "reason": "inputs unchanged", "elapsed_sec": 0.0}
+                        print(f"[INFO] {step.name}: skipped (inputs unchanged)")
+                        launched = True
+                        continue
+                    if dry_run:
+                        results[step.name] = {"status": "planned",
+                                              "reason": "always" if step.always else "inputs changed"}
+                        print(f"[INFO] {step.name}: would run ({results[step.name]['reason']})")
+                        launched = True
+                        continue
+
+                    print(f"[INFO] {step.name}: start ({step.job} {' '.join(step.args)})")
+                    future = pool.submit(runner.run, step.job, step.args, step.timeout)
+                    running[future] = (step, key, time.perf_counter())
+                    started.add(step.name)
+                    launched = True
+
+                if launched:
+                    continue
+                if not running:
+                    break  # 到達しないはず（_check_dag で循環は除いている）
+
+                finished, _ = wait(list(running), return_when=FIRST_COMPLETED)
+                for future in finished:
+                    step, _, t0 = running.pop(future)
+                    try:
+                        res = future.result()
+                    except Exception as e:
+                        res = {"ok": False, "error": f"{type(e).__name__}: {e}"}
+                    elapsed = round(time.perf_counter() - t0, 3)
+                    summary = {k: v for k, v in res.items() if k not in ("log", "ok", "elapsed_sec")}
+                    if res.get("ok"):
+                        # 実行後の入力で取り直す（自分の入力を書き換えるステップでも次回スキップできるように）
+                        state[step.name] = {"key": step_key(step, hashes),
+                                            "finished_at": datetime.now(timezone.utc).isoformat(timespec="seconds")}
+                        _write_json(state_path, state)
+                        results[step.name] = {"status": "done", "elapsed_sec": elapsed, "result": summary}
+                        print(f"[OK] {step.name}: done in {elapsed:.1f}s")
+                    else:
+                        results[step.name] = {"status": "failed", "elapsed_sec": elapsed,
+                                              "error": res.get("error"), "log_tail": (res.get("log") or "")[-2000:]}
+                        level = "[WARN]" if step.optional else "[ERROR]"
+                        print(f"{level} {step.name}: failed in {elapsed:.1f}s: {res.get('error')}")
+    finally:
+        if own_runner:
+            runner.shutdown()
+        hashes.save()
+
+    elapsed = round(time.perf_counter() - t_start, 3)
+    ok = all(r["status"] in ok_status or by_name[n].optional for n, r in results.items())
+    record = {"run_id": run_id, "ok": ok, "dry_run": dry_run, "elapsed_sec": elapsed,
+              "files_hashed": hashes.hashed,
+              "steps": {s.name: results.get(s.name, {"status": "not_run"}) for s in steps}}
+
+    if log_path is not None and not dry_run:
+        log_path.parent.mkdir(parents=True, exist_ok=True)
+        with open(log_path, "a", encoding="utf-8") as f:
+            f.write(json.dumps(record, ensure_ascii=False, default=str) + "\n")
+
+    print(f"[{'OK' if ok else 'ERROR'}] pipeline {run_id} finished in {elapsed:.1f}s")
+    for s in steps:
+        r = record["steps"][s.name]
+        print(f"    {s.name:<20} {r['status']:<8} {r.get('elapsed_sec', 0.0):>8.1f}s")
+    return record
+
+
+def main():
+    ap = argparse.ArgumentParser(description="Run the data pipeline as a DAG with step caching")
+    ap.add_argument("--pair", default="USDJPY")
+    ap.add_argument("--pairs", help="Comma separated pairs (or 'all') processed together by each job")
+    ap.add_argument("--pair-workers", type=int, default=2, help="Processes each job spreads --pairs over")
+    ap.add_argument("--days-back", type=int, default=7, help="Days of bi5 data to download")
+    ap.add_argument("--start-date", help="UTC start date (default: today - days-back)")
+    ap.add_argument("--end-date", help="UTC end date, exclusive (default: today)")
+    ap.add_argument("--timeframe", default="M5", help="Features timeframe")
+    ap.add_argument("--no-train", action="store_true", help="Skip the auto_train step")
+    ap.add_argument("--workers", type=int, default=2, help="Parallel job processes")
+    ap.add_argument("--force", action="store_true", help="Run every step even if its inputs are unchanged")
+    ap.add_argument("--dry-run", action="store_true", help="Show which steps would run")
+    args = ap.parse_args()
+
+    today = datetime.now(timezone.utc).date()
+    end_date = args.end_date or today.isoformat()
+    start_date = args.start_date or (today - timedelta(days=args.days_back)).isoformat()
+
+    pairs = parse_pairs(args.pair, args.pairs)
+    steps = build_pipeline(pairs, start_date, end_date, tf=args.timeframe, train=not args.no_train,
+                           pair_workers=args.pair_workers)
+    record = run_pipeline(steps, workers=args.workers, force=args.force, dry_run=args.dry_run)
+    if not record["ok"]:
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -35,7 +35,7 @@ else
 fi
 
 # 特徴量ファイルの存在確認
-if [ -f "data/features/USDJPY/M5_features.parquet" ]; then
+if [ -d "data/features/USDJPY/tf=M5" ] || [ -f "data/features/USDJPY/M5_features.parquet" ]; then
     echo "✅ 特徴量ファイルが見つかりました"
 else
     echo "⚠️ 特徴量ファイルが見つかりません。先に特徴量を生成してください:"
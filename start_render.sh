@@ -13,7 +13,7 @@ mkdir -p data/{raw_bi5,bars,features,events,logs,merged,yahoo_finance,oanda}
 mkdir -p models
 
 # 特徴量ファイルが存在するか確認
-if [ ! -f "data/features/USDJPY/M5_features.parquet" ]; then
+if [ ! -d "data/features/USDJPY/tf=M5" ] && [ ! -f "data/features/USDJPY/M5_features.parquet" ]; then
     echo "[INFO] 特徴量ファイルが見つかりません。データパイプラインを実行します..."
     
     # 最新7日分のデータを取得
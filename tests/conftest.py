@@ -0,0 +1,103 @@
+# -*- coding: utf-8 -*-
+
+"""
+テスト共通のフィクスチャ
+
+local_http: ローカルの http.server（外部のデータフィード・RSSの代わり）
+    server.route(path, *responses) でパスごとの応答を順に返す（最後の応答を繰り返す）
+    server.requests に受け取ったリクエストの (path, headers) を記録する
+"""
+
+import sys
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).parent.parent))
+
+
+class Response:
+    """
+    Args:
+        status: HTTPステータス
+        body: 本文
+        headers: 追加のヘッダ
+        truncate: 本文をこのバイト数だけ送って接続を切る（Content-Length は本文全体）
+    """
+
+    def __init__(self, status: int = 200, body: bytes = b"", headers: dict = None, truncate: int = None):
+        self.status = status
+        self.body = body
+        self.headers = headers or {}
+        self.truncate = truncate
+
+
+class LocalServer:
+    def __init__(self):
+        self.routes = {}
+        self.requests = []
+        self._lock = threading.Lock()
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def do_GET(self):
+                resp = server._next(self.path, dict(self.headers))
+                self.send_response(resp.status)
+                for k, v in resp.headers.items():
+                    self.send_header(k, v)
+                self.send_header("Content-Length", str(len(resp.body)))
+                if resp.truncate is not None:
+                    self.send_header("Connection", "close")
+                self.end_headers()
+                if resp.truncate is not None:
+                    self.wfile.write(resp.body[:resp.truncate])
+                    self.wfile.flush()
+                    self.close_connection = True
+                    return
+                if resp.status != 304:
+                    self.wfile.write(resp.body)
+
+            def log_message(self, *args):
+                pass
+
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.httpd.daemon_threads = True
+        self.url = f"http://127.0.0.1:{self.httpd.server_address[1]}"
+        self._thread = threading.Thread(target=self.httpd.serve_forever, kwargs={"poll_interval": 0.05},
+                                        daemon=True)
+
+    def route(self, path: str, *responses: Response):
+        with self._lock:
+            self.routes[path] = list(responses)
+
+    def _next(self, path: str, headers: dict) -> Response:
+        with self._lock:
+            self.requests.append((path, headers))
+            queue = self.routes.get(path)
+            if not queue:
+                return Response(404)
+            return queue.pop(0) if len(queue) > 1 else queue[0]
+
+    def paths(self):
+        return [p for p, _ in self.requests]
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+@pytest.fixture
+def local_http():
+    server = LocalServer().start()
+    try:
+        yield server
+    finally:
+        server.stop()
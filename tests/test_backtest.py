@@ -0,0 +1,44 @@
+# -*- coding: utf-8 -*-
+
+"""jobs/backtest の閾値スイープを小さな特徴量ストアで動かす"""
+
+import numpy as np
+import pandas as pd
+
+from feature_store import FeatureStore
+from jobs import backtest
+
+
+def write_features(rows: int = 600) -> pd.DataFrame:
+    rng = np.random.default_rng(0)
+    ts = pd.date_range("2024-02-01", periods=rows, freq="5min", tz="UTC")
+    close = 150 * np.exp(np.cumsum(rng.normal(0, 5e-4, rows)))
+    feat = pd.DataFrame({"close": close, "spread": 0.002}, index=pd.DatetimeIndex(ts, name="ts"))
+    feat["logret_1"] = np.log(feat["close"]).diff()
+    feat["vol_20"] = feat["logret_1"].rolling(20).std()
+    feat["ma_20"] = feat["close"].rolling(20).mean()
+    FeatureStore("USDJPY", "M5").write(feat)
+    return feat
+
+
+def test_date_only_split_is_utc(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    feat = write_features()
+
+    summary = backtest.run(["--pair", "USDJPY", "--timeframe", "M5", "--target-thresholds", "0.0005,0.001",
+                            "--split", "2024-02-02", "--forward-bars", "12", "--confidence-cutoffs", "0.0"])
+
+    assert summary["split"] == "2024-02-02T00:00:00+00:00"
+    train_rows = int((feat.index < pd.Timestamp("2024-02-02", tz="UTC")).sum()) - 12
+    assert {r["target_threshold"] for r in summary["results"]} == {0.0005, 0.001}
+    assert all(r["train_rows"] == train_rows for r in summary["results"])
+
+
+def test_default_split_is_70_percent(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    feat = write_features()
+
+    summary = backtest.run(["--pair", "USDJPY", "--timeframe", "M5", "--target-thresholds", "0.001",
+                            "--forward-bars", "12", "--confidence-cutoffs", "0.0"])
+
+    assert pd.Timestamp(summary["split"]) == feat.index[int(len(feat) * 0.7)]
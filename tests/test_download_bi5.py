@@ -0,0 +1,85 @@
+# -*- coding: utf-8 -*-
+
+"""jobs/download_bi5 をローカルのHTTPサーバーに向けて動かす"""
+
+from datetime import datetime, timezone
+from pathlib import Path
+
+from conftest import Response
+from jobs import download_bi5
+from jobs.bi5_manifest import Bi5Manifest, STATUS_EMPTY, STATUS_ERROR, STATUS_MISSING, STATUS_OK, hour_key
+
+PAIR = "USDJPY"
+HOUR = datetime(2024, 1, 2, 0, tzinfo=timezone.utc)
+
+
+def hour_url_path(dt: datetime) -> str:
+    return download_bi5.bi5_url(PAIR, dt, base="")
+
+
+def test_fetch_hour_retries_5xx(local_http, tmp_path):
+    local_http.route(hour_url_path(HOUR), Response(503), Response(502), Response(200, b"ticks"))
+    out = download_bi5.bi5_path(tmp_path, HOUR)
+
+    status, size, sha = download_bi5.fetch_hour(download_bi5.bi5_url(PAIR, HOUR, local_http.url), out,
+                                                 timeout=5, retries=3, backoff=0)
+
+    assert (status, size) == (STATUS_OK, 5)
+    assert out.read_bytes() == b"ticks"
+    assert sha is not None
+    assert len(local_http.requests) == 3
+
+
+def test_fetch_hour_truncated_body_leaves_no_file(local_http, tmp_path):
+    local_http.route(hour_url_path(HOUR), Response(200, b"x" * 1000, truncate=10))
+    out = download_bi5.bi5_path(tmp_path, HOUR)
+
+    status, size, _sha = download_bi5.fetch_hour(download_bi5.bi5_url(PAIR, HOUR, local_http.url), out,
+                                                  timeout=5, retries=1, backoff=0)
+
+    assert (status, size) == (STATUS_ERROR, 0)
+    assert not out.exists()
+    assert list(out.parent.iterdir()) == []  # 一時ファイルも残らない
+    assert len(local_http.requests) == 2
+
+
+def test_fetch_hour_truncated_then_complete(local_http, tmp_path):
+    body = b"x" * 1000
+    local_http.route(hour_url_path(HOUR), Response(200, body, truncate=10), Response(200, body))
+    out = download_bi5.bi5_path(tmp_path, HOUR)
+
+    status, size, _sha = download_bi5.fetch_hour(download_bi5.bi5_url(PAIR, HOUR, local_http.url), out,
+                                                  timeout=5, retries=1, backoff=0)
+
+    assert (status, size) == (STATUS_OK, len(body))
+    assert out.read_bytes() == body
+
+
+def test_run_records_manifest_and_skips_completed_hours(local_http, tmp_path):
+    hours = [HOUR.replace(hour=h) for h in range(4)]
+    local_http.route(hour_url_path(hours[0]), Response(200, b"h0"))
+    # hours[1] はルート無し（404）
+    local_http.route(hour_url_path(hours[2]), Response(200, b""))
+    local_http.route(hour_url_path(hours[3]), Response(200, b"h3"))
+    argv = ["--pair", PAIR, "--start", "2024-01-02T00", "--end", "2024-01-02T04",
+            "--out-root", str(tmp_path), "--base-url", local_http.url, "--timeout", "5"]
+
+    first = download_bi5.run(argv)
+
+    assert (first["ok_hours"], first["missing_hours"]) == (2, 2)
+    with Bi5Manifest(tmp_path / PAIR) as manifest:
+        statuses = {k: v[0] for k, v in manifest.entries(hours).items()}
+    assert statuses == {
+        hour_key(hours[0]): STATUS_OK,
+        hour_key(hours[1]): STATUS_MISSING,
+        hour_key(hours[2]): STATUS_EMPTY,
+        hour_key(hours[3]): STATUS_OK,
+    }
+    assert sorted(p.name for p in Path(tmp_path / PAIR).rglob("*.bi5")) == ["00h_ticks.bi5", "03h_ticks.bi5"]
+    assert len(local_http.requests) == 4
+
+    # 2回目: 取得済みの時間と、確定した404・空の時間には問い合わせない
+    second = download_bi5.run(argv)
+
+    assert (second["ok_hours"], second["missing_hours"]) == (2, 2)
+    assert len(local_http.requests) == 4
@@ -0,0 +1,32 @@
+# -*- coding: utf-8 -*-
+
+"""events_store の変更の記録（changes）"""
+
+import pandas as pd
+
+from events_store import EventsStore
+
+
+def event(i: int, day: int, sentiment: float = 0.5) -> dict:
+    return {"id": f"e{i}", "ts": pd.Timestamp(f"2024-01-{day:02d}", tz="UTC"), "category": "news",
+            "sentiment": sentiment}
+
+
+def test_prune_changes_keeps_seq_and_floor(tmp_path):
+    store = EventsStore(tmp_path / "events.sqlite")
+    store.upsert([event(1, 5), event(2, 6)])
+    seq = store.change_seq()
+    store.upsert([event(3, 2), event(1, 5, sentiment=-1.0)])
+
+    assert store.prune_changes(seq) == 2
+    assert store.changes_floor() == seq
+    # 通し番号は消しても戻らず、残した変更は追える
+    assert store.change_seq() == seq + 2
+    assert store.changed_since(seq) == pd.Timestamp("2024-01-02", tz="UTC")
+
+    assert store.prune_changes(seq) == 0
+    assert store.prune_changes(store.change_seq()) == 2
+    assert store.change_seq() == seq + 2
+    assert store.changed_since(seq + 2) is None
+    store.upsert([event(4, 9)])
+    assert store.change_seq() == seq + 3
@@ -0,0 +1,50 @@
+# -*- coding: utf-8 -*-
+
+"""feature_store の全期間の書き直し（write）"""
+
+import os
+import threading
+
+import numpy as np
+import pandas as pd
+
+from feature_store import FeatureStore
+
+
+def features(months: int = 3, shift: float = 0.0) -> pd.DataFrame:
+    ts = pd.date_range("2024-01-01", periods=months * 24 * 28, freq="1h", tz="UTC")
+    return pd.DataFrame({"ts": ts, "x": np.arange(len(ts), dtype=float) + shift})
+
+
+def test_write_swaps_in_a_new_directory(tmp_path):
+    store = FeatureStore("USDJPY", "M5", root=tmp_path)
+    store.write(features(3))
+    (store.path / "_state.json").write_text("{}")
+
+    store.write(features(2, shift=100.0))
+
+    assert [f.parent.name for f in store.partitions()] == ["month=2024-01", "month=2024-02"]
+    assert store.range()["x"].iloc[0] == 100.0
+    # 古いディレクトリ（状態ファイルを含む）も一時ディレクトリも残らない
+    assert os.listdir(tmp_path / "USDJPY") == ["tf=M5"]
+    assert not (store.path / "_state.json").exists()
+
+
+def test_reader_waits_for_a_swap_in_progress(tmp_path):
+    store = FeatureStore("USDJPY", "M5", root=tmp_path)
+    store.write(features(1))
+    # write が古いディレクトリを退かし、新しい方をまだ入れていない状態を作る
+    old = tmp_path / "USDJPY" / ".tf=M5.abc.old"
+    old.mkdir()
+    os.replace(store.path, old / "tf=M5")
+
+    def finish_swap():
+        os.replace(old / "tf=M5", store.path)
+        old.rmdir()
+
+    timer = threading.Timer(0.05, finish_swap)
+    timer.start()
+    try:
+        assert len(store.latest(5)) == 5
+    finally:
+        timer.join()
@@ -0,0 +1,85 @@
+# -*- coding: utf-8 -*-
+
+"""jobs/fetch_rss_events の条件付きGETをローカルのHTTPサーバーに向けて確かめる"""
+
+from conftest import Response
+from events_store import EventsStore
+from jobs import fetch_rss_events
+
+LAST_MODIFIED = "Mon, 01 Jan 2024 00:00:00 GMT"
+
+
+def rss(*titles: str, dated: bool = True) -> bytes:
+    items = "".join(
+        f"<item><title>{t}</title><link>https://example.com/{i}</link>"
+        + (f"<pubDate>Mon, 01 Jan 2024 0{i}:00:00 GMT</pubDate>" if dated else "") + "</item>"
+        for i, t in enumerate(titles)
+    )
+    return (f'<?xml version="1.0"?><rss version="2.0"><channel><title>bank</title>{items}'
+            f"</channel></rss>").encode("utf-8")
+
+
+def test_conditional_get(local_http, tmp_path):
+    db = tmp_path / "events.sqlite"
+    local_http.route(
+        "/feed.xml",
+        Response(200, rss("rate decision", "speech"), {"ETag": '"v1"', "Last-Modified": LAST_MODIFIED}),
+        Response(304),
+        Response(200, rss("rate decision", "speech", "minutes"), {"ETag": '"v2"'}),
+        Response(304),
+    )
+    argv = ["--events-cache", str(db), "--feed", f"bank={local_http.url}/feed.xml", "--timeout", "5"]
+
+    first = fetch_rss_events.run(argv)
+    assert (first["inserted"], first["not_modified"]) == (2, 0)
+    assert "If-None-Match" not in local_http.requests[0][1]
+
+    # 2回目: 前回の ETag / Last-Modified を送り、304 ならイベントストアに書かない
+    store = EventsStore(db)
+    seq = store.change_seq()
+    second = fetch_rss_events.run(argv)
+    headers = local_http.requests[1][1]
+    assert headers["If-None-Match"] == '"v1"'
+    assert headers["If-Modified-Since"] == LAST_MODIFIED
+    assert (second["inserted"], second["updated"], second["not_modified"]) == (0, 0, 1)
+    assert second["feeds"]["bank"]["status"] == 304
+    assert store.change_seq() == seq
+    assert store.count() == 2
+
+    # 3回目: フィードが変わって新しい ETag が返れば取り込み、以後はその ETag を送る
+    third = fetch_rss_events.run(argv)
+    assert local_http.requests[2][1]["If-None-Match"] == '"v1"'
+    assert (third["inserted"], third["not_modified"]) == (1, 0)
+    assert store.count() == 3
+
+    fourth = fetch_rss_events.run(argv)
+    assert local_http.requests[3][1]["If-None-Match"] == '"v2"'
+    assert fourth["not_modified"] == 1
+
+
+def test_no_conditional_ignores_validators(local_http, tmp_path):
+    db = tmp_path / "events.sqlite"
+    local_http.route("/feed.xml", Response(200, rss("speech"), {"ETag": '"v1"'}))
+    argv = ["--events-cache", str(db), "--feed", f"bank={local_http.url}/feed.xml", "--timeout", "5"]
+
+    fetch_rss_events.run(argv)
+    again = fetch_rss_events.run(argv + ["--no-conditional"])
+
+    assert "If-None-Match" not in local_http.requests[1][1]
+    assert (again["inserted"], again["updated"], again["not_modified"]) == (0, 0, 0)
+
+
+def test_undated_entries_keep_first_seen_ts(local_http, tmp_path):
+    db = tmp_path / "events.sqlite"
+    local_http.route("/feed.xml", Response(200, rss("speech", "minutes", dated=False)))
+    argv = ["--events-cache", str(db), "--feed", f"bank={local_http.url}/feed.xml", "--timeout", "5"]
+
+    assert fetch_rss_events.run(argv)["inserted"] == 2
+    store = EventsStore(db)
+    seq, first = store.change_seq(), store.range()["ts"].tolist()
+
+    # 取り直しても時刻の無い項目の ts は書き換えず、変更も記録しない
+    again = fetch_rss_events.run(argv)
+    assert (again["inserted"], again["updated"]) == (0, 0)
+    assert store.range()["ts"].tolist() == first
+    assert store.change_seq() == seq